@@ -0,0 +1,169 @@
+"""
+In-process stand-in for the Outline management API
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+KEY_PATH = re.compile(r"^/access-keys/(?P<key_id>[^/]+)(?P<rest>/name|/data-limit)?$")
+
+
+class _Server(ThreadingHTTPServer):
+    # the default backlog of 5 makes concurrent clients wait for SYN retransmits
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeOutlineServer:
+    """
+    Serves the access-keys, metrics, name and data-limit endpoints of one
+    Outline server from memory, over plain HTTP on a free local port.
+
+    Every request sleeps for `latency` seconds and fails with a 500 with
+    probability `failure_rate`. Requests are counted per method and endpoint.
+    """
+
+    def __init__(
+        self,
+        keys: int = 100,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param keys: keys the server starts with, named like Telegram users
+        :param latency: seconds added to every request
+        :param failure_rate: share of requests answered with a server error
+        :param seed: seed of the failures and of the generated traffic
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.keys: Dict[str, dict] = {}
+        self.used: Dict[str, int] = {}
+        for i in range(keys):
+            key = self._create()
+            key["name"] = f"User{i}_None_{1000000 + i}"
+            self.used[key["id"]] = self._random.randrange(0, 10 * 1024 ** 3)
+
+        self.server = _Server(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/secret"
+
+    def start(self) -> "FakeOutlineServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def handle(self, method: str, path: str, body: bytes) -> Tuple[int, Optional[dict]]:
+        """
+        Answer one request
+        :return: HTTP status and JSON body
+        """
+        if not path.startswith("/secret/"):
+            return 404, None
+        path = path[len("/secret"):]
+
+        match = KEY_PATH.match(path)
+        endpoint = path if match is None else "/access-keys/{id}" + (match.group("rest") or "")
+        with self._lock:
+            self.calls[f"{method} {endpoint}"] += 1
+            failed = self._random.random() < self.failure_rate
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if failed:
+            return 500, None
+
+        with self._lock:
+            if method == "GET" and path == "/access-keys/":
+                return 200, {"accessKeys": [dict(key) for key in self.keys.values()]}
+            if method == "GET" and path == "/metrics/transfer":
+                return 200, {"bytesTransferredByUserId": dict(self.used)}
+            if method == "GET" and path == "/server":
+                return 200, {"name": "fake", "serverId": "fake"}
+            if method == "POST" and path == "/access-keys/":
+                return 201, dict(self._create())
+            if match is None or match.group("key_id") not in self.keys:
+                return 404, None
+
+            key = self.keys[match.group("key_id")]
+            if method == "DELETE" and match.group("rest") is None:
+                del self.keys[key["id"]]
+                self.used.pop(key["id"], None)
+                return 204, None
+            if method == "PUT" and match.group("rest") == "/name":
+                key["name"] = _form_field(body, "name")
+                return 204, None
+            if method == "PUT" and match.group("rest") == "/data-limit":
+                key["dataLimit"] = json.loads(body)["limit"]
+                return 204, None
+            if method == "DELETE" and match.group("rest") == "/data-limit":
+                key.pop("dataLimit", None)
+                return 204, None
+        return 404, None
+
+    def _create(self) -> dict:
+        key_id = str(self._next_id)
+        self._next_id += 1
+        key = {
+            "id": key_id,
+            "name": "",
+            "password": "secret",
+            "port": 443,
+            "method": "chacha20-ietf-poly1305",
+            "accessUrl": f"ss://fake-{key_id}@127.0.0.1:443/?outline=1",
+        }
+        self.keys[key_id] = key
+        return key
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive like the real server does
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length > 0 else b""
+                status, data = fake.handle(self.command, self.path, body)
+                payload = json.dumps(data).encode() if data is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                pass
+
+        return Handler
+
+
+def _form_field(body: bytes, name: str) -> str:
+    """The value of a field in a multipart/form-data body"""
+    marker = f'name="{name}"'.encode()
+    start = body.index(marker) + len(marker)
+    start = body.index(b"\r\n\r\n", start) + 4
+    return body[start:body.index(b"\r\n", start)].decode()
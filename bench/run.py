@@ -0,0 +1,214 @@
+"""
+Latency benchmark of /start and /stats against in-process fake Outline servers
+
+    python -m bench.run --servers 3 --keys 1000 --users 200 --latency 0.02
+
+Every run is appended as one JSON line to the output file and compared with
+the previous run of the same configuration.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from telegram import Chat, ChatMember, Message, Update, User
+
+from bench.fake_outline import FakeOutlineServer
+from bot.outbox import RateLimiter
+from bot.vpn_bot import VPNBot
+
+FIRST_USER_ID = 2000000
+
+
+class FakeTelegram:
+    """Answers the Bot API calls the handlers make and counts them"""
+
+    defaults = None
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+
+    def get_chat(self, chat_id):
+        """The main chat"""
+        self.calls["getChat"] += 1
+        return SimpleNamespace(id=chat_id, title="Benchmark")
+
+    def getChatMember(self, chat_id, user_id):  # pylint: disable=C0103
+        """Everybody is a member"""
+        self.calls["getChatMember"] += 1
+        return ChatMember(User(user_id, "Bench", False), ChatMember.MEMBER)
+
+    def send_message(self, *args, **kwargs):
+        """Drops the message"""
+        self.calls["sendMessage"] += 1
+
+    sendMessage = send_message
+
+
+def make_update(update_id: int, user_id: int, text: str, bot: FakeTelegram) -> Update:
+    """A private message from a user, as if received from Telegram"""
+    user = User(user_id, f"Bench{user_id}", False)
+    chat = Chat(user_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(), chat, from_user=user, text=text, bot=bot)
+    return Update(update_id, message=message)
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    """p50, p95 and p99 in milliseconds"""
+    import numpy as np  # pylint: disable=C0415
+
+    p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2)}
+
+
+def run(
+    servers: int = 3,
+    keys: int = 1000,
+    users: int = 200,
+    concurrency: int = 16,
+    latency: float = 0.0,
+    failure_rate: float = 0.0,
+    pool_size: int = 0,
+    seed: int = 0,
+) -> dict:
+    """
+    Send /start from new users, /start again and /stats through VPNBot
+    :return: latency percentiles and API calls of every phase
+    """
+    fakes = [
+        FakeOutlineServer(keys, latency, failure_rate, seed=seed + i).start()
+        for i in range(servers)
+    ]
+    telegram = FakeTelegram()
+    context = SimpleNamespace(bot=telegram)
+
+    with tempfile.TemporaryDirectory() as directory:
+        servers_path = os.path.join(directory, "servers.json")
+        with open(servers_path, "w") as f:
+            json.dump({"servers": [fake.api_url for fake in fakes]}, f)
+
+        bot = VPNBot(
+            chat_id=-1, dev_chat_id=-2, vpn_urls=servers_path, max_users=keys + users,
+            index_path=os.path.join(directory, "users.sqlite"), stats_interval=3600,
+            pool_size=pool_size, limiter=RateLimiter(rate=0, chat_interval=0, group_interval=0),
+        )
+        bot.start_background()
+        try:
+            _wait(lambda: bot.usage.ready and all(
+                bot.provider.pool.available(fake.api_url) >= pool_size for fake in fakes))
+            phases = {}
+            update_ids = iter(range(1, 10 * users + 1))
+            for name, text in (("start_new", "/start"), ("start_known", "/start"), ("stats", "/stats")):
+                handler = bot.start if text == "/start" else bot.stats
+                updates = [make_update(next(update_ids), FIRST_USER_ID + i, text, telegram)
+                           for i in range(users)]
+                phases[name] = _phase(handler, updates, context, fakes, concurrency)
+        finally:
+            bot.usage.stop()
+            bot.provider.close()
+            for fake in fakes:
+                fake.stop()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "servers": servers, "keys": keys, "users": users, "concurrency": concurrency,
+            "latency": latency, "failure_rate": failure_rate, "pool_size": pool_size,
+        },
+        "phases": phases,
+    }
+
+
+def _phase(handler: Callable, updates: List[Update], context, fakes, concurrency: int) -> dict:
+    for fake in fakes:
+        fake.reset_calls()
+
+    def timed(update):
+        started = time.perf_counter()
+        handler(update, context)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        seconds = list(executor.map(timed, updates))
+    elapsed = time.perf_counter() - started
+
+    calls: Counter = Counter()
+    for fake in fakes:
+        calls.update(fake.calls)
+    result = percentiles(seconds)
+    result.update({
+        "requests": len(updates),
+        "per_second": round(len(updates) / elapsed, 1),
+        "api_calls": dict(sorted(calls.items())),
+        "api_calls_per_request": round(sum(calls.values()) / len(updates), 2),
+    })
+    return result
+
+
+def _wait(ready: Callable[[], bool], timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not ready() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def previous(path: str, config: dict) -> Optional[dict]:
+    """The last stored run with the same configuration"""
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("config") == config:
+                last = result
+    return last
+
+
+def report(result: dict, before: Optional[dict]) -> str:
+    """A table of the phases, with the change of p95 since the previous run"""
+    lines = [f"{json.dumps(result['config'])}",
+             f"{'phase':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'calls/req':>11}  p95 change"]
+    for name, phase in result["phases"].items():
+        change = ""
+        if before is not None and name in before["phases"] and before["phases"][name]["p95"] > 0:
+            change = f"{(phase['p95'] / before['phases'][name]['p95'] - 1) * 100:+.1f}%"
+        lines.append(f"{name:<12}{phase['p50']:>10}{phase['p95']:>10}{phase['p99']:>10}"
+                     f"{phase['per_second']:>10}{phase['api_calls_per_request']:>11}  {change}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /start and /stats against fake Outline servers")
+    parser.add_argument("--servers", type=int, default=3, help="Fake Outline servers")
+    parser.add_argument("--keys", type=int, default=1000, help="Keys every server starts with")
+    parser.add_argument("--users", type=int, default=200, help="New users sending /start and /stats")
+    parser.add_argument("--concurrency", type=int, default=16, help="Updates handled at once")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of API calls that fail")
+    parser.add_argument("--pool_size", type=int, default=0, help="Pre-provisioned keys per server")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake servers")
+    parser.add_argument("--output", type=str, default="bench_output.txt",
+                        help="File the results are appended to")
+    args = parser.parse_args()
+
+    result = run(args.servers, args.keys, args.users, args.concurrency,
+                 args.latency, args.failure_rate, args.pool_size, args.seed)
+    before = previous(args.output, result["config"])
+    print(report(result, before))
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
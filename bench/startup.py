@@ -0,0 +1,164 @@
+"""
+Cold start benchmark: the time to import the bot and to answer the first /start
+
+    python -m bench.startup --repeat 5 --import_budget 1.0 --startup_budget 2.0
+
+Every measurement starts a fresh interpreter, like a restart under systemd does.
+The run fails when the median of a phase is over its budget or when a module
+loaded on first use was imported along with the bot.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from statistics import median
+from typing import Dict, List, Optional
+
+# modules the bot imports on first use only
+DEFERRED = ("numpy", "watchdog.observers")
+
+PHASES = ("import", "first_start", "total")
+
+
+def measure(servers_path: str, index_path: str) -> dict:
+    """
+    Import the bot, start it and answer a /start from a new user, in this interpreter
+    :return: seconds of every phase and the deferred modules the import loaded
+    """
+    started = time.perf_counter()
+    import bot.vpn_bot  # pylint: disable=C0415
+
+    imported = time.perf_counter()
+    loaded = [module for module in DEFERRED if module in sys.modules]
+
+    from types import SimpleNamespace  # pylint: disable=C0415
+
+    from bench.run import FIRST_USER_ID, FakeTelegram, make_update  # pylint: disable=C0415
+    from bot.outbox import RateLimiter  # pylint: disable=C0415
+
+    helpers = time.perf_counter()
+    telegram = FakeTelegram()
+    vpn_bot = bot.vpn_bot.VPNBot(
+        chat_id=-1, dev_chat_id=-2, vpn_urls=servers_path, index_path=index_path, max_users=10 ** 6,
+        limiter=RateLimiter(rate=0, chat_interval=0, group_interval=0),
+    )
+    vpn_bot.start_background()
+    vpn_bot.start(make_update(1, FIRST_USER_ID, "/start", telegram), SimpleNamespace(bot=telegram))
+    answered = time.perf_counter()
+    vpn_bot.usage.stop()
+    vpn_bot.provider.close()
+
+    first_start = answered - helpers
+    return {
+        "seconds": {"import": imported - started, "first_start": first_start,
+                    "total": imported - started + first_start},
+        "loaded": loaded,
+    }
+
+
+def run(repeat: int = 5, servers: int = 3, keys: int = 1000) -> dict:
+    """
+    Measure the cold start `repeat` times, every time in a new interpreter and with an empty index
+    :return: median, min and max milliseconds of every phase
+    """
+    from bench.fake_outline import FakeOutlineServer  # pylint: disable=C0415
+
+    fakes = [FakeOutlineServer(keys, seed=i).start() for i in range(servers)]
+    samples: List[dict] = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            servers_path = os.path.join(directory, "servers.json")
+            with open(servers_path, "w") as f:
+                json.dump({"servers": [fake.api_url for fake in fakes]}, f)
+            for i in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, "-m", "bench.startup", "--measure", servers_path,
+                     os.path.join(directory, f"users{i}.sqlite")],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                ).stdout
+                samples.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        for fake in fakes:
+            fake.stop()
+
+    phases = {}
+    for phase in PHASES:
+        milliseconds = [sample["seconds"][phase] * 1000 for sample in samples]
+        phases[phase] = {"median": round(median(milliseconds), 1), "min": round(min(milliseconds), 1),
+                         "max": round(max(milliseconds), 1)}
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {"benchmark": "startup", "repeat": repeat, "servers": servers, "keys": keys},
+        "phases": phases,
+        "loaded": sorted({module for sample in samples for module in sample["loaded"]}),
+    }
+
+
+def over_budget(result: dict, budgets: Dict[str, float]) -> List[str]:
+    """
+    :param budgets: phase -> most milliseconds its median may take
+    :return: a line for every phase over its budget and for every deferred module that was loaded
+    """
+    problems = [
+        f"{phase} took {result['phases'][phase]['median']} ms, the budget is {budget} ms"
+        for phase, budget in budgets.items()
+        if result["phases"][phase]["median"] > budget
+    ]
+    problems.extend(f"{module} was imported with the bot" for module in result["loaded"])
+    return problems
+
+
+def report(result: dict, before: Optional[dict], budgets: Dict[str, float]) -> str:
+    """A table of the phases, with the change of the median since the previous run"""
+    lines = [f"{json.dumps(result['config'])}",
+             f"{'phase':<12}{'median ms':>10}{'min ms':>10}{'max ms':>10}{'budget ms':>10}  median change"]
+    for name, phase in result["phases"].items():
+        change = ""
+        if before is not None and name in before["phases"] and before["phases"][name]["median"] > 0:
+            change = f"{(phase['median'] / before['phases'][name]['median'] - 1) * 100:+.1f}%"
+        budget = budgets.get(name, "")
+        lines.append(f"{name:<12}{phase['median']:>10}{phase['min']:>10}{phase['max']:>10}{budget:>10}  {change}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the bot against a time budget")
+    parser.add_argument("--repeat", type=int, default=5, help="Interpreters started")
+    parser.add_argument("--servers", type=int, default=3, help="Fake Outline servers")
+    parser.add_argument("--keys", type=int, default=1000, help="Keys every server starts with")
+    parser.add_argument("--import_budget", type=float, default=1.0,
+                        help="Seconds the median import of the bot may take")
+    parser.add_argument("--startup_budget", type=float, default=2.0,
+                        help="Seconds the median import and first /start may take together")
+    parser.add_argument("--output", type=str, default="bench_output.txt",
+                        help="File the results are appended to")
+    parser.add_argument("--measure", nargs=2, metavar=("SERVERS", "INDEX"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure)))
+        return
+
+    from bench.run import previous  # pylint: disable=C0415
+
+    budgets = {"import": args.import_budget * 1000, "total": args.startup_budget * 1000}
+    result = run(args.repeat, args.servers, args.keys)
+    before = previous(args.output, result["config"])
+    print(report(result, before, budgets))
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    problems = over_budget(result, budgets)
+    for problem in problems:
+        print(f"Over budget: {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Unit tests for the benchmark harness
+"""
+
+import json
+
+import pytest
+
+from bench.fake_outline import FakeOutlineServer
+from bench.run import previous, report, run
+from outline.outline_vpn import OutlineVPN
+
+
+@pytest.fixture
+def fake():
+    """A fake server with a few keys"""
+    server = FakeOutlineServer(keys=3, seed=1).start()
+    yield server
+    server.stop()
+
+
+def test_speaks_the_outline_api(fake: FakeOutlineServer):  # pylint: disable=W0621
+    """The real client can manage keys on the fake server"""
+    with OutlineVPN(api_url=fake.api_url) as client:
+        assert len(client.snapshot()) == 3
+        key = client.create_key()
+        assert client.rename_key(key.key_id, "new")
+        assert client.add_data_limit(key.key_id, 1024)
+        assert fake.keys[key.key_id]["name"] == "new"
+        assert fake.keys[key.key_id]["dataLimit"] == {"bytes": 1024}
+        assert client.delete_key(key.key_id)
+        assert client.get_server_info()["name"] == "fake"
+
+    assert fake.calls["POST /access-keys/"] == 1
+    assert fake.calls["PUT /access-keys/{id}/name"] == 1
+
+
+def test_injected_failures():
+    """A failure rate of one fails every call"""
+    fake = FakeOutlineServer(keys=1, failure_rate=1.0).start()
+    try:
+        with OutlineVPN(api_url=fake.api_url, retries=0) as client:
+            with pytest.raises(Exception):
+                client.snapshot()
+    finally:
+        fake.stop()
+
+
+def test_run_reports_every_phase(tmp_path):
+    """A small run measures all phases and compares with the stored one"""
+    result = run(servers=2, keys=10, users=4, concurrency=2)
+    assert set(result["phases"]) == {"start_new", "start_known", "stats"}
+    assert result["phases"]["start_new"]["api_calls"]["POST /access-keys/"] == 4
+    assert result["phases"]["start_known"]["api_calls_per_request"] == 0
+
+    output = tmp_path / "bench_output.txt"
+    output.write_text(json.dumps(result) + "\n")
+    assert previous(str(output), result["config"]) == result
+    assert "+0.0%" in report(result, result)
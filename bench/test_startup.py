@@ -0,0 +1,24 @@
+"""
+Unit tests for the cold start benchmark
+"""
+
+from bench.startup import over_budget, report, run
+
+
+def test_startup_leaves_heavy_imports_for_later():
+    """A cold start measures every phase and imports none of the deferred modules"""
+    result = run(repeat=1, servers=1, keys=10)
+    assert set(result["phases"]) == {"import", "first_start", "total"}
+    assert result["loaded"] == []
+    phases = result["phases"]
+    assert phases["total"]["median"] >= phases["import"]["median"] > 0
+
+    assert over_budget(result, {"import": 10 ** 6, "total": 10 ** 6}) == []
+    assert len(over_budget(result, {"import": 0, "total": 10 ** 6})) == 1
+    assert "+0.0%" in report(result, result, {"import": 1000})
+
+
+def test_budget_counts_deferred_modules():
+    """A deferred module imported with the bot fails the check even within the time budget"""
+    result = {"phases": {"import": {"median": 10.0}}, "loaded": ["numpy"]}
+    assert over_budget(result, {"import": 100}) == ["numpy was imported with the bot"]
@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Optional, TypeVar
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+T = TypeVar('T')
+
+
+@dataclass
+class ServerHealth:
+    """
+    Circuit breaker state and recent results of one server
+    """
+
+    state: str = CLOSED
+    # failures in a row since the last success
+    failures: int = 0
+    # monotonic time the circuit last opened or let a trial request through
+    changed_at: float = 0.0
+    # exponentially weighted moving average of successful calls, in seconds
+    latency: Optional[float] = None
+    last_error: Optional[str] = None
+    # True for every success and False for every failure, newest last
+    results: Deque[bool] = field(default_factory=lambda: deque(maxlen=20))
+
+    @property
+    def error_rate(self) -> float:
+        if len(self.results) == 0:
+            return 0.0
+        return round(self.results.count(False) / len(self.results), 2)
+
+
+class HealthChecker:
+    """
+    Tracks the latency and error rate of every server from background probes
+    and from the calls made while serving users.
+
+    After `failure_threshold` failures in a row the server's circuit opens and
+    handlers skip it without waiting. Once `reset_timeout` seconds have passed a
+    single trial call is let through (half-open): a success closes the circuit,
+    a failure opens it again.
+    """
+
+    def __init__(self, provider, interval: float = 30, failure_threshold: int = 3,
+                 reset_timeout: float = 60, window: int = 20):
+        """
+        :param provider: VPNProvider with the servers to probe
+        :param interval: seconds between probes of every server
+        :param failure_threshold: failures in a row that open the circuit
+        :param reset_timeout: seconds an open circuit waits before a trial call
+        :param window: recent results the error rate is computed over
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.window = window
+        self._lock = threading.Lock()
+        self._servers: Dict[str, ServerHealth] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name='health-checker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def allow(self, server: str) -> bool:
+        """
+        Whether a call to the server may be made now;
+        the first call after `reset_timeout` on an open circuit is its trial
+        """
+        with self._lock:
+            health = self._health(server)
+            if health.state == CLOSED:
+                return True
+            if time.monotonic() - health.changed_at < self.reset_timeout:
+                return False
+            # a trial whose answer never came is retried after another reset_timeout
+            health.state = HALF_OPEN
+            health.changed_at = time.monotonic()
+            return True
+
+    def is_closed(self, server: str) -> bool:
+        with self._lock:
+            return self._health(server).state == CLOSED
+
+    def call(self, server: str, func: Callable[[], T]) -> T:
+        """
+        Run a call to the server and record how it went
+        """
+        started = time.monotonic()
+        try:
+            result = func()
+        except Exception as e:
+            self.record_failure(server, e)
+            raise
+        self.record_success(server, time.monotonic() - started)
+        return result
+
+    def forget(self, server: str):
+        """
+        Drop what is known about a server that was removed
+        """
+        with self._lock:
+            self._servers.pop(server, None)
+
+    def record_success(self, server: str, latency: float):
+        with self._lock:
+            health = self._health(server)
+            health.results.append(True)
+            health.latency = latency if health.latency is None else 0.8 * health.latency + 0.2 * latency
+            health.failures = 0
+            if health.state != CLOSED:
+                health.state = CLOSED
+                self.logger.info(f'{server} is back, closing its circuit')
+
+    def record_failure(self, server: str, error: Exception):
+        with self._lock:
+            health = self._health(server)
+            health.results.append(False)
+            health.failures += 1
+            health.last_error = str(error)
+            if health.state == HALF_OPEN or (
+                    health.state == CLOSED and health.failures >= self.failure_threshold):
+                health.state = OPEN
+                health.changed_at = time.monotonic()
+                self.logger.error(
+                    f'{server} failed {health.failures} times in a row, opening its circuit: {error}')
+
+    def status(self) -> Dict[str, ServerHealth]:
+        """
+        A copy of the health of every server seen so far
+        """
+        with self._lock:
+            return {server: ServerHealth(health.state, health.failures, health.changed_at,
+                                         health.latency, health.last_error,
+                                         deque(health.results, maxlen=self.window))
+                    for server, health in self._servers.items()}
+
+    def probe(self):
+        """
+        Check every server whose circuit lets a call through
+        """
+        servers = [server for server in self.provider.configurator.servers if self.allow(server)]
+        futures = {self.provider.background.submit(
+            self.call, server, self.provider.scan_client(server).get_server_info): server
+            for server in servers}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.debug(f'Probe of {futures[future]} failed with error: {e}')
+
+    def _health(self, server: str) -> ServerHealth:
+        health = self._servers.get(server)
+        if health is None:
+            health = self._servers[server] = ServerHealth(results=deque(maxlen=self.window))
+        return health
+
+    def _loop(self):
+        while True:
+            try:
+                self.probe()
+            except Exception as e:
+                self.logger.error(f'Could not probe the servers with error: {e}')
+            if self._stopped.wait(self.interval):
+                return
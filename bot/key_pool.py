@@ -0,0 +1,177 @@
+import logging
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import as_completed
+from typing import Deque, Dict, Optional, Set
+
+from outline.outline_vpn import KeySnapshot, OutlineKey, OutlineVPN
+
+# names of keys created ahead of time, pool:instance:id; user keys are named first_last_id
+POOL_PREFIX = 'pool:'
+
+
+def is_pooled(name: Optional[str]) -> bool:
+    return name is not None and name.startswith(POOL_PREFIX)
+
+
+def count_users(snapshot: KeySnapshot) -> int:
+    """
+    Number of keys on a server that belong to users, leaving out pooled keys
+    """
+    return sum(1 for record in snapshot.records if not is_pooled(record.get('name')))
+
+
+class KeyPool:
+    """
+    Keeps up to `size` unassigned keys on every server, already created
+    and limited to the provider's `bytes_limit`, so a new user only needs a rename.
+
+    Taking a key wakes up the provisioner, which refills the pools in the background.
+    A server is never filled beyond its capacity, users and pooled keys together.
+    Pooled keys do not survive a restart: the ones left by a previous run are deleted
+    before the first refill. Every pool names its keys after itself and keeps announcing
+    itself in the provider's store, so pools of other processes sharing the store keep theirs.
+    """
+
+    def __init__(self, provider, size: int = 3, interval: float = 60):
+        """
+        :param provider: VPNProvider with the servers to provision
+        :param size: unassigned keys kept per server
+        :param interval: seconds between refills when no key is taken
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.size = size
+        self.interval = interval
+        self.instance = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        # server URL -> keys ready to be handed out
+        self._keys: Dict[str, Deque[OutlineKey]] = {}
+        self._wanted = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name='key-pool', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wanted.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def wake(self):
+        """
+        Refill the pools now instead of after `interval`
+        """
+        self._wanted.set()
+
+    def available(self, server: str) -> int:
+        with self._lock:
+            return len(self._keys.get(server, ()))
+
+    def take(self, server: str) -> Optional[OutlineKey]:
+        """
+        Hand out a pooled key of a server and schedule a refill
+        :return: the key, None if the server's pool is empty
+        """
+        with self._lock:
+            keys = self._keys.get(server)
+            key = keys.popleft() if keys else None
+        self._wanted.set()
+        return key
+
+    def cleanup(self):
+        """
+        Delete pooled keys that this pool does not hold, left behind by an earlier run
+        """
+        self._for_each_client(self._cleanup)
+
+    def refill(self):
+        """
+        Top up the pool of every server
+        """
+        servers = set(self.provider.configurator.servers)
+        with self._lock:
+            for server in [server for server in self._keys if server not in servers]:
+                del self._keys[server]
+        self._for_each_client(self._fill)
+
+    def _for_each_client(self, job):
+        futures = {self.provider.background.submit(job, client): client
+                   for client in self.provider.clients() if self.provider.health.is_closed(client.api_url)}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.error(
+                    f'Could not provision keys on {futures[future].api_url} with error: {e}')
+
+    def _alive(self):
+        self.provider.store.set('pools', self.instance, '1', ttl=max(3 * self.interval, 300))
+
+    def _orphaned(self, name: str, key_id: str, held: Set[str]) -> bool:
+        instance, _, rest = name[len(POOL_PREFIX):].partition(':')
+        if not rest:
+            # named before pools had instances
+            return True
+        if instance == self.instance:
+            return key_id not in held
+        return self.provider.store.get('pools', instance) is None
+
+    def _cleanup(self, client: OutlineVPN):
+        with self._lock:
+            held = {str(key.key_id) for key in self._keys.get(client.api_url, ())}
+        orphans = [record.get('id') for record in client.snapshot().records
+                   if is_pooled(record.get('name'))
+                   and self._orphaned(record['name'], str(record.get('id')), held)]
+        for key_id in orphans:
+            client.delete_key(key_id)
+        if orphans:
+            self.logger.info(f'Deleted {len(orphans)} orphaned pool keys on {client.api_url}')
+
+    def _fill(self, client: OutlineVPN):
+        server = client.api_url
+        # counted by the reconciler, the last scan and every key given out since
+        stored = self.provider.store.get('server_users', server)
+        users = int(stored) if stored is not None else count_users(client.snapshot())
+        created = 0
+        while not self._stopped.is_set():
+            available = self.available(server)
+            if available >= self.size or users + available >= self.provider.capacity(server):
+                break
+
+            key = client.create_key()
+            key.name = f'{POOL_PREFIX}{self.instance}:{key.key_id}'
+            try:
+                if not (client.rename_key(key.key_id, key.name)
+                        and client.add_data_limit(key.key_id, self.provider.bytes_limit)):
+                    raise Exception('the server refused to set up the key')
+            except Exception:
+                client.delete_key(key.key_id)
+                raise
+
+            with self._lock:
+                self._keys.setdefault(server, deque()).append(key)
+            created += 1
+
+        if created:
+            self.logger.debug(f'Added {created} keys to the pool of {server}')
+
+    def _loop(self):
+        self._alive()
+        try:
+            self.cleanup()
+        except Exception as e:
+            self.logger.error(f'Could not clean up the key pool with error: {e}')
+
+        while not self._stopped.is_set():
+            self._wanted.clear()
+            self._alive()
+            try:
+                self.refill()
+            except Exception as e:
+                self.logger.error(f'Could not refill the key pool with error: {e}')
+            self._wanted.wait(self.interval)
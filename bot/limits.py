@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from outline.outline_vpn import OutlineVPN
+
+# (keys done, keys to change)
+Progress = Callable[[int, int], None]
+
+
+def data_limit(record: dict) -> Optional[int]:
+    """
+    Data limit of a key in bytes, None when the key has none
+    """
+    limit = record.get('dataLimit')
+    if not isinstance(limit, dict) or limit.get('bytes') is None:
+        return None
+    return int(limit['bytes'])
+
+
+@dataclass
+class LimitReport:
+    """
+    Outcome of applying a data limit to every server
+    """
+
+    limit: int
+    dry_run: bool = False
+    # keys already at the limit
+    unchanged: int = 0
+    # server URL -> ids of keys with another limit
+    pending: Dict[str, List[str]] = field(default_factory=dict)
+    updated: int = 0
+    failed: int = 0
+    # servers whose keys could not be listed
+    skipped: List[str] = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        return sum(len(key_ids) for key_ids in self.pending.values())
+
+    def summary(self) -> str:
+        text = f'{self.total} keys to limit to {self.limit} bytes, {self.unchanged} already limited'
+        if not self.dry_run:
+            text += f'; {self.updated} updated, {self.failed} failed'
+        if self.skipped:
+            text += f'; {len(self.skipped)} servers not reached'
+        return text
+
+
+class LimitApplier:
+    """
+    Brings the data limit of every existing key to the configured one,
+    so changing --limit affects old keys and not only new ones.
+
+    Keys are compared with the limit from one listing per server and only the ones
+    that differ are updated. Servers are updated at the same time, each with at most
+    `concurrency` requests in flight; a failed update is retried `retries` times.
+    """
+
+    def __init__(self, provider, concurrency: int = 8, retries: int = 2, backoff: float = 0.5,
+                 progress: Optional[Progress] = None, progress_interval: float = 5):
+        """
+        :param provider: VPNProvider with the servers to update
+        :param concurrency: data limit requests in flight per server
+        :param retries: attempts after the first for every key
+        :param backoff: seconds before the first retry, doubled for every next one
+        :param progress: called with the keys done and the keys to change after every key, one call at a time
+        :param progress_interval: seconds between progress lines in the log
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, limit: int):
+        """
+        Apply the limit in the background
+        """
+        self._thread = threading.Thread(
+            target=self._run, args=(limit,), name='limit-applier', daemon=True)
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def apply(self, limit: int, dry_run: bool = False) -> LimitReport:
+        """
+        Set the data limit of every key on every server that has another one
+        :param limit: data limit in bytes
+        :param dry_run: only count the keys that would change
+        """
+        report = LimitReport(limit, dry_run)
+        clients = self.provider.clients()
+        futures = {self.provider.background.submit(client.snapshot): client for client in clients}
+        for future in as_completed(futures):
+            client = futures[future]
+            try:
+                records = future.result().records
+            except Exception as e:
+                self.logger.error(f'Could not list the keys of {client.api_url} with error: {e}')
+                report.skipped.append(client.api_url)
+                continue
+            pending = [str(record.get('id')) for record in records if data_limit(record) != limit]
+            report.unchanged += len(records) - len(pending)
+            if pending:
+                report.pending[client.api_url] = pending
+
+        self.logger.info(report.summary())
+        if dry_run or report.total == 0:
+            return report
+
+        done = 0
+        logged_at = time.monotonic()
+
+        def advance(succeeded: bool):
+            nonlocal done, logged_at
+            with self._lock:
+                done += 1
+                if succeeded:
+                    report.updated += 1
+                else:
+                    report.failed += 1
+                if self.progress is not None:
+                    self.progress(done, report.total)
+                current = done
+                log = time.monotonic() - logged_at >= self.progress_interval
+                if log:
+                    logged_at = time.monotonic()
+            if log:
+                self.logger.info(f'Applied the data limit to {current}/{report.total} keys')
+
+        servers = [client for client in clients if client.api_url in report.pending]
+        with ThreadPoolExecutor(max_workers=len(servers), thread_name_prefix='limits') as executor:
+            for future in [executor.submit(self._apply_server, client, report.pending[client.api_url], limit, advance)
+                           for client in servers]:
+                future.result()
+
+        self.logger.info(report.summary())
+        return report
+
+    def _apply_server(self, client: OutlineVPN, key_ids: List[str], limit: int,
+                      advance: Callable[[bool], None]):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='limits') as executor:
+            futures = {executor.submit(self._apply_key, client, key_id, limit): key_id for key_id in key_ids}
+            for future in as_completed(futures):
+                succeeded, error = future.result()
+                if not succeeded:
+                    self.logger.error(
+                        f'Could not limit key {futures[future]} on {client.api_url} with error: {error}')
+                advance(succeeded)
+
+    def _apply_key(self, client: OutlineVPN, key_id: str, limit: int) -> Tuple[bool, Optional[str]]:
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                if client.add_data_limit(key_id, limit):
+                    return True, None
+                error = 'the server refused the limit'
+            except Exception as e:
+                error = str(e)
+        return False, error
+
+    def _run(self, limit: int):
+        try:
+            self.apply(limit)
+        except Exception as e:
+            self.logger.error(f'Could not apply the data limit with error: {e}')
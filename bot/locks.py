@@ -0,0 +1,98 @@
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+
+class KeyedLock:
+    """
+    A set of locks created on demand, one per key.
+
+    Locks are dropped as soon as nobody holds or waits for them,
+    so the set only grows with the number of concurrent keys.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [lock, number of threads holding or waiting for it]
+        self._locks: Dict[Hashable, List] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, key: Hashable):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+class KeyedQueue:
+    """
+    Runs jobs one key at a time without parking threads.
+
+    A job for a busy key is queued and later run by the thread that is working
+    on that key. A job named like the one running or waiting for the key is
+    dropped, since that work is already underway.
+
+    A queued job has no caller left to raise to, so its error goes to the
+    `on_error` it was queued with.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # key -> (name of the running job, jobs waiting behind it with their error callbacks)
+        self._keys: Dict[Hashable, Tuple[str, Deque[Tuple[str, Callable, Optional[Callable]]]]] = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def run(self, key: Hashable, name: str, job: Callable,
+            on_error: Optional[Callable[[Exception], None]] = None) -> Tuple[bool, Any]:
+        """
+        Run a job now if the key is idle, otherwise queue or drop it
+        :param on_error: called with the error of the job if it fails after being queued;
+        a job run in this call raises to the caller instead
+        :return: (whether the job ran in this call, its result)
+        """
+        with self._lock:
+            if key in self._keys:
+                running, waiting = self._keys[key]
+                if name != running and all(name != queued for queued, _, _ in waiting):
+                    waiting.append((name, job, on_error))
+                return False, None
+            self._keys[key] = (name, deque())
+
+        try:
+            return True, job()
+        finally:
+            self._drain(key)
+
+    def _drain(self, key: Hashable):
+        while True:
+            with self._lock:
+                waiting = self._keys[key][1]
+                if len(waiting) == 0:
+                    del self._keys[key]
+                    return
+                name, job, on_error = waiting.popleft()
+                self._keys[key] = (name, waiting)
+
+            try:
+                job()
+            except Exception as e:
+                if on_error is None:
+                    self.logger.error(f'Queued job {name} failed with error: {e}')
+                else:
+                    on_error(e)
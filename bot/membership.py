@@ -0,0 +1,68 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from bot.state import StateStore
+
+
+class MembershipCache:
+    """
+    Remembers whether users belong to the main chat.
+
+    Members are trusted for `ttl` seconds and non-members for `negative_ttl`,
+    so somebody who just joined does not wait long to be let in.
+    chat_member updates overwrite entries as soon as a user joins, leaves or is banned.
+    With a shared store, entries live only in the store, so a leave or ban
+    seen by one process takes effect in all of them.
+    """
+
+    def __init__(self, ttl: float = 600, negative_ttl: float = 60, store: Optional[StateStore] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store if store is not None and store.shared else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # user id -> (is member, expiry on the monotonic clock)
+        self._entries: Dict[int, Tuple[bool, float]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[bool]:
+        """
+        :return: the cached membership, None if unknown or expired
+        """
+        if self.store is not None:
+            stored = self.store.get('members', str(user_id))
+            with self._lock:
+                if stored is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                return stored == '1'
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def set(self, user_id: int, is_member: bool):
+        ttl = self.ttl if is_member else self.negative_ttl
+        if self.store is not None:
+            self.store.set('members', str(user_id), '1' if is_member else '0', ttl=ttl)
+            return
+        with self._lock:
+            self._entries[user_id] = (is_member, time.monotonic() + ttl)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self.store is not None:
+            self.store.delete('members', str(user_id))
@@ -0,0 +1,244 @@
+import bisect
+import heapq
+import itertools
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# a metric computed when scraped: (name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        escaped = ','.join(
+            '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels)
+        name = f'{name}{{{escaped}}}'
+    return f'{name} {value}'
+
+
+class Histogram:
+    """
+    Counts of observations per latency bucket, with their sum
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms kept in memory
+    and rendered in the Prometheus text format.
+
+    Values that already live elsewhere, like cache counters,
+    are read by collectors when the metrics are rendered.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._types: Dict[str, str] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def describe(self, name: str, kind: str, text: str):
+        """
+        Set the type and help text of a metric
+        """
+        self._types[name] = kind
+        self._help[name] = text
+
+    def observe(self, name: str, seconds: float, **labels):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = _labels(labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def add(self, name: str, amount: float, **labels):
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def collector(self, collect: Callable[[], Iterable[Sample]]):
+        """
+        Register a function producing samples whenever the metrics are rendered
+        """
+        self._collectors.append(collect)
+
+    @contextmanager
+    def time(self, name: str, in_flight: Optional[str] = None, **labels):
+        """
+        Observe how long the block takes, counting it as in flight meanwhile
+        """
+        if in_flight is not None:
+            self.add(in_flight, 1, **labels)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+            if in_flight is not None:
+                self.add(in_flight, -1, **labels)
+
+    def count(self, name: str, **labels) -> int:
+        """
+        Observations of a histogram, or the value of a counter or gauge
+        """
+        key = _labels(labels)
+        with self._lock:
+            if name in self._histograms and key in self._histograms[name]:
+                return self._histograms[name][key].count
+            for values in (self._counters, self._gauges):
+                if name in values and key in values[name]:
+                    return values[name][key]
+        return 0
+
+    def render(self) -> str:
+        collected: Dict[str, Dict[Labels, float]] = {}
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                collected.setdefault(name, {})[_labels(labels)] = value
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(_format(f'{name}_bucket', labels + (('le', le),), cumulative))
+                    lines.append(_format(f'{name}_sum', labels, histogram.sum))
+                    lines.append(_format(f'{name}_count', labels, histogram.count))
+
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges), ('gauge', collected)):
+                for name, series in sorted(values.items()):
+                    self._header(lines, name, self._types.get(name, kind))
+                    for labels, value in sorted(series.items()):
+                        lines.append(_format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines: List[str], name: str, kind: str):
+        if name in self._help:
+            lines.append(f'# HELP {name} {self._help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+
+class SlowestTraces:
+    """
+    Sampling profiler for handlers.
+
+    While a traced block runs, the stack of its thread is sampled every
+    `interval` seconds. The `keep` slowest blocks are kept with the stacks
+    seen most often, to find out where slow updates spend their time.
+    """
+
+    def __init__(self, keep: int = 10, interval: float = 0.01, depth: int = 40):
+        self.keep = keep
+        self.interval = interval
+        self.depth = depth
+        self._lock = threading.Lock()
+        # thread id -> stacks sampled while its block runs
+        self._active: Dict[int, Counter] = {}
+        # min-heap of (seconds, sequence, name, stacks)
+        self._slowest: List[Tuple[float, int, str, Counter]] = []
+        self._sequence = itertools.count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    @contextmanager
+    def trace(self, name: str):
+        thread_id = threading.get_ident()
+        samples: Counter = Counter()
+        with self._lock:
+            self._active[thread_id] = samples
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            with self._lock:
+                self._active.pop(thread_id, None)
+                entry = (seconds, next(self._sequence), name, samples)
+                if len(self._slowest) < self.keep:
+                    heapq.heappush(self._slowest, entry)
+                elif seconds > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def dump(self, stacks: int = 5) -> str:
+        """
+        The slowest traces, slowest first, each with its most frequent stacks
+        """
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+
+        lines = []
+        for seconds, _, name, samples in slowest:
+            lines.append(f'{seconds:.3f}s {name} ({sum(samples.values())} samples)')
+            for stack, count in samples.most_common(stacks):
+                lines.append(f'  {count:>5} {stack}')
+        return '\n'.join(lines) + '\n'
+
+    def _sample(self):
+        frames = sys._current_frames()  # pylint: disable=W0212
+        with self._lock:
+            for thread_id, samples in self._active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                if stack:
+                    samples[';'.join(reversed(stack))] += 1
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
@@ -0,0 +1,195 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+
+class RateLimiter:
+    """
+    Spaces out messages to stay within the Telegram flood limits:
+    `rate` messages a second for the whole bot with bursts of up to `burst`,
+    one message every `chat_interval` seconds to a private chat
+    and every `group_interval` seconds to a group.
+
+    Every message reserves the earliest slot allowed by both limits, so callers
+    are served in the order they ask. A message waiting for its chat takes its share
+    of the global rate when it is booked, so it never holds up messages to other chats.
+    """
+
+    def __init__(self, rate: float = 30, burst: int = 30, chat_interval: float = 1.0,
+                 group_interval: float = 3.0):
+        """
+        :param rate: messages a second for all chats together, 0 for no limit
+        :param burst: messages allowed at once before `rate` applies
+        :param chat_interval: seconds between messages to one private chat
+        :param group_interval: seconds between messages to one group
+        """
+        self.emission = 1 / rate if rate > 0 else 0.0
+        self.tolerance = (max(1, burst) - 1) * self.emission
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._lock = threading.Lock()
+        # theoretical arrival time of the next message, on the monotonic clock
+        self._tat = 0.0
+        # chat id -> earliest time of the next message to it
+        self._chats: Dict[int, float] = {}
+
+    def reserve(self, chat_id: int) -> float:
+        """
+        Book the next slot for a message to a chat
+        :return: seconds to wait before sending it
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._tat - self.tolerance)
+            self._tat = max(self._tat, slot) + self.emission
+            at = max(slot, self._chats.get(chat_id, 0.0))
+            # group ids are negative
+            self._chats[chat_id] = at + (self.group_interval if int(chat_id) < 0 else self.chat_interval)
+            if len(self._chats) > 10000:
+                self._chats = {chat: slot for chat, slot in self._chats.items() if slot > now}
+            return at - now
+
+
+@dataclass
+class _Alert:
+    text: str
+    # alerts suppressed since the window started
+    repeated: int
+    window_started: float
+
+
+class Outbox:
+    """
+    Every message the bot sends goes through here.
+
+    Replies from handlers are sent by the handler's thread once the rate limiter
+    allows it. Messages nobody waits for, like notifications and alerts, are posted
+    to a queue and sent by a background thread.
+
+    Alerts to the dev chat are deduplicated: the first alert of a kind is sent at once,
+    repeats within `digest_interval` seconds are counted and sent as one digest.
+    """
+
+    def __init__(self, dev_chat_id: int, limiter: Optional[RateLimiter] = None,
+                 digest_interval: float = 300, queue_size: int = 10000):
+        """
+        :param dev_chat_id: chat the alerts go to
+        :param limiter: rate limits shared by every message, Telegram's defaults when omitted
+        :param digest_interval: seconds repeated alerts are collected for
+        :param queue_size: posted messages waiting to be sent; more are dropped
+        """
+        self.logger = logging.getLogger(__name__)
+        self.dev_chat_id = dev_chat_id
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.digest_interval = digest_interval
+        self.bot: Optional[Bot] = None
+        self.sent = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self._queue: 'queue.Queue[Tuple[int, str, dict]]' = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # kind -> alert of that kind sent last
+        self._alerts: Dict[str, _Alert] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name='outbox', daemon=True)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def start(self, bot: Bot):
+        """
+        Start sending posted messages with a bot
+        """
+        self.bot = bot
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def send(self, bot: Bot, chat_id: int, text: str, **kwargs):
+        """
+        Send a message now, waiting for the rate limits first
+        :return: the sent message
+        """
+        delay = self.limiter.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            message = bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            self.logger.warning(f'Telegram asked to wait {e.retry_after}s before messaging {chat_id}')
+            time.sleep(e.retry_after)
+            message = bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        with self._lock:
+            self.sent += 1
+        return message
+
+    def post(self, chat_id: int, text: str, **kwargs) -> bool:
+        """
+        Queue a message to be sent in the background
+        :return: False if the queue is full and the message was dropped
+        """
+        try:
+            self._queue.put_nowait((chat_id, text, kwargs))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            self.logger.error(f'Outbox is full, dropped a message to {chat_id}')
+            return False
+
+    def alert(self, kind: str, text: str):
+        """
+        Tell the dev chat about a problem, once per `digest_interval` for every kind
+        """
+        with self._lock:
+            alert = self._alerts.get(kind)
+            if alert is not None:
+                alert.repeated += 1
+                self.suppressed += 1
+                return
+            self._alerts[kind] = _Alert(text, 0, time.monotonic())
+        self.post(self.dev_chat_id, text)
+
+    def flush_alerts(self, force: bool = False):
+        """
+        Post a digest of every kind of alert whose window is over and that was repeated;
+        the others are forgotten, so their next alert is sent at once
+        :param force: end every window now
+        """
+        now = time.monotonic()
+        digests = []
+        with self._lock:
+            for kind, alert in list(self._alerts.items()):
+                if not force and now - alert.window_started < self.digest_interval:
+                    continue
+                if alert.repeated == 0:
+                    del self._alerts[kind]
+                    continue
+                minutes = max(1, round((now - alert.window_started) / 60))
+                digests.append(f'{alert.text} (repeated {alert.repeated} times in the last {minutes} min)')
+                alert.repeated = 0
+                alert.window_started = now
+        for digest in digests:
+            self.post(self.dev_chat_id, digest)
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            self.flush_alerts()
+            try:
+                chat_id, text, kwargs = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.send(self.bot, chat_id, text, **kwargs)
+            except Exception as e:
+                self.logger.error(f'Could not send a message to {chat_id} with error: {e}')
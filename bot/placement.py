@@ -0,0 +1,106 @@
+import random
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Type, Union
+
+
+@dataclass(frozen=True)
+class ServerLoad:
+    """
+    What is known about a server when placing a new user, all from cached responses
+    """
+
+    server: str
+    users: int
+    # bytes transferred by all keys of the server, as reported by /metrics/transfer
+    traffic: int
+    capacity: int
+    weight: float = 1.0
+
+    @property
+    def headroom(self) -> int:
+        return self.capacity - self.users
+
+
+class PlacementStrategy:
+    """
+    Picks the server for a new user among servers with headroom left
+    """
+
+    name = ''
+
+    def choose(self, loads: Sequence[ServerLoad]) -> ServerLoad:
+        """
+        :param loads: servers that have room, in the order of the servers file
+        :return: the server to place the user on
+        """
+        raise NotImplementedError
+
+
+class LeastKeys(PlacementStrategy):
+    """
+    The server with the smallest filled share of its capacity, scaled by weight
+    """
+
+    name = 'least-keys'
+
+    def choose(self, loads: Sequence[ServerLoad]) -> ServerLoad:
+        return min(loads, key=lambda load: load.users / load.capacity / load.weight)
+
+
+class LeastTraffic(PlacementStrategy):
+    """
+    The server with the least traffic per unit of weight, the least filled one on a tie
+    """
+
+    name = 'least-traffic'
+
+    def choose(self, loads: Sequence[ServerLoad]) -> ServerLoad:
+        return min(loads, key=lambda load: (load.traffic / load.weight,
+                                            load.users / load.capacity / load.weight))
+
+
+class WeightedRandom(PlacementStrategy):
+    """
+    A random server, each as likely as its weight times its headroom
+    """
+
+    name = 'weighted-random'
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng if rng is not None else random.Random()
+
+    def choose(self, loads: Sequence[ServerLoad]) -> ServerLoad:
+        return self.rng.choices(loads, weights=[load.weight * load.headroom for load in loads])[0]
+
+
+STRATEGIES: Dict[str, Type[PlacementStrategy]] = {
+    strategy.name: strategy for strategy in (LeastKeys, LeastTraffic, WeightedRandom)
+}
+
+
+class PlacementEngine:
+    """
+    Decides where new users go from the loads gathered while scanning the servers,
+    without asking the servers anything else
+    """
+
+    def __init__(self, strategy: Union[str, PlacementStrategy] = LeastKeys.name):
+        """
+        :param strategy: a PlacementStrategy or the name of one in STRATEGIES
+        """
+        if isinstance(strategy, str):
+            if strategy not in STRATEGIES:
+                raise ValueError(f'Unknown placement strategy {strategy}')
+            strategy = STRATEGIES[strategy]()
+        self.strategy = strategy
+
+    def choose(self, loads: List[ServerLoad]) -> Optional[ServerLoad]:
+        """
+        :param loads: every server that answered, in the order of the servers file
+        :return: the server for a new user, None if every server is full
+        """
+        candidates = [load for load in loads
+                      if load.headroom > 0 and load.weight > 0]
+        if len(candidates) == 0:
+            return None
+        return self.strategy.choose(candidates)
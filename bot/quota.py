@@ -0,0 +1,103 @@
+import logging
+import sqlite3
+import threading
+from typing import Dict, Sequence, Tuple
+
+from bot.outbox import Outbox
+from bot.state import LockTimeout
+from bot.sweeper import owner_id
+
+
+class QuotaNotifier:
+    """
+    Tells users when their traffic crosses a share of the limit, once for every threshold,
+    from the numbers the usage collector already has.
+
+    The highest threshold announced to every key is kept in SQLite, so a restart does not
+    repeat it. A new key or traffic falling below a threshold, after the limit was raised,
+    lets the threshold be announced again. Processes sharing a store check one at a time.
+    """
+
+    def __init__(self, provider, usage, outbox: Outbox, limit_gb: int,
+                 thresholds: Sequence[int] = (80, 100)):
+        """
+        :param provider: VPNProvider whose index lists the users
+        :param usage: UsageStats with the traffic of every key
+        :param outbox: where the notifications are posted
+        :param limit_gb: the limit in GB, for the messages
+        :param thresholds: shares of the limit in percent that are announced
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.usage = usage
+        self.outbox = outbox
+        self.limit_gb = limit_gb
+        self.thresholds = sorted(thresholds)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(provider.index.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS quota_notices ('
+            'name TEXT PRIMARY KEY, key_id TEXT NOT NULL, threshold INTEGER NOT NULL)')
+        self._conn.commit()
+
+    def check(self) -> int:
+        """
+        Notify every user whose traffic crossed a threshold since the last check
+        :return: number of notifications posted, 0 when another process is checking
+        """
+        if self.provider.bytes_limit <= 0 or not self.thresholds:
+            return 0
+        try:
+            with self.provider.store.lock('quota', timeout=0):
+                return self._check()
+        except LockTimeout:
+            return 0
+
+    def _check(self) -> int:
+        limit = self.provider.bytes_limit
+        with self._lock:
+            # user name -> (key id, highest threshold announced)
+            notified: Dict[str, Tuple[str, int]] = {
+                row[0]: (row[1], row[2])
+                for row in self._conn.execute('SELECT name, key_id, threshold FROM quota_notices')
+            }
+
+        posted = 0
+        changed = []
+        for entry in self.provider.index.entries():
+            user_id = owner_id(entry.name)
+            used = self.usage.usage(entry.server, entry.key_id)
+            if user_id is None or used is None:
+                continue
+
+            percent = used / limit * 100
+            reached = max((threshold for threshold in self.thresholds if percent >= threshold), default=0)
+            key_id, announced = notified.get(entry.name, (entry.key_id, 0))
+            if key_id != entry.key_id:
+                announced = 0
+            if reached == announced and key_id == entry.key_id:
+                continue
+
+            if reached > announced:
+                if not self.outbox.post(user_id, self._message(reached)):
+                    # the outbox is full: try again on the next check
+                    continue
+                posted += 1
+            changed.append((entry.name, entry.key_id, reached))
+
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO quota_notices (name, key_id, threshold) VALUES (?, ?, ?)', changed)
+            self._conn.commit()
+        if posted:
+            self.logger.info(f'Posted {posted} quota notifications')
+        return posted
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _message(self, threshold: int) -> str:
+        if threshold >= 100:
+            return f'Вы израсходовали весь трафик ({self.limit_gb} GB). Подробнее: /stats'
+        return f'Вы использовали {threshold}% трафика от {self.limit_gb} GB. Подробнее: /stats'
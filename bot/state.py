@@ -0,0 +1,196 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import ContextManager, Dict, Iterator, Optional, Tuple
+
+from bot.locks import KeyedLock
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class StateStore:
+    """
+    State the bot processes share: short-lived values, counters and locks.
+
+    `MemoryStore` serves a single process; `SQLiteStore` lets several
+    processes on one host work on the same users.
+    """
+
+    # whether other processes see what this one writes
+    shared = False
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None):
+        """
+        :param ttl: seconds the value lives, forever when None
+        """
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def incr(self, namespace: str, key: str, amount: int = 1) -> int:
+        """
+        Add to a counter, missing counters start at 0
+        :return: the new value
+        """
+        raise NotImplementedError
+
+    def lock(self, name: str, timeout: float = 30, lease: float = 60) -> ContextManager[None]:
+        """
+        Hold a lock shared by every process using the store
+        :param timeout: seconds to wait for it before raising LockTimeout
+        :param lease: seconds after which the lock of a process that died is taken over
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStore(StateStore):
+    """
+    Keeps the state in this process, for a bot running alone
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (namespace, key) -> (value, expiry on the monotonic clock or None)
+        self._values: Dict[Tuple[str, str], Tuple[str, Optional[float]]] = {}
+        self._locks = KeyedLock()
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._values.get((namespace, key))
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._values[(namespace, key)]
+                return None
+            return entry[0]
+
+    def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None):
+        with self._lock:
+            self._values[(namespace, key)] = (value, None if ttl is None else time.monotonic() + ttl)
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._values.pop((namespace, key), None)
+
+    def incr(self, namespace: str, key: str, amount: int = 1) -> int:
+        with self._lock:
+            value = int(self._values.get((namespace, key), ('0', None))[0]) + amount
+            self._values[(namespace, key)] = (str(value), None)
+            return value
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 30, lease: float = 60) -> Iterator[None]:
+        with self._locks.hold(name):
+            yield
+
+
+class SQLiteStore(StateStore):
+    """
+    Keeps the state in a SQLite database in WAL mode, so several bot processes
+    on the same host read it at once while one of them writes.
+
+    Locks are rows with an owner and a lease; they are taken over once the lease
+    runs out, so a process that died while holding one does not block the others.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        """
+        :param path: database file, may be the user index
+        :param poll_interval: seconds between attempts to take a busy lock
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex}'
+        self._writes = 0
+        self._lock = threading.Lock()
+        # locks of this process are taken one at a time, the others wait here
+        self._local = KeyedLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL, '
+            'PRIMARY KEY (namespace, key))')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS locks ('
+            'name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM state WHERE namespace = ? AND key = ? '
+                'AND (expires_at IS NULL OR expires_at > ?)', (namespace, key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, value, None if ttl is None else time.time() + ttl))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute('DELETE FROM state WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def incr(self, namespace: str, key: str, amount: int = 1) -> int:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT value FROM state WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+                value = (int(row[0]) if row is not None else 0) + amount
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, NULL)',
+                    (namespace, key, str(value)))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return value
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 30, lease: float = 60) -> Iterator[None]:
+        deadline = time.monotonic() + timeout
+        with self._local.hold(name):
+            while not self._acquire(name, lease):
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f'Could not lock {name} within {timeout}s')
+                time.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._conn.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, self.owner))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _acquire(self, name: str, lease: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE locks.expires_at <= ?', (name, self.owner, now + lease, now))
+            return cursor.rowcount == 1
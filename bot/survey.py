@@ -0,0 +1,85 @@
+import threading
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from bot.key_pool import is_pooled
+from outline.outline_vpn import OutlineKey
+
+
+class KeySurvey:
+    """
+    One streamed pass over the keys of a server, shared by every lookup that joins it
+    while it runs, so a burst of new users reads a large key list once.
+
+    Only what a lookup needs is kept: the users counted, their traffic and the id
+    and access URL of every user's key. Each lookup returns as soon as its key was read;
+    the pass stops once every lookup that joined has its answer.
+    """
+
+    def __init__(self):
+        self.users = 0
+        self.used = 0
+        # the whole list was read
+        self.complete = False
+        self.error: Optional[Exception] = None
+        self._finished = False
+        # user name -> (key id, access URL)
+        self._keys: Dict[str, Tuple[str, str]] = {}
+        # user names lookups wait for and that were not read yet
+        self._wanted: Set[str] = set()
+        self._changed = threading.Condition()
+
+    def join(self, name: str) -> bool:
+        """
+        Wait for a user's key in this pass
+        :return: False if the pass is over and a new one is needed
+        """
+        with self._changed:
+            if self._finished:
+                return False
+            if name not in self._keys:
+                self._wanted.add(name)
+            return True
+
+    def read(self, keys: Iterator[OutlineKey]):
+        """
+        Go through the keys until they run out or nobody waits anymore
+        """
+        try:
+            for key in keys:
+                with self._changed:
+                    if not is_pooled(key.name):
+                        self.users += 1
+                        if key.name:
+                            self._keys[key.name] = (str(key.key_id), key.access_url)
+                    self.used += key.used_bytes or 0
+                    if key.name in self._wanted:
+                        self._wanted.discard(key.name)
+                        self._changed.notify_all()
+                        if not self._wanted:
+                            break
+            else:
+                self.complete = True
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(keys, 'close', None)
+            if close is not None:
+                close()
+            with self._changed:
+                self._finished = True
+                self._changed.notify_all()
+
+    def result(self, name: str) -> Tuple[Optional[OutlineKey], int, int]:
+        """
+        Wait until a joined user's key is read or the pass is over
+        :return: (the user's key or None, users on the server, bytes transferred on it);
+        the counts are only final when the key was not found
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: name in self._keys or self._finished)
+            if name in self._keys:
+                key_id, access_url = self._keys[name]
+                return OutlineKey(key_id, name, None, None, None, access_url, None), self.users, self.used
+            if self.error is not None:
+                raise self.error
+            return None, self.users, self.used
@@ -0,0 +1,287 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from bot.key_pool import is_pooled
+from bot.state import LockTimeout
+from bot.usage_stats import DAY
+from outline.outline_vpn import OutlineVPN
+
+# user keys are named first_last_id
+USER_ID = re.compile(r'_(\d+)$')
+
+IDLE = 'idle'
+LEFT = 'left'
+
+
+def owner_id(name: Optional[str]) -> Optional[int]:
+    """
+    Telegram id of the user a key was issued to, None for keys not named after a user
+    """
+    match = USER_ID.search(name or '')
+    return int(match.group(1)) if match is not None else None
+
+
+@dataclass(frozen=True)
+class Candidate:
+    """
+    A key the sweeper deletes, with the reason
+    """
+
+    server: str
+    key_id: str
+    name: str
+    reason: str
+
+
+@dataclass
+class SweepReport:
+    """
+    What one sweep found and deleted
+    """
+
+    dry_run: bool
+    candidates: List[Candidate] = field(default_factory=list)
+    deleted: List[Candidate] = field(default_factory=list)
+    failed: List[Candidate] = field(default_factory=list)
+    # servers that were not swept because they did not answer or their circuit is open
+    skipped: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        idle = sum(1 for candidate in self.candidates if candidate.reason == IDLE)
+        title = 'Key sweep (dry run)' if self.dry_run else 'Key sweep'
+        lines = [f'{title}: {len(self.candidates)} keys to delete, '
+                 f'{idle} idle, {len(self.candidates) - idle} of users who left the chat']
+        servers: Dict[str, List[Candidate]] = {}
+        for candidate in self.candidates:
+            servers.setdefault(candidate.server, []).append(candidate)
+        for server, candidates in servers.items():
+            idle = sum(1 for candidate in candidates if candidate.reason == IDLE)
+            lines.append(f'{_label(server)}: {idle} idle, {len(candidates) - idle} left')
+        if not self.dry_run:
+            lines.append(f'Deleted {len(self.deleted)}, failed {len(self.failed)}')
+        if self.skipped:
+            lines.append('Not swept: ' + ', '.join(_label(server) for server in self.skipped))
+        return '\n'.join(lines)
+
+
+def _label(server: str) -> str:
+    # the path of an API URL is its secret, it never leaves the bot
+    return urllib.parse.urlsplit(server).netloc
+
+
+class ActivityLog:
+    """
+    Last time the traffic of every key changed.
+
+    Outline reports the bytes a key transferred over the last 30 days, so a key is idle
+    since its count last grew; a count going down only means old traffic left the window.
+    The times live in SQLite to be counted across restarts.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS activity ('
+            'server TEXT NOT NULL, key_id TEXT NOT NULL, used INTEGER NOT NULL, '
+            'changed_at REAL NOT NULL, PRIMARY KEY (server, key_id))')
+        self._conn.commit()
+
+    def update(self, server: str, key_ids: Iterable[str], used: Dict[str, int],
+               now: float) -> Dict[str, float]:
+        """
+        Record the traffic of the keys present on a server and forget the other keys
+        :param used: key id -> bytes transferred, keys that never transferred anything are missing
+        :param now: wall clock time of the observation
+        :return: key id -> wall clock time its traffic last grew, `now` for keys seen the first time
+        """
+        with self._lock:
+            known: Dict[str, Tuple[int, float]] = {
+                row[0]: (row[1], row[2]) for row in self._conn.execute(
+                    'SELECT key_id, used, changed_at FROM activity WHERE server = ?', (server,))
+            }
+            changed_at: Dict[str, float] = {}
+            rows = []
+            for key_id in key_ids:
+                current = int(used.get(key_id, 0))
+                before = known.get(key_id)
+                if before is None or current > before[0]:
+                    rows.append((server, key_id, current, now))
+                    changed_at[key_id] = now
+                else:
+                    if current < before[0]:
+                        # remember the lower count, so the next traffic shows as growth
+                        rows.append((server, key_id, current, before[1]))
+                    changed_at[key_id] = before[1]
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO activity (server, key_id, used, changed_at) VALUES (?, ?, ?, ?)', rows)
+            self._conn.executemany(
+                'DELETE FROM activity WHERE server = ? AND key_id = ?',
+                [(server, key_id) for key_id in known if key_id not in changed_at])
+            self._conn.commit()
+        return changed_at
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class KeySweeper:
+    """
+    Deletes the keys nobody needs anymore, so they stop counting against `max_users`:
+    keys without traffic for `idle_days` and keys of users who left the main chat.
+    Pooled keys and keys not named after a user are never touched.
+
+    Every server's keys are deleted in batches of `batch_size`, `pause` seconds apart.
+    A dry run deletes nothing and only reports what would be deleted.
+    """
+
+    def __init__(self, provider, is_member: Callable[[int], bool],
+                 notify: Optional[Callable[[str], None]] = None, idle_days: float = 30,
+                 interval: float = 6 * 60 * 60, batch_size: int = 20, pause: float = 1.0,
+                 dry_run: bool = False):
+        """
+        :param provider: VPNProvider with the servers to sweep
+        :param is_member: whether a Telegram user is still in the main chat
+        :param notify: called with the summary of every sweep that found something
+        :param idle_days: days without traffic after which a key is deleted, 0 to keep idle keys
+        :param interval: seconds between sweeps
+        :param batch_size: keys deleted on a server before pausing
+        :param pause: seconds between batches
+        :param dry_run: only report the keys that would be deleted
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.is_member = is_member
+        self.notify = notify
+        self.idle_days = idle_days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self.dry_run = dry_run
+        self.activity = ActivityLog(provider.index.path)
+        self.provider.metrics.describe('vpn_swept_keys_total', 'counter', 'Keys deleted by the sweeper')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name='key-sweeper', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.activity.close()
+
+    def sweep(self, dry_run: Optional[bool] = None) -> SweepReport:
+        """
+        Find the keys to delete on every server and delete them, unless it is a dry run
+        :param dry_run: overrides the sweeper's `dry_run`
+        """
+        report = SweepReport(self.dry_run if dry_run is None else dry_run)
+        now = time.time()
+        clients = []
+        for client in self.provider.clients():
+            if self.provider.health.is_closed(client.api_url):
+                clients.append(client)
+            else:
+                report.skipped.append(client.api_url)
+
+        found: Dict[str, List[Candidate]] = {}
+        futures = {self.provider.background.submit(self._candidates, client, now): client
+                   for client in clients}
+        for future in as_completed(futures):
+            client = futures[future]
+            try:
+                found[client.api_url] = future.result()
+            except Exception as e:
+                self.logger.error(f'Could not sweep {client.api_url} with error: {e}')
+                report.skipped.append(client.api_url)
+
+        for client in clients:
+            report.candidates.extend(found.get(client.api_url, ()))
+        if report.dry_run:
+            return report
+
+        futures = {self.provider.background.submit(self._delete, client, found[client.api_url]): client
+                   for client in clients if found.get(client.api_url)}
+        for future in as_completed(futures):
+            deleted, failed = future.result()
+            report.deleted.extend(deleted)
+            report.failed.extend(failed)
+        return report
+
+    def _candidates(self, client: OutlineVPN, now: float) -> List[Candidate]:
+        server = client.api_url
+        snapshot = self.provider.health.call(server, client.snapshot)
+        records = [record for record in snapshot.records if not is_pooled(record.get('name'))]
+        changed_at = self.activity.update(
+            server, [str(record.get('id')) for record in records], snapshot.used_by_id, now)
+
+        candidates = []
+        for record in records:
+            key_id, name = str(record.get('id')), record.get('name')
+            user_id = owner_id(name)
+            if user_id is None:
+                continue
+            if self.idle_days > 0 and now - changed_at[key_id] >= self.idle_days * DAY:
+                candidates.append(Candidate(server, key_id, name, IDLE))
+            elif self._left(user_id):
+                candidates.append(Candidate(server, key_id, name, LEFT))
+        return candidates
+
+    def _left(self, user_id: int) -> bool:
+        try:
+            return not self.is_member(user_id)
+        except Exception as e:
+            # a key is only deleted when Telegram says its owner is gone
+            self.logger.debug(f'Could not check the membership of {user_id} with error: {e}')
+            return False
+
+    def _delete(self, client: OutlineVPN,
+                candidates: List[Candidate]) -> Tuple[List[Candidate], List[Candidate]]:
+        deleted, failed = [], []
+        for start in range(0, len(candidates), self.batch_size):
+            if start > 0 and self._stopped.wait(self.pause):
+                break
+            for candidate in candidates[start:start + self.batch_size]:
+                try:
+                    if not client.delete_key(candidate.key_id):
+                        raise Exception('the server refused to delete the key')
+                except Exception as e:
+                    self.logger.error(
+                        f'Could not delete key {candidate.key_id} of {candidate.name} '
+                        f'on {candidate.server} with error: {e}')
+                    failed.append(candidate)
+                    continue
+                self.provider.index.remove(candidate.name)
+                self.provider.metrics.inc(
+                    'vpn_swept_keys_total', reason=candidate.reason, server=_label(candidate.server))
+                deleted.append(candidate)
+        if deleted:
+            self.logger.info(f'Deleted {len(deleted)} keys on {client.api_url}')
+        return deleted, failed
+
+    def _loop(self):
+        while True:
+            try:
+                # processes sharing a store take turns
+                with self.provider.store.lock('sweep', timeout=0, lease=self.interval):
+                    report = self.sweep()
+                self.logger.info(report.summary())
+                if self.notify is not None and (report.candidates or report.dry_run):
+                    self.notify(report.summary())
+            except LockTimeout:
+                self.logger.debug('Another process is sweeping the keys')
+            except Exception as e:
+                self.logger.error(f'Could not sweep the keys with error: {e}')
+            if self._stopped.wait(self.interval):
+                return
@@ -0,0 +1,58 @@
+"""
+Unit tests for the health checker and circuit breaker
+"""
+
+import time
+
+import pytest
+
+from bot.health import CLOSED, HALF_OPEN, OPEN, HealthChecker
+from bot.test_vpn_bot import FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.vpn_bot import VPNProvider
+
+
+def test_circuit_opens_and_recovers():
+    """Failures in a row open the circuit; after the reset timeout one trial decides"""
+    health = HealthChecker(None, failure_threshold=2, reset_timeout=0.05)
+    health.record_failure("https://one", ConnectionError("down"))
+    assert health.allow("https://one")
+    health.record_failure("https://one", ConnectionError("down"))
+    assert not health.allow("https://one")
+
+    time.sleep(0.06)
+    assert health.allow("https://one")
+    assert health.status()["https://one"].state == HALF_OPEN
+    assert not health.allow("https://one")
+    health.record_failure("https://one", ConnectionError("still down"))
+    assert health.status()["https://one"].state == OPEN
+
+    time.sleep(0.06)
+    assert health.allow("https://one")
+    health.record_success("https://one", 0.2)
+    status = health.status()["https://one"]
+    assert status.state == CLOSED
+    assert status.latency == 0.2
+    assert status.error_rate == 0.75
+
+
+def test_call_records_results():
+    """Calls made through the checker count as results of the server"""
+    health = HealthChecker(None, failure_threshold=1)
+    assert health.call("https://one", lambda: 42) == 42
+    with pytest.raises(ConnectionError):
+        health.call("https://one", FakeOutlineVPN("https://down").get_server_info)
+    assert not health.is_closed("https://one")
+
+
+def test_scan_skips_open_servers(provider: VPNProvider):  # pylint: disable=W0621
+    """Probes open the circuit of a dead server and lookups stop asking it"""
+    provider.health.failure_threshold = 1
+    provider.health.probe()
+    assert provider.health.status()["https://down"].state == OPEN
+    assert provider.health.is_closed("https://one")
+
+    FakeOutlineVPN.servers["https://two"] = None
+    provider.get_client("new")
+    provider.get_client("new")
+    assert not provider.health.is_closed("https://two")
+    assert provider.get_client("new").api_url == "https://one"
@@ -0,0 +1,55 @@
+"""
+Unit tests for the pool of pre-provisioned keys
+"""
+
+from bot.key_pool import POOL_PREFIX
+from bot.test_vpn_bot import DELETED, FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.vpn_bot import VPNProvider
+
+
+def test_cleanup_deletes_orphans(provider: VPNProvider):  # pylint: disable=W0621
+    """Pool keys left by an earlier run are deleted, user keys and keys of live pools are kept"""
+    FakeOutlineVPN.servers["https://one"] += [f"{POOL_PREFIX}3", f"{POOL_PREFIX}gone:4", f"{POOL_PREFIX}peer:5"]
+    provider.store.set("pools", "peer", "1")
+    provider.pool.cleanup()
+    assert FakeOutlineVPN.servers["https://one"] == ["a", "b", "c", DELETED, DELETED, f"{POOL_PREFIX}peer:5"]
+
+
+def test_refill_respects_max_users(provider: VPNProvider):  # pylint: disable=W0621
+    """Every server gets limited pool keys, but never more keys than max_users"""
+    provider.pool.size = 2
+    provider.max_users = 4
+    provider.pool.refill()
+
+    assert provider.pool.available("https://one") == 1
+    assert provider.pool.available("https://two") == 2
+    assert provider.pool.available("https://down") == 0
+    pooled = f"{POOL_PREFIX}{provider.pool.instance}:"
+    assert FakeOutlineVPN.servers["https://two"] == ["d", f"{pooled}1", f"{pooled}2"]
+    assert FakeOutlineVPN.limits[("https://two", "1")] == provider.bytes_limit
+
+
+def test_generate_url_takes_pooled_key(provider: VPNProvider):  # pylint: disable=W0621
+    """A new user is given a pooled key by renaming it, and pool keys are not users"""
+    provider.pool.size = 2
+    provider.pool.refill()
+    created = len(FakeOutlineVPN.servers["https://two"])
+
+    provider.generate_url("new")
+    assert FakeOutlineVPN.servers["https://two"] == ["d", "new", f"{POOL_PREFIX}{provider.pool.instance}:2"]
+    assert len(FakeOutlineVPN.servers["https://two"]) == created
+    assert provider.index.get("new").key_id == "1"
+    assert provider.pool.available("https://two") == 1
+
+
+def test_unrenamed_pooled_key_is_deleted(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """A pooled key that cannot be renamed is deleted and the user gets a new key"""
+    provider.pool.size = 1
+    provider.pool.refill()
+    rename_key = FakeOutlineVPN.rename_key
+    monkeypatch.setattr(FakeOutlineVPN, "rename_key",
+                        lambda self, key_id, name: key_id != "1" and rename_key(self, key_id, name))
+
+    provider.generate_url("new")
+    assert FakeOutlineVPN.servers["https://two"] == ["d", DELETED, "new"]
+    assert provider.index.get("new").key_id == "2"
@@ -0,0 +1,50 @@
+"""
+Unit tests for applying the data limit to existing keys
+"""
+
+from bot.limits import LimitApplier, data_limit
+from bot.test_vpn_bot import FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.vpn_bot import VPNProvider
+
+
+def test_data_limit():
+    """Keys without a limit have none"""
+    assert data_limit({"dataLimit": {"bytes": 5}}) == 5
+    assert data_limit({"id": "1"}) is None
+
+
+def test_only_changed_keys_are_updated(provider: VPNProvider):  # pylint: disable=W0621
+    """Keys already at the limit are left alone, down servers are reported"""
+    FakeOutlineVPN.limits[("https://one", "0")] = 100
+    FakeOutlineVPN.limits[("https://one", "1")] = 50
+    progress = []
+
+    report = LimitApplier(provider, concurrency=2, progress=lambda *args: progress.append(args)).apply(100)
+
+    assert report.pending == {"https://one": ["1", "2"], "https://two": ["0"]}
+    assert (report.unchanged, report.updated, report.failed) == (1, 3, 0)
+    assert report.skipped == ["https://down"]
+    assert FakeOutlineVPN.limits[("https://one", "1")] == 100
+    assert FakeOutlineVPN.limits[("https://two", "0")] == 100
+    assert sorted(progress) == [(1, 3), (2, 3), (3, 3)]
+
+
+def test_dry_run_and_retries(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """A dry run changes nothing; a refused update is retried"""
+    applier = LimitApplier(provider, retries=1, backoff=0)
+    assert applier.apply(100, dry_run=True).total == 4
+    assert FakeOutlineVPN.limits == {}
+
+    refused = set()
+
+    def flaky(self, key_id, limit_bytes):
+        if (self.api_url, key_id) not in refused:
+            refused.add((self.api_url, key_id))
+            return False
+        self.limits[(self.api_url, str(key_id))] = limit_bytes
+        return True
+
+    monkeypatch.setattr(FakeOutlineVPN, "add_data_limit", flaky)
+    report = applier.apply(100)
+    assert (report.updated, report.failed) == (4, 0)
+    assert "4 updated, 0 failed" in report.summary()
@@ -0,0 +1,88 @@
+"""
+Unit tests for the per-key locks
+"""
+
+import threading
+import time
+
+from bot.locks import KeyedLock, KeyedQueue
+
+
+def test_same_key_is_serialized():
+    """Holders of one key run one after another and the lock is dropped afterwards"""
+    locks = KeyedLock()
+    active, overlaps = [], []
+
+    def work():
+        with locks.hold("user"):
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == [1] * 5
+    assert len(locks) == 0
+
+
+def test_different_keys_run_concurrently():
+    """Holding one key does not block another"""
+    locks = KeyedLock()
+    with locks.hold("one"):
+        done = threading.Event()
+
+        def work():
+            with locks.hold("two"):
+                done.set()
+
+        threading.Thread(target=work).start()
+        assert done.wait(1)
+
+
+def test_queue_drops_duplicates_and_runs_the_rest():
+    """A busy key queues other jobs, drops repeats and never blocks the caller"""
+    queue = KeyedQueue()
+    release, ran = threading.Event(), []
+
+    def slow_start():
+        release.wait(1)
+        ran.append("start")
+
+    worker = threading.Thread(target=queue.run, args=("user", "start", slow_start))
+    worker.start()
+    while len(queue) == 0:
+        time.sleep(0.001)
+
+    assert queue.run("user", "start", lambda: ran.append("again")) == (False, None)
+    assert queue.run("user", "stats", lambda: ran.append("stats")) == (False, None)
+    assert queue.run("other", "start", lambda: "done") == (True, "done")
+
+    release.set()
+    worker.join()
+    assert ran == ["start", "stats"]
+    assert len(queue) == 0
+
+
+def test_queued_errors_reach_their_callback():
+    """A queued job that fails hands its error to the callback it was queued with"""
+    queue = KeyedQueue()
+    release, errors = threading.Event(), []
+
+    def fail():
+        raise ValueError("queued")
+
+    worker = threading.Thread(target=queue.run, args=("user", "start", lambda: release.wait(1)))
+    worker.start()
+    while len(queue) == 0:
+        time.sleep(0.001)
+
+    assert queue.run("user", "stats", fail, errors.append) == (False, None)
+    release.set()
+    worker.join()
+    assert [str(error) for error in errors] == ["queued"]
+    assert len(queue) == 0
@@ -0,0 +1,106 @@
+"""
+Unit tests for the membership cache
+"""
+
+import logging
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import Chat, ChatMember, ChatMemberUpdated, Update, User
+
+from bot.membership import MembershipCache
+from bot.metrics import Metrics
+from bot.vpn_bot import VPNBot
+
+
+def test_positive_and_negative_ttl():
+    """Non-members expire sooner than members"""
+    cache = MembershipCache(ttl=60, negative_ttl=0.01)
+    cache.set(1, True)
+    cache.set(2, False)
+    assert cache.get(2) is False
+    time.sleep(0.02)
+
+    assert cache.get(1) is True
+    assert cache.get(2) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_invalidate():
+    """Invalidated users are looked up again"""
+    cache = MembershipCache()
+    cache.set(1, True)
+    cache.invalidate(1)
+    assert cache.get(1) is None
+
+
+class FakeTelegram:
+    """Answers getChatMember with a fixed status and counts the calls"""
+
+    def __init__(self, status: str):
+        self.status = status
+        self.calls = 0
+
+    def getChatMember(self, chat_id, user_id):  # pylint: disable=C0103
+        """Reports the fixed status"""
+        self.calls += 1
+        return ChatMember(User(user_id, "a", False), self.status)
+
+
+def make_bot() -> VPNBot:
+    """A bot with just the membership state"""
+    vpn_bot = VPNBot.__new__(VPNBot)
+    vpn_bot.logger = logging.getLogger(__name__)
+    vpn_bot.chat_id = -100
+    vpn_bot.members = MembershipCache()
+    vpn_bot.metrics = Metrics()
+    vpn_bot.profiler = None
+    return vpn_bot
+
+
+def member_update(chat_id: int, user_id: int, status: str) -> Update:
+    """A chat_member update moving a user to a new status"""
+    user = User(user_id, "a", False)
+    change = ChatMemberUpdated(
+        Chat(chat_id, "channel"),
+        user,
+        datetime.now(),
+        ChatMember(user, ChatMember.MEMBER),
+        ChatMember(user, status),
+    )
+    return Update(1, chat_member=change)
+
+
+def test_check_member_is_cached():
+    """Only the first check asks Telegram"""
+    vpn_bot = make_bot()
+    context = SimpleNamespace(bot=FakeTelegram(ChatMember.MEMBER))
+    assert vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+    assert vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+    assert context.bot.calls == 1
+
+
+def test_leave_and_ban_revoke_cached_member():
+    """Leaving or being banned from the main chat takes effect right away"""
+    vpn_bot = make_bot()
+    context = SimpleNamespace(bot=FakeTelegram(ChatMember.MEMBER))
+    assert vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+    assert vpn_bot._check_member(context, 2)  # pylint: disable=W0212
+
+    vpn_bot.on_chat_member(member_update(-100, 1, ChatMember.LEFT), context)
+    vpn_bot.on_chat_member(member_update(-100, 2, ChatMember.KICKED), context)
+    assert not vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+    assert not vpn_bot._check_member(context, 2)  # pylint: disable=W0212
+    assert context.bot.calls == 2
+
+
+def test_other_chats_are_ignored():
+    """Leaving some other chat does not revoke access"""
+    vpn_bot = make_bot()
+    context = SimpleNamespace(bot=FakeTelegram(ChatMember.MEMBER))
+    assert vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+
+    vpn_bot.on_chat_member(member_update(-200, 1, ChatMember.LEFT), context)
+    assert vpn_bot._check_member(context, 1)  # pylint: disable=W0212
+    assert context.bot.calls == 1
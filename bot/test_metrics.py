@@ -0,0 +1,132 @@
+"""
+Unit tests for the metrics and the profiler
+"""
+
+import logging
+import threading
+import time
+import urllib.request
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+from bot.locks import KeyedQueue
+from bot.metrics import Metrics, SlowestTraces
+from bot.test_vpn_bot import FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.vpn_bot import UserLimitReached, VPNProvider, instrumented, per_user
+from vpn_bot.metrics_server import MetricsServer
+
+
+def test_render_histogram_and_collectors():
+    """Histograms are cumulative and collectors are read when rendering"""
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.describe("handler_seconds", "histogram", "Handler latency")
+    metrics.observe("handler_seconds", 0.05, handler="start")
+    metrics.observe("handler_seconds", 0.5, handler="start")
+    metrics.inc("errors_total", server='a"b')
+    metrics.collector(lambda: [("cache_hits_total", {}, 3)])
+
+    lines = metrics.render().splitlines()
+    assert "# HELP handler_seconds Handler latency" in lines
+    assert 'handler_seconds_bucket{handler="start",le="0.1"} 1' in lines
+    assert 'handler_seconds_bucket{handler="start",le="1"} 2' in lines
+    assert 'handler_seconds_bucket{handler="start",le="+Inf"} 2' in lines
+    assert 'handler_seconds_count{handler="start"} 2' in lines
+    assert 'errors_total{server="a\\"b"} 1' in lines
+    assert "cache_hits_total 3" in lines
+
+
+def test_time_tracks_in_flight():
+    """A timed block counts as in flight until it ends"""
+    metrics = Metrics()
+    with metrics.time("seconds", in_flight="in_flight", handler="stats"):
+        assert metrics.count("in_flight", handler="stats") == 1
+    assert metrics.count("in_flight", handler="stats") == 0
+    assert metrics.count("seconds", handler="stats") == 1
+
+
+def test_profiler_keeps_slowest():
+    """Only the slowest traces are kept, with the stacks they spent time in"""
+    profiler = SlowestTraces(keep=1, interval=0.005)
+    profiler.start()
+    with profiler.trace("fast"):
+        pass
+    with profiler.trace("slow"):
+        time.sleep(0.1)
+    profiler.stop()
+
+    dump = profiler.dump()
+    assert dump.startswith("0.1")
+    assert "slow" in dump and "fast" not in dump
+    assert "test_profiler_keeps_slowest" in dump
+
+
+def test_handlers_are_measured_when_they_run():
+    """Dropped updates are not timed and errors of queued updates are counted"""
+    release = threading.Event()
+
+    class Handlers:
+        """Just enough of VPNBot for the decorators"""
+
+        logger = logging.getLogger(__name__)
+        metrics = Metrics()
+        profiler = None
+        user_queue = KeyedQueue()
+
+        @per_user
+        @instrumented
+        def stats(self, update, context):
+            """Waits until released"""
+            release.wait(1)
+
+        @per_user
+        @instrumented
+        def start(self, update, context):
+            """Fails"""
+            raise ValueError("start")
+
+    user = User(id=1, first_name="a", is_bot=False)
+    update = Update(1, message=Message(1, None, Chat(id=1, type="private"), from_user=user))
+    handlers = Handlers()
+    first = threading.Thread(target=handlers.stats, args=(update, None))
+    first.start()
+    while len(handlers.user_queue) == 0:
+        time.sleep(0.001)
+
+    handlers.stats(update, None)
+    handlers.start(update, None)
+    assert handlers.metrics.count("bot_handler_seconds", handler="start") == 0
+    release.set()
+    first.join()
+
+    assert handlers.metrics.count("bot_handler_seconds", handler="stats") == 1
+    assert handlers.metrics.count("bot_handler_seconds", handler="start") == 1
+    assert handlers.metrics.count("bot_handler_errors_total", handler="start") == 1
+
+
+def test_provider_metrics(provider: VPNProvider):  # pylint: disable=W0621
+    """Server users and refused users are counted without exposing server secrets"""
+    provider.max_users = 1
+    with pytest.raises(UserLimitReached):
+        provider.generate_url("new")
+
+    assert provider.metrics.count("vpn_server_users", server="two") == 1
+    assert provider.metrics.count("vpn_user_limit_reached_total", server="two") == 1
+    assert "outline_cache_hits_total" in provider.metrics.render()
+
+
+def test_metrics_server():
+    """The endpoint serves the rendered metrics and the slowest traces"""
+    metrics = Metrics()
+    metrics.inc("updates_total")
+    profiler = SlowestTraces()
+    server = MetricsServer(metrics, profiler, port=0)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{server.port}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert "updates_total 1" in response.read().decode()
+        with urllib.request.urlopen(f"{url}/debug/slowest") as response:
+            assert response.status == 200
+    finally:
+        server.stop()
@@ -0,0 +1,116 @@
+"""
+Unit tests for the outbound message queue and the quota notifications
+"""
+
+import time
+
+from bot.outbox import Outbox, RateLimiter
+from bot.quota import QuotaNotifier
+from bot.test_vpn_bot import provider  # pylint: disable=W0611
+from bot.user_index import IndexEntry
+from bot.vpn_bot import VPNProvider
+
+
+class FakeTelegram:
+    """Records the messages sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Remembers the message and when it was sent"""
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+def test_rate_limits():
+    """Bursts pass at once, then messages are spaced globally and per chat"""
+    limiter = RateLimiter(rate=10, burst=2, chat_interval=1.0, group_interval=3.0)
+    assert limiter.reserve(1) == 0
+    assert limiter.reserve(2) == 0
+    assert 0.05 < limiter.reserve(3) <= 0.1
+    assert 0.9 < limiter.reserve(1) <= 1.0
+    assert 0.25 < limiter.reserve(-100) <= 0.3
+    assert 3.25 < limiter.reserve(-100) <= 3.3
+
+
+def test_alerts_are_digested():
+    """The first alert goes out at once, repeats are folded into one digest"""
+    telegram = FakeTelegram()
+    outbox = Outbox(-1, limiter=RateLimiter(rate=0, chat_interval=0), digest_interval=60)
+    for _ in range(5):
+        outbox.alert("full", "No more available VPN resources")
+    outbox.alert("down", "Server down")
+    outbox.flush_alerts(force=True)
+    outbox.flush_alerts(force=True)
+    assert outbox.suppressed == 4
+
+    outbox.start(telegram)
+    deadline = time.monotonic() + 5
+    while len(telegram.sent) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    outbox.stop()
+    assert [text for _, text, _ in telegram.sent] == [
+        "No more available VPN resources",
+        "Server down",
+        "No more available VPN resources (repeated 4 times in the last 1 min)",
+    ]
+    assert outbox.sent == 3
+
+
+def test_quota_thresholds_notified_once(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """Users are told once per threshold crossed, again only for a new key"""
+    used = {"1": 50, "2": 85}
+
+    class Usage:
+        """Traffic of the keys on https://one"""
+
+        def usage(self, server, key_id):
+            """Bytes used by a key"""
+            return used.get(key_id) if server == "https://one" else None
+
+    outbox = Outbox(-1)
+    posted = []
+    monkeypatch.setattr(outbox, "post", lambda chat_id, text: posted.append((chat_id, text)) is None)
+    provider.bytes_limit = 100
+    provider.index.put(IndexEntry("Ann_None_11", "https://one", "1", "ss://a"))
+    provider.index.put(IndexEntry("Bob_None_12", "https://one", "2", "ss://b"))
+    notifier = QuotaNotifier(provider, Usage(), outbox, limit_gb=10)
+
+    assert notifier.check() == 1
+    assert posted == [(12, "Вы использовали 80% трафика от 10 GB. Подробнее: /stats")]
+    assert notifier.check() == 0
+
+    used.update({"1": 100, "2": 90})
+    assert notifier.check() == 1
+    assert posted[-1][0] == 11 and "весь трафик" in posted[-1][1]
+    notifier.close()
+
+    notifier = QuotaNotifier(provider, Usage(), outbox, limit_gb=10)
+    assert notifier.check() == 0
+    provider.index.put(IndexEntry("Bob_None_12", "https://one", "1", "ss://b"))
+    assert notifier.check() == 1
+    notifier.close()
+
+
+def test_dropped_quota_notice_is_retried(provider: VPNProvider):  # pylint: disable=W0621
+    """A notice the full outbox dropped is not recorded and goes out on a later check"""
+
+    class Usage:
+        """Every key used its whole traffic"""
+
+        def usage(self, server, key_id):
+            """Bytes used by a key"""
+            return 100
+
+    outbox = Outbox(-1, queue_size=1)
+    outbox.post(1, "fills the queue")
+    provider.bytes_limit = 100
+    provider.index.put(IndexEntry("Ann_None_11", "https://one", "1", "ss://a"))
+    notifier = QuotaNotifier(provider, Usage(), outbox, limit_gb=10)
+
+    assert notifier.check() == 0
+    assert outbox.dropped == 1
+    outbox._queue.get_nowait()  # pylint: disable=W0212
+    assert notifier.check() == 1
+    assert notifier.check() == 0
+    notifier.close()
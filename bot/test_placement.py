@@ -0,0 +1,61 @@
+"""
+Unit tests for the placement of new users
+"""
+
+import json
+import random
+
+import pytest
+
+from bot.placement import LeastKeys, LeastTraffic, PlacementEngine, ServerLoad, WeightedRandom
+from bot.test_vpn_bot import FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.vpn_bot import VPNProvider
+
+LOADS = [
+    ServerLoad("https://one", users=40, traffic=900, capacity=100),
+    ServerLoad("https://two", users=45, traffic=100, capacity=100),
+    ServerLoad("https://big", users=80, traffic=500, capacity=200, weight=2.0),
+    ServerLoad("https://full", users=10, traffic=0, capacity=10),
+]
+
+
+def test_least_keys():
+    """The least filled server relative to capacity and weight wins"""
+    assert PlacementEngine(LeastKeys()).choose(LOADS).server == "https://big"
+
+
+def test_least_traffic():
+    """Idle servers win over busy ones with fewer users"""
+    assert PlacementEngine(LeastTraffic()).choose(LOADS).server == "https://two"
+
+
+def test_weighted_random():
+    """Picks follow weight times headroom and never land on a full server"""
+    engine = PlacementEngine(WeightedRandom(random.Random(1)))
+    picks = [engine.choose(LOADS).server for _ in range(2000)]
+    assert "https://full" not in picks
+    # headroom 60, 55 and 120 * 2
+    assert picks.count("https://big") > picks.count("https://one") + picks.count("https://two")
+
+
+def test_no_room():
+    """Nothing is chosen when every server is full or switched off"""
+    loads = [LOADS[3], ServerLoad("https://off", users=0, traffic=0, capacity=10, weight=0)]
+    assert PlacementEngine().choose(loads) is None
+    with pytest.raises(ValueError):
+        PlacementEngine("fastest")
+
+
+def test_provider_uses_server_settings(provider: VPNProvider, tmp_path):  # pylint: disable=W0621
+    """Weights and capacities from the servers file steer new users"""
+    servers = tmp_path / "servers.json"
+    servers.write_text(json.dumps({"servers": [
+        {"url": "https://one", "capacity": 300},
+        {"url": "https://two", "weight": 0},
+    ]}))
+    provider.configurator.update()
+
+    assert provider.configurator.servers == ["https://one", "https://two"]
+    assert provider.capacity("https://one") == 300
+    assert provider.capacity("https://two") == provider.max_users
+    assert provider.get_client("new").api_url == "https://one"
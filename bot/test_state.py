@@ -0,0 +1,121 @@
+"""
+Unit tests for the state shared by bot processes
+"""
+
+import threading
+import time
+
+import pytest
+
+from bot.membership import MembershipCache
+from bot.state import LockTimeout, MemoryStore, SQLiteStore
+from bot.test_vpn_bot import FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.user_index import IndexEntry, UserIndex
+from bot.vpn_bot import VPNProvider
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    """Every kind of store"""
+    store = MemoryStore() if request.param == "memory" else SQLiteStore(str(tmp_path / "state.sqlite"))
+    yield store
+    store.close()
+
+
+def test_values_and_counters(store):  # pylint: disable=W0621
+    """Values expire after their ttl, counters start at 0"""
+    assert store.get("ns", "a") is None
+    store.set("ns", "a", "1")
+    store.set("ns", "b", "2", ttl=0.05)
+    assert store.get("ns", "a") == "1"
+    assert store.get("ns", "b") == "2"
+    assert store.get("other", "a") is None
+    time.sleep(0.1)
+    assert store.get("ns", "b") is None
+    store.delete("ns", "a")
+    assert store.get("ns", "a") is None
+
+    assert store.incr("count", "x") == 1
+    assert store.incr("count", "x", 4) == 5
+    assert store.get("count", "x") == "5"
+
+
+def test_lock_is_shared_by_processes(tmp_path):
+    """A second store on the file waits for the lock and takes it over once the lease runs out"""
+    path = str(tmp_path / "state.sqlite")
+    first, second = SQLiteStore(path), SQLiteStore(path)
+    with first.lock("job"):
+        with pytest.raises(LockTimeout):
+            with second.lock("job", timeout=0.1):
+                pass
+    with second.lock("job", timeout=0.1):
+        pass
+
+    # the first store dies holding the lock
+    assert first._acquire("job", lease=0.2)  # pylint: disable=W0212
+    first.close()
+    started = time.monotonic()
+    with second.lock("job", timeout=1):
+        assert time.monotonic() - started >= 0.15
+    second.close()
+
+
+def test_counters_are_shared(tmp_path):
+    """Increments of several processes add up"""
+    path = str(tmp_path / "state.sqlite")
+    stores = [SQLiteStore(path) for _ in range(3)]
+    threads = [
+        threading.Thread(target=lambda s=s: [s.incr("count", "x") for _ in range(50)]) for s in stores
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stores[0].get("count", "x") == "150"
+    for s in stores:
+        s.close()
+
+
+def test_shared_index_and_membership(tmp_path):
+    """Users and memberships written or removed by one process are seen by another at once"""
+    path = str(tmp_path / "users.sqlite")
+    writer, reader = UserIndex(path, shared=True), UserIndex(path, shared=True)
+    writer.put(IndexEntry("alice_1", "https://a", "1", "ss://alice"))
+    assert reader.get("alice_1") == IndexEntry("alice_1", "https://a", "1", "ss://alice")
+    assert reader.get("bob_2") is None
+    writer.remove("alice_1")
+    assert reader.get("alice_1") is None
+
+    first, second = SQLiteStore(path), SQLiteStore(path)
+    cache, peer = MembershipCache(store=first), MembershipCache(store=second)
+    cache.set(1, True)
+    cache.set(2, False)
+    assert peer.get(1) is True
+    assert peer.get(2) is False
+    cache.set(1, False)
+    assert peer.get(1) is False
+    cache.invalidate(1)
+    assert peer.get(1) is None
+    for closable in (writer, reader, first, second):
+        closable.close()
+
+
+def test_processes_provision_one_key(provider, tmp_path):  # pylint: disable=W0621
+    """Two processes asked for the same user at once create a single key"""
+    path = str(tmp_path / "users.sqlite")
+    servers = str(tmp_path / "servers.json")
+    workers = [
+        VPNProvider(servers, server_timeout=0.5, index_path=path, store=SQLiteStore(path)) for _ in range(2)
+    ]
+    urls = []
+    threads = [threading.Thread(target=lambda w=w: urls.append(w.generate_url("twice_7"))) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(urls) == 2 and urls[0] == urls[1]
+    names = [name for names in FakeOutlineVPN.servers.values() if names for name in names]
+    assert names.count("twice_7") == 1
+    for worker in workers:
+        worker.close()
@@ -0,0 +1,67 @@
+"""
+Unit tests for the shared streamed pass over a server's keys
+"""
+
+import threading
+
+from bot.survey import KeySurvey
+from outline.outline_vpn import OutlineKey
+
+
+def make_keys(names, read, gate=None):
+    """Yields a key for every name, recording how many were read"""
+    for i, name in enumerate(names):
+        if gate is not None:
+            gate.wait(5)
+        read.append(name)
+        yield OutlineKey(str(i), name, None, None, None, f"ss://{name}", 10)
+
+
+def test_lookup_stops_at_its_key():
+    """A lone lookup stops reading once its key was read"""
+    read = []
+    survey = KeySurvey()
+    assert survey.join("b")
+    survey.read(make_keys(["a", "b", "c", "d"], read))
+    key, users, used = survey.result("b")
+    assert (key.key_id, key.access_url) == ("1", "ss://b")
+    assert (users, used) == (2, 20)
+    assert read == ["a", "b"]
+    assert not survey.complete
+    assert not survey.join("c")
+
+
+def test_lookups_share_one_pass():
+    """Lookups that join a running pass are answered from it, the new user gets the full counts"""
+    read = []
+    gate = threading.Event()
+    survey = KeySurvey()
+    survey.join("b")
+    survey.join("new")
+    reader = threading.Thread(target=survey.read, args=(make_keys(["a", "b", "pool:x:1", "c"], read, gate),))
+    reader.start()
+    gate.set()
+    assert survey.result("b")[0].name == "b"
+    assert survey.result("new") == (None, 3, 40)
+    reader.join()
+    assert survey.complete
+    assert read == ["a", "b", "pool:x:1", "c"]
+
+
+def test_failed_pass_reaches_every_lookup():
+    """A read that fails is reported to the lookups still waiting"""
+
+    def broken():
+        yield OutlineKey("0", "a", None, None, None, "ss://a", 0)
+        raise ConnectionError("server is down")
+
+    survey = KeySurvey()
+    survey.join("a")
+    survey.join("z")
+    survey.read(broken())
+    assert survey.result("a")[0].name == "a"
+    try:
+        survey.result("z")
+        assert False, "the error was swallowed"
+    except ConnectionError:
+        pass
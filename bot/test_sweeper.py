@@ -0,0 +1,82 @@
+"""
+Unit tests for the sweeper of unused keys
+"""
+
+import time
+
+from bot.key_pool import POOL_PREFIX
+from bot.sweeper import IDLE, LEFT, ActivityLog, KeySweeper
+from bot.test_vpn_bot import DELETED, FakeOutlineVPN, provider  # pylint: disable=W0611
+from bot.usage_stats import DAY
+from bot.user_index import IndexEntry
+from bot.vpn_bot import VPNProvider
+
+
+def make_sweeper(provider: VPNProvider, members=(), **kwargs) -> KeySweeper:  # pylint: disable=W0621
+    """A sweeper of the fake servers where only `members` are in the chat"""
+    FakeOutlineVPN.servers["https://one"] = ["Ann_None_1", "Bob_None_2", "admin", f"{POOL_PREFIX}3"]
+    FakeOutlineVPN.servers["https://two"] = ["Cid_None_3"]
+    provider.index.put(IndexEntry("Bob_None_2", "https://one", "1", "ss://Bob_None_2"))
+    return KeySweeper(provider, is_member=lambda user_id: user_id in members, **kwargs)
+
+
+def test_dry_run_reports_users_who_left(provider: VPNProvider):  # pylint: disable=W0621
+    """Keys of users who left are reported, pooled and unnamed keys are never touched"""
+    sweeper = make_sweeper(provider, members={1})
+    report = sweeper.sweep(dry_run=True)
+
+    assert [(c.name, c.reason) for c in report.candidates] == [
+        ("Bob_None_2", LEFT), ("Cid_None_3", LEFT)]
+    assert report.deleted == []
+    assert report.skipped == ["https://down"]
+    assert FakeOutlineVPN.servers["https://one"][1] == "Bob_None_2"
+    assert "2 keys to delete" in report.summary()
+    assert "secret" not in report.summary()
+
+
+def test_sweep_deletes_in_batches(provider: VPNProvider):  # pylint: disable=W0621
+    """Deleted keys leave the servers and the index and are counted"""
+    sweeper = make_sweeper(provider, members={1}, batch_size=1, pause=0.1)
+    report = sweeper.sweep()
+
+    assert {c.name for c in report.deleted} == {"Bob_None_2", "Cid_None_3"}
+    assert FakeOutlineVPN.servers["https://one"] == ["Ann_None_1", DELETED, "admin", f"{POOL_PREFIX}3"]
+    assert FakeOutlineVPN.servers["https://two"] == [DELETED]
+    assert provider.index.get("Bob_None_2") is None
+    assert provider.metrics.count("vpn_swept_keys_total", reason=LEFT, server="one") == 1
+
+
+def test_idle_keys(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """Keys are idle once their traffic has not moved for idle_days"""
+    sweeper = make_sweeper(provider, members={1, 2, 3}, idle_days=1)
+    assert sweeper.sweep(dry_run=True).candidates == []
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + DAY)
+    report = sweeper.sweep(dry_run=True)
+    assert {(c.name, c.reason) for c in report.candidates} == {
+        ("Ann_None_1", IDLE), ("Bob_None_2", IDLE), ("Cid_None_3", IDLE)}
+
+
+def test_activity_survives_restart(tmp_path):
+    """Idle time is counted from the last change of the traffic, across restarts"""
+    path = str(tmp_path / "users.sqlite")
+    log = ActivityLog(path)
+    assert log.update("s", ["1", "2"], {"1": 5}, now=10) == {"1": 10, "2": 10}
+    log.close()
+
+    log = ActivityLog(path)
+    assert log.update("s", ["1", "2"], {"1": 7}, now=20) == {"1": 20, "2": 10}
+    assert log.update("s", ["2"], {}, now=30) == {"2": 10}
+    assert log.update("s", ["1"], {"1": 7}, now=40) == {"1": 40}
+    log.close()
+
+
+def test_shrinking_traffic_is_not_activity(tmp_path):
+    """Traffic leaving the 30 day window does not make a key active, new traffic does"""
+    log = ActivityLog(str(tmp_path / "users.sqlite"))
+    assert log.update("s", ["1"], {"1": 100}, now=10) == {"1": 10}
+    assert log.update("s", ["1"], {"1": 60}, now=20) == {"1": 10}
+    assert log.update("s", ["1"], {"1": 0}, now=30) == {"1": 10}
+    assert log.update("s", ["1"], {"1": 5}, now=40) == {"1": 40}
+    log.close()
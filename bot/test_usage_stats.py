@@ -0,0 +1,64 @@
+"""
+Unit tests for the usage statistics collector
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bot.usage_stats import UsageAggregate, UsageStats
+
+
+class FakeClient:
+    """Reports the traffic it is given"""
+
+    def __init__(self, api_url: str, used: dict):
+        self.api_url = api_url
+        self.used = used
+
+    def get_transferred_data(self):
+        """Reports the traffic or fails when there is none"""
+        if self.used is None:
+            raise ConnectionError("server is down")
+        return {"bytesTransferredByUserId": dict(self.used)}
+
+
+class FakeProvider:
+    """Serves fake clients"""
+
+    def __init__(self, clients):
+        self.background = ThreadPoolExecutor(max_workers=2)
+        self._clients = clients
+
+    def clients(self):
+        """The configured servers"""
+        return self._clients
+
+
+def test_aggregate():
+    """Idle keys are ignored and users are ranked against the others"""
+    aggregate = UsageAggregate.from_used(np.array([0, 10, 20, 30, 40]))
+    assert aggregate.users == 4
+    assert aggregate.median == 25
+    assert aggregate.mean == 25
+    assert aggregate.rank(30) == 50.0
+    assert UsageAggregate.from_used(np.array([], dtype=np.int64)).rank(10) == 0.0
+
+
+def test_collect():
+    """Collections aggregate the fleet and track deltas"""
+    one = FakeClient("https://one", {"0": 100, "1": 0})
+    two = FakeClient("https://two", {"0": 300})
+    stats = UsageStats(FakeProvider([one, two]), interval=60)
+
+    stats.collect()
+    assert stats.fleet.users == 2
+    assert stats.servers["https://one"].users == 1
+    assert stats.usage("https://two", "0") == 300
+
+    one.used["1"] = 50
+    two.used = None
+    stats.collect()
+    assert stats.fleet.total == 450
+    assert stats.daily_delta("https://one", "1") == 50
+    assert stats.fleet_daily_delta() == 50
@@ -0,0 +1,58 @@
+"""
+Unit tests for the user index
+"""
+
+import time
+
+from bot.user_index import IndexEntry, UserIndex
+from outline.outline_vpn import OutlineKey
+
+
+def make_key(key_id: str, name: str) -> OutlineKey:
+    """Builds a key with just the fields the index cares about"""
+    return OutlineKey(
+        key_id=key_id,
+        name=name,
+        password="",
+        port=0,
+        method="",
+        access_url=f"ss://{key_id}",
+        used_bytes=None,
+    )
+
+
+def test_persistence(tmp_path):
+    """Entries survive reopening the index"""
+    path = str(tmp_path / "users.sqlite")
+    index = UserIndex(path)
+    index.put(IndexEntry("alice", "https://one", "1", "ss://1"))
+    index.close()
+
+    assert UserIndex(path).get("alice") == IndexEntry("alice", "https://one", "1", "ss://1")
+
+
+def test_reconcile(tmp_path):
+    """Reconciling a server adds new keys and drops deleted ones"""
+    index = UserIndex(str(tmp_path / "users.sqlite"))
+    index.put(IndexEntry("gone", "https://one", "7", "ss://7"))
+    index.put(IndexEntry("elsewhere", "https://two", "3", "ss://3"))
+
+    index.reconcile("https://one", [make_key("1", "alice"), make_key("2", "")])
+
+    assert index.get("gone") is None
+    assert index.get("alice").key_id == "1"
+    assert index.get("elsewhere").server == "https://two"
+    assert len(index) == 2
+
+
+def test_reconcile_keeps_newer_writes(tmp_path):
+    """A key list requested before a key was created does not drop its entry"""
+    index = UserIndex(str(tmp_path / "users.sqlite"))
+    fetched_at = time.monotonic()
+    index.put(IndexEntry("new", "https://one", "9", "ss://9"))
+
+    index.reconcile("https://one", [make_key("1", "alice")], fetched_at)
+    assert index.get("new").key_id == "9"
+
+    index.reconcile("https://one", [make_key("1", "alice")], time.monotonic())
+    assert index.get("new") is None
@@ -0,0 +1,254 @@
+"""
+Unit tests for the VPN provider
+"""
+
+import copy
+import json
+import logging
+import threading
+import time
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+import bot.vpn_bot
+from bot.locks import KeyedQueue
+from bot.vpn_bot import VPNProvider, per_user
+from outline.outline_vpn import KeySnapshot
+
+
+SERVERS = {
+    "https://one": ["a", "b", "c"],
+    "https://two": ["d"],
+    "https://slow": [],
+    "https://down": None,
+}
+
+# name of a key removed from a fake server; ids of the other keys do not change
+DELETED = "<deleted>"
+
+
+class FakeOutlineVPN:
+    """Serves keys from a copy of SERVERS instead of a live Outline server"""
+
+    servers = SERVERS
+    # (server, key id) -> data limit in bytes
+    limits = {}
+
+    def __init__(self, api_url: str, **kwargs):
+        self.api_url = api_url
+        self.kwargs = kwargs
+
+    def close(self):
+        """Nothing to close"""
+
+    def create_key(self):
+        """Adds an unnamed key"""
+        names = self.servers[self.api_url]
+        names.append(None)
+        return KeySnapshot([{"id": str(len(names) - 1), "accessUrl": "ss://new"}], {}).keys[0]
+
+    def rename_key(self, key_id, name):
+        """Names a key"""
+        self.servers[self.api_url][int(key_id)] = name
+        return True
+
+    def add_data_limit(self, key_id, limit_bytes):
+        """Remembers the limit of a key"""
+        self.limits[(self.api_url, str(key_id))] = limit_bytes
+        return True
+
+    def delete_key(self, key_id):
+        """Removes a key"""
+        self.servers[self.api_url][int(key_id)] = DELETED
+        return True
+
+    def get_server_info(self):
+        """Answers unless the server is down"""
+        if self.servers[self.api_url] is None:
+            raise ConnectionError("server is down")
+        return {"name": self.api_url}
+
+    def snapshot(self):
+        """Describes the server's keys"""
+        names = self.servers[self.api_url]
+        if names is None:
+            raise ConnectionError("server is down")
+        if self.api_url == "https://slow":
+            time.sleep(1)
+        records = [
+            {"id": str(i), "name": name, "accessUrl": f"ss://{name}"}
+            for i, name in enumerate(names)
+            if name != DELETED
+        ]
+        for record in records:
+            if (self.api_url, record["id"]) in self.limits:
+                record["dataLimit"] = {"bytes": self.limits[(self.api_url, record["id"])]}
+        return KeySnapshot(records, {})
+
+    def iter_keys(self):
+        """Yields the keys one at a time"""
+        yield from self.snapshot().keys
+
+    def find_key_by_name(self, name):
+        """The key with the given name"""
+        return self.snapshot().find(name)
+
+    def count_keys(self, where=None):
+        """Counts the keys"""
+        return sum(1 for record in self.snapshot().records if where is None or where(record))
+
+    def get_transferred_data(self):
+        """No key transferred anything"""
+        return {"bytesTransferredByUserId": {}}
+
+
+def write_servers(provider: VPNProvider, servers):  # pylint: disable=W0621
+    """Replaces the servers file of a provider"""
+    with open(provider.configurator.path, "w") as f:
+        json.dump({"servers": servers}, f)
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch) -> VPNProvider:
+    """A provider over the fake servers"""
+    monkeypatch.setattr(bot.vpn_bot, "OutlineVPN", FakeOutlineVPN)
+    monkeypatch.setattr(bot.vpn_bot.VPNProvider, "reconcile", lambda self: None)
+    monkeypatch.setattr(FakeOutlineVPN, "servers", copy.deepcopy(SERVERS))
+    monkeypatch.setattr(FakeOutlineVPN, "limits", {})
+    servers = tmp_path / "servers.json"
+    servers.write_text(json.dumps({"servers": list(SERVERS)}))
+    provider = VPNProvider(
+        str(servers), server_timeout=0.5, index_path=str(tmp_path / "users.sqlite")
+    )  # pylint: disable=W0621
+    yield provider
+    provider.close()
+    assert not provider.reconciler.is_alive()
+
+
+def test_background_waits_for_start(provider: VPNProvider):  # pylint: disable=W0621
+    """Nothing runs in the background before start, and start runs it once"""
+    assert provider.observer is None
+    assert not provider.reconciler.is_alive()
+    assert provider.get_client("b").api_url == "https://one"
+
+    provider.start()
+    provider.start()
+    assert provider.observer.is_alive()
+    assert provider.reconciler.is_alive()
+
+
+def test_get_client_existing_user(provider: VPNProvider):  # pylint: disable=W0621
+    """A user that has a key is routed to its server"""
+    assert provider.get_client("b").api_url == "https://one"
+
+
+def test_get_client_least_loaded(provider: VPNProvider):  # pylint: disable=W0621
+    """A new user gets the least loaded server that answered in time"""
+    started = time.monotonic()
+    assert provider.get_client("new").api_url == "https://two"
+    assert time.monotonic() - started < 1
+
+
+def test_get_client_from_index(provider: VPNProvider):  # pylint: disable=W0621
+    """Users found once are resolved from the index afterwards"""
+    assert provider.get_client("d").api_url == "https://two"
+    write_servers(provider, ["https://two", "https://down"])
+    provider.configurator.reload()
+    assert provider.index.get("d").server == "https://two"
+    assert provider.generate_url("d").endswith("ss%3A//d")
+
+
+def test_large_servers_are_streamed(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """Scans read the keys of servers with many of them one at a time"""
+    streamed = []
+    iter_keys = FakeOutlineVPN.iter_keys
+    monkeypatch.setattr(FakeOutlineVPN, "iter_keys", lambda self: streamed.append(self.api_url) or iter_keys(self))
+    assert provider.get_client("b").api_url == "https://one"
+    assert not streamed
+
+    provider.stream_threshold = 3
+    provider.store.set("server_users", "https://one", "3")
+    assert provider.get_client("c").api_url == "https://one"
+    assert streamed == ["https://one"]
+
+
+def test_scan_is_bounded(provider: VPNProvider):  # pylint: disable=W0621
+    """Scans use their own pool and clients that give up within server_timeout"""
+    provider.get_client("new")
+    scan_client = provider.scan_client("https://one")
+    assert sum(scan_client.kwargs["timeout"]) <= provider.server_timeout
+    assert scan_client.kwargs["retries"] == 0
+    assert provider.get_client("new") is not scan_client
+    assert provider.background is not provider.executor
+
+
+def test_generate_url_creates_and_indexes(provider: VPNProvider):  # pylint: disable=W0621
+    """A new user gets a named key on the least loaded server, remembered in the index"""
+    assert provider.generate_url("new").endswith("ss%3A//new")
+    assert FakeOutlineVPN.servers["https://two"] == ["d", "new"]
+    assert provider.index.get("new").server == "https://two"
+    assert provider.index.get("new").key_id == "1"
+
+
+def test_double_start_creates_one_key():
+    """A /start sent while the first one is running does not reach generate_url again"""
+    release = threading.Event()
+    calls = []
+
+    class SlowBot:
+        """Just enough of VPNBot for the decorator"""
+
+        logger = logging.getLogger(__name__)
+        user_queue = KeyedQueue()
+
+        @per_user
+        def start(self, update, context):
+            """Waits like a slow generate_url"""
+            calls.append(update.update_id)
+            release.wait(1)
+
+    def _update(update_id):
+        user = User(id=1, first_name="a", is_bot=False)
+        chat = Chat(id=1, type="private")
+        return Update(update_id, message=Message(update_id, None, chat, from_user=user))
+
+    handler = SlowBot()
+    first = threading.Thread(target=handler.start, args=(_update(1), None))
+    first.start()
+    while not calls:
+        time.sleep(0.001)
+
+    assert handler.start(_update(2), None) is None
+    release.set()
+    first.join()
+    assert calls == [1]
+
+
+def test_reload_warms_added_and_drains_removed(provider: VPNProvider):  # pylint: disable=W0621
+    """Only the difference is applied: added servers are ready before they are used"""
+    provider.get_client("new")
+    one = provider._client("https://one")  # pylint: disable=W0212
+    FakeOutlineVPN.servers["https://three"] = ["e"]
+
+    write_servers(provider, ["https://one", "https://three"])
+    provider.configurator.reload()
+
+    assert provider.configurator.servers == ["https://one", "https://three"]
+    assert provider.index.get("e").server == "https://three"
+    assert "https://three" in provider._clients  # pylint: disable=W0212
+    assert "https://two" not in provider._clients  # pylint: disable=W0212
+    assert "https://two" not in provider._scan_clients  # pylint: disable=W0212
+    assert provider._client("https://one") is one  # pylint: disable=W0212
+    assert len(provider._draining) == 1  # pylint: disable=W0212
+
+
+def test_reload_is_debounced(provider: VPNProvider, monkeypatch):  # pylint: disable=W0621
+    """A burst of file events ends in one reload"""
+    reloads = []
+    monkeypatch.setattr(provider.configurator, "reload", lambda: reloads.append(1))
+    provider.configurator.debounce = 0.05
+    for _ in range(5):
+        provider.configurator.schedule()
+    time.sleep(0.2)
+    assert reloads == [1]
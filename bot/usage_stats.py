@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterable, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    # NumPy is imported by the first collection, so the bot starts without it
+    import numpy as np
+
+DAY = 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class UsageAggregate:
+    """
+    Traffic of a group of keys, counting only keys that used any
+    """
+
+    users: int
+    total: int
+    mean: float
+    median: float
+    p90: float
+    p99: float
+    # used bytes in ascending order, to rank a user against the group
+    sorted_used: 'np.ndarray'
+
+    @classmethod
+    def from_used(cls, used: Union['np.ndarray', Iterable[int]]) -> 'UsageAggregate':
+        """
+        :param used: bytes transferred by every key
+        """
+        import numpy as np  # pylint: disable=C0415
+
+        if not isinstance(used, np.ndarray):
+            used = np.fromiter(used, dtype=np.int64)
+        used = np.sort(used[used > 0])
+        if len(used) == 0:
+            return cls(0, 0, 0.0, 0.0, 0.0, 0.0, used)
+
+        median, p90, p99 = np.percentile(used, [50, 90, 99])
+        return cls(len(used), int(used.sum()), float(used.mean()),
+                   float(median), float(p90), float(p99), used)
+
+    def rank(self, used_bytes: int) -> float:
+        """
+        Share of the group that used less traffic, in percent
+        """
+        if self.users == 0:
+            return 0.0
+        import numpy as np  # pylint: disable=C0415
+
+        return round(np.searchsorted(self.sorted_used, used_bytes, side='left') / self.users * 100, 2)
+
+
+@dataclass(frozen=True)
+class UsageSample:
+    """
+    Traffic of every key on every server at one moment
+    """
+
+    timestamp: float
+    # server URL -> key id -> bytes transferred
+    used: Dict[str, Dict[str, int]]
+
+    @property
+    def total(self) -> int:
+        return sum(sum(keys.values()) for keys in self.used.values())
+
+
+class UsageStats:
+    """
+    Collects traffic from every server in the background
+    and keeps fleet-wide and per-server aggregates in memory,
+    along with a rolling series of samples for daily deltas.
+    """
+
+    def __init__(self, provider, interval: float = 300, window: float = DAY,
+                 on_collect: Optional[Callable[[], None]] = None):
+        """
+        :param provider: VPNProvider with the servers to collect from
+        :param interval: seconds between collections
+        :param window: seconds of samples kept for deltas
+        :param on_collect: called after every collection
+        """
+        self.logger = logging.getLogger(__name__)
+        self.provider = provider
+        self.interval = interval
+        self.on_collect = on_collect
+        self.series: Deque[UsageSample] = deque(maxlen=max(2, int(window // interval) + 1))
+        self.fleet: Optional[UsageAggregate] = None
+        self.servers: Dict[str, UsageAggregate] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop, name='usage-stats', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.fleet is not None
+
+    def collect(self):
+        """
+        Fetch the traffic of every server and recompute the aggregates
+        """
+        clients = self.provider.clients()
+        futures = {self.provider.background.submit(client.get_transferred_data): client
+                   for client in clients}
+        used: Dict[str, Dict[str, int]] = {}
+        for future in as_completed(futures):
+            client = futures[future]
+            try:
+                used[client.api_url] = future.result()['bytesTransferredByUserId']
+            except Exception as e:
+                self.logger.error(
+                    f'Could not collect usage from {client.api_url} with error: {e}')
+                # keep the previous numbers of a server that did not answer
+                if len(self.series) > 0 and client.api_url in self.series[-1].used:
+                    used[client.api_url] = self.series[-1].used[client.api_url]
+
+        import numpy as np  # pylint: disable=C0415
+
+        columns = {server: np.fromiter(keys.values(), dtype=np.int64, count=len(keys))
+                   for server, keys in used.items()}
+        self.servers = {server: UsageAggregate.from_used(column)
+                        for server, column in columns.items()}
+        self.fleet = UsageAggregate.from_used(
+            np.concatenate(list(columns.values())) if columns else np.zeros(0, dtype=np.int64))
+        self.series.append(UsageSample(time.time(), used))
+        self.logger.debug(
+            f'Collected usage of {self.fleet.users} active users on {len(used)} servers')
+        if self.on_collect is not None:
+            self.on_collect()
+
+    def usage(self, server: str, key_id: str) -> Optional[int]:
+        """
+        Bytes used by a key as of the last collection
+        """
+        if len(self.series) == 0 or server not in self.series[-1].used:
+            return None
+        return self.series[-1].used[server].get(str(key_id), 0)
+
+    def daily_delta(self, server: str, key_id: str) -> Optional[int]:
+        """
+        Bytes used by a key since the oldest sample of the last day
+        """
+        current, oldest = self._day_bounds()
+        if current is None:
+            return None
+        key_id = str(key_id)
+        before = oldest.used.get(server, {}).get(key_id, 0)
+        return max(0, current.used.get(server, {}).get(key_id, 0) - before)
+
+    def fleet_daily_delta(self) -> Optional[int]:
+        """
+        Bytes used by all keys since the oldest sample of the last day
+        """
+        current, oldest = self._day_bounds()
+        if current is None:
+            return None
+        return max(0, current.total - oldest.total)
+
+    def _day_bounds(self) -> Tuple[Optional[UsageSample], Optional[UsageSample]]:
+        if len(self.series) == 0:
+            return None, None
+        current = self.series[-1]
+        for sample in self.series:
+            if current.timestamp - sample.timestamp <= DAY:
+                return current, sample
+        return current, current
+
+    def _loop(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                self.logger.error(f'Could not collect usage with error: {e}')
+            if self._stopped.wait(self.interval):
+                return
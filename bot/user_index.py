@@ -0,0 +1,130 @@
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from outline.outline_vpn import OutlineKey
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    """
+    Location of a user's access key
+    """
+
+    name: str
+    server: str
+    key_id: str
+    access_url: str
+
+
+class UserIndex:
+    """
+    Persistent map from a VPN user name to the server and key issued to it.
+
+    Entries live in SQLite so they survive restarts and are mirrored in memory,
+    so a lookup never touches the disk or the Outline servers.
+
+    A shared index is written by several processes: the database is put in WAL mode
+    and every lookup reads the disk, so keys added or removed by the others are seen at once.
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if shared:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'name TEXT PRIMARY KEY, server TEXT NOT NULL, '
+            'key_id TEXT NOT NULL, access_url TEXT NOT NULL)')
+        self._conn.commit()
+        self._entries: Dict[str, IndexEntry] = {
+            row[0]: IndexEntry(*row)
+            for row in self._conn.execute('SELECT name, server, key_id, access_url FROM users')
+        }
+        # name -> monotonic time of the last put, so reconciling never undoes newer writes
+        self._written: Dict[str, float] = {}
+        self.logger.debug(f'Loaded {len(self._entries)} users from {path}')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name: str) -> Optional[IndexEntry]:
+        if not self.shared:
+            return self._entries.get(name)
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT name, server, key_id, access_url FROM users WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                self._entries.pop(name, None)
+                return None
+            entry = self._entries[name] = IndexEntry(*row)
+        return entry
+
+    def entries(self) -> List[IndexEntry]:
+        with self._lock:
+            return list(self._entries.values())
+
+    def put(self, entry: IndexEntry):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO users (name, server, key_id, access_url) VALUES (?, ?, ?, ?)',
+                (entry.name, entry.server, str(entry.key_id), entry.access_url))
+            self._conn.commit()
+            self._entries[entry.name] = entry
+            self._written[entry.name] = time.monotonic()
+
+    def remove(self, name: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM users WHERE name = ?', (name,))
+            self._conn.commit()
+            self._entries.pop(name, None)
+            self._written.pop(name, None)
+
+    def reconcile(self, server: str, keys: Iterable[OutlineKey], fetched_at: Optional[float] = None):
+        """
+        Make the index agree with the keys currently present on a server
+        :param server: API URL of the server
+        :param keys: every key on that server
+        :param fetched_at: monotonic time the keys were requested at;
+        entries written after it are newer than the keys and left alone
+        """
+        present = {
+            key.name: IndexEntry(key.name, server, str(key.key_id), key.access_url)
+            for key in keys if key.name
+        }
+        with self._lock:
+            if fetched_at is not None:
+                newer = {name for name, written in self._written.items() if written >= fetched_at}
+            else:
+                newer = set()
+            stale = [entry.name for entry in self._entries.values()
+                     if entry.server == server and entry.name not in present and entry.name not in newer]
+            changed = [entry for name, entry in present.items()
+                       if self._entries.get(name) != entry and name not in newer]
+            self._conn.executemany(
+                'DELETE FROM users WHERE name = ?', [(name,) for name in stale])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO users (name, server, key_id, access_url) VALUES (?, ?, ?, ?)',
+                [(e.name, e.server, e.key_id, e.access_url) for e in changed])
+            self._conn.commit()
+            for name in stale:
+                del self._entries[name]
+                self._written.pop(name, None)
+            for entry in changed:
+                self._entries[entry.name] = entry
+
+        if stale or changed:
+            self.logger.debug(
+                f'Reconciled {server}: {len(changed)} updated, {len(stale)} removed')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
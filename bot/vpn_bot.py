@@ -1,16 +1,33 @@
+import contextlib
+import functools
 import os
 import traceback
 import json
 import logging
+import threading
+import time
 import urllib.parse
-
-import numpy as np
-
-from outline.outline_vpn import OutlineVPN
-from telegram import ChatMember, Update, User, ReplyKeyboardRemove
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bot.health import OPEN, HealthChecker
+from bot.key_pool import KeyPool, count_users, is_pooled
+from bot.locks import KeyedQueue
+from bot.membership import MembershipCache
+from bot.metrics import Metrics, SlowestTraces
+from bot.outbox import Outbox, RateLimiter
+from bot.placement import PlacementEngine, ServerLoad
+from bot.quota import QuotaNotifier
+from bot.state import LockTimeout, MemoryStore, SQLiteStore, StateStore
+from bot.survey import KeySurvey
+from bot.sweeper import KeySweeper
+from bot.usage_stats import UsageAggregate, UsageStats
+from bot.user_index import IndexEntry, UserIndex
+from outline.outline_vpn import ACCESS_KEYS, METRICS, OutlineKey, OutlineVPN, ResponseCache
+from telegram import Bot, ChatMember, Update, User, ReplyKeyboardRemove
 from telegram.ext import ConversationHandler, CallbackContext
 
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 VPN_URL_PREFIX = 'https://s3.amazonaws.com/outline-vpn/invite.html#'
@@ -30,55 +47,297 @@ class UserLimitReached(Exception):
     pass
 
 
-class ServersConfigurator(FileSystemEventHandler):
+def server_label(server: str) -> str:
+    """
+    Name of a server in metrics and reports: its host and port, leaving out the secret path
+    """
+    return urllib.parse.urlsplit(server).netloc
+
 
-    def __init__(self, url_path, url_filename):
+def instrumented(handler):
+    """
+    Time a handler, count it as in flight while it runs and count its errors;
+    with a profiler, sample where the slowest updates spend their time
+    """
+    @functools.wraps(handler)
+    def wrapper(self, update: Update, context: CallbackContext):
+        name = handler.__name__
+        trace = self.profiler.trace(name) if self.profiler is not None else contextlib.nullcontext()
+        with trace, self.metrics.time('bot_handler_seconds', in_flight='bot_handlers_in_flight', handler=name):
+            try:
+                return handler(self, update, context)
+            except Exception:
+                self.metrics.inc('bot_handler_errors_total', handler=name)
+                raise
+
+    return wrapper
+
+
+def per_user(handler):
+    """
+    Handle updates of one user one after another.
+    An update that arrives while the same command of that user is running
+    or waiting is dropped; other commands wait in the user's queue
+    instead of holding a worker. A queued update that fails is handed
+    to the error handlers of the dispatcher like any other.
+    """
+    @functools.wraps(handler)
+    def wrapper(self, update: Update, context: CallbackContext):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return handler(self, update, context)
+
+        dispatcher = getattr(context, 'dispatcher', None)
+        on_error = functools.partial(dispatcher.dispatch_error, update) if dispatcher is not None else None
+        ran, result = self.user_queue.run(
+            user.id, handler.__name__, functools.partial(handler, self, update, context), on_error)
+        if not ran:
+            self.logger.debug(f'Queued {handler.__name__} behind other updates of {user.id}')
+        return result
+
+    return wrapper
+
+
+@dataclass(frozen=True)
+class ServerSet:
+    """
+    The servers of one version of the servers file, replaced as a whole on reload
+    """
+
+    servers: List[str]
+    # server URL -> weight, capacity and other settings of the server
+    settings: Dict[str, dict]
+
+
+class ServersConfigurator(FileSystemEventHandler):
+    """
+    Keeps the list of servers in sync with the servers file.
+
+    A server is either its API URL or an object like
+    {"url": "https://...", "weight": 2, "capacity": 150};
+    `servers` holds the URLs and `settings` the rest of each object.
+
+    Bursts of file events, as editors write a file in several steps, are collapsed
+    into a single reload `debounce` seconds after the last one. A reload hands the
+    added servers to `on_added` before the new set is published, and the removed
+    ones to `on_removed` after.
+    """
+
+    def __init__(self, url_path, url_filename, debounce: float = 0.5,
+                 on_added: Optional[Callable[[List[str]], None]] = None,
+                 on_removed: Optional[Callable[[List[str]], None]] = None):
         self.logger = logging.getLogger(__name__)
         self.url_path = url_path
         self.url_filename = url_filename
         self.path = os.path.join(url_path, url_filename)
-        self.servers = {}
+        self.debounce = debounce
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.current = ServerSet([], {})
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
         self.update()
 
-    def on_modified(self, event):
-        if event.event_type == 'modified' and event.src_path == self.path:
-            with open(self.path, 'r') as f:
-                servers = json.load(f)['servers']
-                self.logger.debug(f'Loaded servers: {servers}')
-                if servers != self.servers:
-                    self.servers = servers
-                    self.logger.debug(
-                        f'Updated servers on: {event.event_type}  path : {event.src_path}')
+    @property
+    def servers(self) -> List[str]:
+        return self.current.servers
+
+    @property
+    def settings(self) -> Dict[str, dict]:
+        return self.current.settings
+
+    def on_any_event(self, event):
+        paths = (getattr(event, 'src_path', None), getattr(event, 'dest_path', None))
+        if event.event_type in ('created', 'modified', 'moved') and self.path in paths:
+            self.logger.debug(f'Servers file changed on: {event.event_type}')
+            self.schedule()
+
+    def schedule(self):
+        """
+        Reload the servers file once no event has arrived for `debounce` seconds
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self.reload)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
 
     def update(self):
+        """
+        Load the servers file without notifying anybody
+        """
+        self.current = ServerSet(*self._load())
+
+    def reload(self):
+        """
+        Load the servers file and publish what changed
+        """
+        try:
+            servers, settings = self._load()
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f'Could not load servers from {self.path}, keeping the old ones: {e}')
+            return
+
+        current = self.current
+        if servers == current.servers and settings == current.settings:
+            return
+
+        added = [server for server in servers if server not in current.servers]
+        removed = [server for server in current.servers if server not in servers]
+        if added and self.on_added is not None:
+            self.on_added(added)
+        self.current = ServerSet(servers, settings)
+        self.logger.info(f'Updated servers: {len(added)} added, {len(removed)} removed')
+        if removed and self.on_removed is not None:
+            self.on_removed(removed)
+
+    def _load(self) -> Tuple[List[str], Dict[str, dict]]:
         with open(self.path, 'r') as f:
-            self.servers = json.load(f)['servers']
+            entries = json.load(f)['servers']
+
+        servers, settings = [], {}
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = dict(entry)
+                server = entry.pop('url')
+                settings[server] = entry
+            else:
+                server = entry
+            servers.append(server)
+        return servers, settings
 
 
 class VPNProvider:
-
-    def __init__(self, vpn_urls: str, max_users: int = 100, bytes_limit: int = 1000000):
+    """
+    Finds and creates the keys of users on the Outline servers.
+
+    Nothing runs in the background until `start`: watching the servers file,
+    reconciling the index, probing the servers and filling the key pools.
+    A provider that is never started, like the one of apply-limits, only answers calls.
+    """
+
+    def __init__(self, vpn_urls: str, max_users: int = 100, bytes_limit: int = 1000000,
+                 server_timeout: float = 5.0, max_workers: int = 16,
+                 index_path: str = 'vpn_users.sqlite', reconcile_interval: float = 300,
+                 connect_timeout: float = 5.0, read_timeout: float = 10.0,
+                 keys_ttl: float = 60, metrics_ttl: float = 30,
+                 pool_size: int = 0, pool_interval: float = 60, placement: str = 'least-keys',
+                 health_interval: float = 30, failure_threshold: int = 3, reset_timeout: float = 60,
+                 metrics: Optional[Metrics] = None, create_window: float = 0.0,
+                 store: Optional[StateStore] = None, provision_timeout: float = 30,
+                 stream_threshold: int = 5000):
         self.logger = logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.create_window = create_window
+        # shared with the other processes serving the same users, if any
+        self.store = store if store is not None else MemoryStore()
+        self.provision_timeout = provision_timeout
+        self.stream_threshold = stream_threshold
+        # server URL -> streamed pass over its keys that lookups can still join
+        self._surveys: Dict[str, KeySurvey] = {}
+        self._surveys_lock = threading.Lock()
         self.url_path, self.url_filename = os.path.split(vpn_urls)
         self.max_users = max_users
         self.bytes_limit = bytes_limit
+        self.server_timeout = server_timeout
+        # user requests and background jobs get separate pools,
+        # so slow background work never delays a /start
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='outline')
+        self.background = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='outline-background')
+        self.client_timeout = (connect_timeout, read_timeout)
+        # a scan never retries and gives up on a server within server_timeout,
+        # half of it for connecting and half for reading
+        self.scan_timeout = (min(connect_timeout, server_timeout / 2),
+                             min(read_timeout, server_timeout / 2))
+        self.cache = ResponseCache(ttls={ACCESS_KEYS: keys_ttl, METRICS: metrics_ttl})
+        self._clients: Dict[str, OutlineVPN] = {}
+        self._scan_clients: Dict[str, OutlineVPN] = {}
+        self.index = UserIndex(index_path, shared=self.store.shared)
+        self.placement = PlacementEngine(placement)
+        self.reconcile_interval = reconcile_interval
+        self.health_interval = health_interval
+        self.pool_size = pool_size
+        self.health = HealthChecker(self, interval=health_interval,
+                                    failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.pool = KeyPool(self, size=pool_size, interval=pool_interval)
+        # clients of removed servers waiting for their requests in flight, with the timer closing them
+        self._draining: List[Tuple[threading.Timer, List[OutlineVPN]]] = []
+        self._describe_metrics()
 
         self.logger.debug(
             f'Watching {self.url_path} for changes in {self.url_filename}')
         self.configurator = ServersConfigurator(
-            self.url_path, self.url_filename)
+            self.url_path, self.url_filename, on_added=self._warm, on_removed=self._drain)
+        self.observer = None
+
+        self._started = threading.Lock()
+        self._stopped = threading.Event()
+        self.reconciler = threading.Thread(
+            target=self._reconcile_loop, name='index-reconciler', daemon=True)
+
+    def start(self):
+        """
+        Start watching the servers file, the reconciler, the health checker and the key pool;
+        calls after the first do nothing
+        """
+        if not self._started.acquire(blocking=False) or self._stopped.is_set():
+            return
+
+        # loads the platform's file watcher, only needed once the file is watched
+        from watchdog.observers import Observer  # pylint: disable=C0415
 
         self.observer = Observer()
         self.observer.schedule(
             self.configurator, self.url_path, recursive=False)
         self.observer.start()
+        self.reconciler.start()
+        if self.health_interval > 0:
+            self.health.start()
+        if self.pool_size > 0:
+            self.pool.start()
 
     def __del__(self):
         """
-        Destroy the observer
+        Destroy the observer, the background jobs and the fan-out workers
+        """
+        self.close()
+
+    def close(self):
+        """
+        Stop the observer, the reconciler, the health checker, the key pool
+        and the fan-out workers and close the connections
         """
-        self.observer.stop()
-        self.observer.join()
+        if self._stopped.is_set():
+            return
+
+        self._stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        self.configurator.cancel()
+        if self.reconciler.is_alive():
+            self.reconciler.join()
+        self.health.stop()
+        self.pool.stop()
+        self.store.close()
+        self.executor.shutdown(wait=False)
+        self.background.shutdown(wait=False)
+        self.index.close()
+        for client in list(self._clients.values()) + list(self._scan_clients.values()):
+            client.close()
+        for timer, clients in self._draining:
+            timer.cancel()
+            for client in clients:
+                client.close()
 
     def get_client(self, username: str) -> OutlineVPN:
         """
@@ -87,27 +346,14 @@ class VPNProvider:
         :return: OutlineVPN client
 
         If user belongs to a server return OutlineVPN client for that server,
-        otherwise return the client with the least amount of users
+        otherwise return the client with the least amount of users.
+        Known users are resolved from the index without contacting any server.
         """
-        if len(self.configurator.servers) == 0:
-            self.logger.error('No VPN servers found')
-            raise Exception('No VPN servers found')
-
-        vpns: list[OutlineVPN] = []
-        for server in self.configurator.servers:
-            vpn = OutlineVPN(api_url=server)
-            try:
-                for key in vpn.get_keys():
-                    if key.name == username:
-                        return vpn
-            except Exception as e:
-                self.logger.error(
-                    f'Could not connect to {server} with error: {e}')
-                continue
+        entry = self.lookup(username)
+        if entry is not None:
+            return self._client(entry.server)
 
-            vpns.append(vpn)
-
-        return sorted(vpns, key=lambda vpn: len(vpn.get_keys()))[0]
+        return self._scan(username)[0]
 
     def generate_url(self, username: str):
         """
@@ -115,163 +361,566 @@ class VPNProvider:
         :param username:
         :return: new URL if user doesn't have a VPN, 
         or the existing URL if user has been assigned one already
+
+        New users get a key from the server's pool when one is ready,
+        which only takes a rename. A user is provisioned by one process at a time;
+        the others wait and return the key it created.
         """
-        client = self.get_client(username)
+        entry = self.lookup(username)
+        if entry is not None:
+            return VPN_URL_PREFIX + urllib.parse.quote(entry.access_url)
+
+        try:
+            with self.store.lock(f'provision:{username}', timeout=self.provision_timeout):
+                entry = self.lookup(username)
+                if entry is not None:
+                    return VPN_URL_PREFIX + urllib.parse.quote(entry.access_url)
+                return self._provision(username)
+        except LockTimeout:
+            self.logger.error(f'Another process is still provisioning {username}')
+            return None
+
+    def _provision(self, username: str):
+        client, key, users = self._scan(username)
         if client is not None:
-            for key in client.get_keys():
-                if key.name == username:
-                    return VPN_URL_PREFIX + urllib.parse.quote(key.access_url)
+            if key is not None:
+                return VPN_URL_PREFIX + urllib.parse.quote(key.access_url)
 
-            if len(client.get_keys()) >= self.max_users:
+            if users >= self.capacity(client.api_url):
+                self.metrics.inc('vpn_user_limit_reached_total', server=server_label(client.api_url))
                 raise UserLimitReached
 
-            new_key = client.create_key()
-            client.rename_key(new_key.key_id, username)
-            client.add_data_limit(new_key.key_id, self.bytes_limit)
+            new_key = self.pool.take(client.api_url)
+            if new_key is not None and not client.rename_key(new_key.key_id, username):
+                # no longer held by the pool, the key would be left on the server
+                client.delete_key(new_key.key_id)
+                new_key = None
+            if new_key is None:
+                new_key = client.create_key()
+                client.rename_key(new_key.key_id, username)
+                client.add_data_limit(new_key.key_id, self.bytes_limit)
+            self.index.put(IndexEntry(username, client.api_url,
+                                      str(new_key.key_id), new_key.access_url))
+            self.store.incr('server_users', client.api_url)
             return VPN_URL_PREFIX + urllib.parse.quote(new_key.access_url)
         else:
             self.logger.error(f'Could not find a client for {username}')
 
+    def reconcile(self):
+        """
+        Sync the user index with the keys present on every server
+        """
+        vpns = self.clients()
+        fetched_at = time.monotonic()
+        futures = {self.background.submit(vpn.snapshot): vpn for vpn in vpns}
+        for future in as_completed(futures):
+            vpn = futures[future]
+            try:
+                keys = [key for key in future.result().keys if not is_pooled(key.name)]
+                self.index.reconcile(vpn.api_url, keys, fetched_at)
+                self.store.set('server_users', vpn.api_url, str(len(keys)))
+                self.metrics.set('vpn_server_users', len(keys), server=server_label(vpn.api_url))
+            except Exception as e:
+                self.logger.error(
+                    f'Could not reconcile {vpn.api_url} with error: {e}')
+
+    def _reconcile_loop(self):
+        while True:
+            self.reconcile()
+            if self._stopped.wait(self.reconcile_interval):
+                return
+
+    def _observe_request(self, method: str, server: str, seconds: float, status: Optional[int]):
+        label = server_label(server)
+        self.metrics.observe('outline_request_seconds', seconds, method=method, server=label)
+        if status is None or status >= 400:
+            self.metrics.inc('outline_errors_total', method=method, server=label)
+
+    def _describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe('outline_request_seconds', 'histogram', 'Outline API requests by client method and server')
+        metrics.describe('outline_errors_total', 'counter', 'Outline API requests that failed or were refused')
+        metrics.describe('vpn_server_users', 'gauge', 'Keys of users on a server as of its last scan')
+        metrics.describe('vpn_user_limit_reached_total', 'counter', 'New users refused because servers were full')
+        metrics.describe('outline_cache_hits_total', 'counter', 'Outline responses served from the cache')
+        metrics.describe('outline_cache_misses_total', 'counter', 'Outline responses fetched from a server')
+        metrics.describe('outline_coalesced_reads_total', 'counter', 'Reads that waited for the same read in flight')
+        metrics.describe('vpn_server_circuit_open', 'gauge', '1 while a server is skipped by the circuit breaker')
+        metrics.describe('vpn_server_latency_seconds', 'gauge', 'Moving average of successful calls to a server')
+        metrics.describe('vpn_server_error_rate', 'gauge', 'Share of recent calls to a server that failed')
+        metrics.describe('vpn_pool_keys', 'gauge', 'Pre-provisioned keys ready on a server')
+        metrics.describe('vpn_index_users', 'gauge', 'Users in the user index')
+
+        def collect():
+            for endpoint, counts in self.cache.stats().items():
+                yield 'outline_cache_hits_total', {'endpoint': endpoint}, counts['hits']
+                yield 'outline_cache_misses_total', {'endpoint': endpoint}, counts['misses']
+            yield 'outline_coalesced_reads_total', {}, self.cache.flights.coalesced
+            for server, health in self.health.status().items():
+                labels = {'server': server_label(server)}
+                yield 'vpn_server_circuit_open', labels, int(health.state == OPEN)
+                yield 'vpn_server_error_rate', labels, health.error_rate
+                if health.latency is not None:
+                    yield 'vpn_server_latency_seconds', labels, round(health.latency, 6)
+            for server in self.configurator.servers:
+                yield 'vpn_pool_keys', {'server': server_label(server)}, self.pool.available(server)
+            yield 'vpn_index_users', {}, len(self.index)
+
+        metrics.collector(collect)
+
+    def _warm(self, servers: List[str]):
+        """
+        Get added servers ready before they are published: open their clients
+        and load their keys into the cache, the index and the health checker
+        """
+        fetched_at = time.monotonic()
+        futures = {self.background.submit(self.health.call, server, self.scan_client(server).snapshot): server
+                   for server in servers}
+        for future in as_completed(futures):
+            server = futures[future]
+            self._client(server)
+            try:
+                snapshot = future.result()
+            except Exception as e:
+                self.logger.error(f'Could not warm up {server} with error: {e}')
+                continue
+            self.index.reconcile(
+                server, [key for key in snapshot.keys if not is_pooled(key.name)], fetched_at)
+        self.pool.wake()
+        self.logger.debug(f'Warmed up {len(servers)} added servers')
+
+    def _drain(self, servers: List[str]):
+        """
+        Retire removed servers: they are no longer handed out, and their
+        connections are closed once requests already in flight had time to finish
+        """
+        clients = []
+        for server in servers:
+            self.health.forget(server)
+            for pooled in (self._clients, self._scan_clients):
+                client = pooled.pop(server, None)
+                if client is not None:
+                    clients.append(client)
+
+        timer = threading.Timer(sum(self.client_timeout), self._close_drained, args=(clients,))
+        timer.daemon = True
+        self._draining.append((timer, clients))
+        timer.start()
+        self.logger.debug(f'Draining {len(servers)} removed servers')
+
+    def _close_drained(self, clients: List[OutlineVPN]):
+        for client in clients:
+            client.close()
+        self._draining = [entry for entry in self._draining if entry[1] is not clients]
+
+    def _client(self, server: str) -> OutlineVPN:
+        """
+        Get the pooled client of a server, creating it on first use
+        """
+        client = self._clients.get(server)
+        if client is None:
+            client = self._clients.setdefault(
+                server, OutlineVPN(api_url=server, timeout=self.client_timeout, cache=self.cache,
+                                   on_request=self._observe_request, create_window=self.create_window))
+        return client
+
+    def scan_client(self, server: str) -> OutlineVPN:
+        """
+        Get the client used to scan and probe a server, bounded by `server_timeout`;
+        it shares the response cache with the regular client
+        """
+        client = self._scan_clients.get(server)
+        if client is None:
+            client = self._scan_clients.setdefault(
+                server, OutlineVPN(api_url=server, timeout=self.scan_timeout, retries=0, cache=self.cache,
+                                   on_request=self._observe_request))
+        return client
+
+    def clients(self) -> List[OutlineVPN]:
+        """
+        Get the pooled clients of every configured server
+        """
+        return [self._client(server) for server in self.configurator.servers]
+
+    def capacity(self, server: str) -> int:
+        """
+        Most keys a server may hold: its capacity in the servers file, otherwise `max_users`
+        """
+        return int(self.configurator.settings.get(server, {}).get('capacity', self.max_users))
+
+    def weight(self, server: str) -> float:
+        """
+        Relative share of new users a server should get, from the servers file
+        """
+        return float(self.configurator.settings.get(server, {}).get('weight', 1.0))
+
+    def users(self, server: str, counted: int) -> int:
+        """
+        Users on a server: the count from a key list, which may be cached, or the count
+        kept in the store if another process has added users since
+        """
+        stored = self.store.get('server_users', server)
+        return max(counted, int(stored)) if stored is not None else counted
+
+    def lookup(self, username: str) -> Optional[IndexEntry]:
+        """
+        Find where a user's key lives without contacting the servers
+        :param username:
+        :return: the index entry, None if the user is unknown or its server was removed
+        """
+        entry = self.index.get(username)
+        if entry is not None and entry.server in self.configurator.servers:
+            return entry
+        return None
+
+    def _survey(self, server: str, username: str) -> Tuple[Optional[OutlineKey], int, int]:
+        """
+        Look for a user's key on a server and measure its load
+        :return: (the user's key or None, number of users on the server, bytes transferred on it)
+
+        Servers known to hold `stream_threshold` keys or more are read one key at a time
+        without holding the whole list, in a pass shared with the lookups running at the
+        same time; smaller ones share the cached key list. When the key is found
+        on a streamed server the counts cover only the keys read before it.
+        """
+        client = self.scan_client(server)
+        stored = self.store.get('server_users', server)
+        if (int(stored) if stored is not None else 0) < self.stream_threshold:
+            snapshot = client.snapshot()
+            return snapshot.find(username), count_users(snapshot), sum(snapshot.used_by_id.values())
+
+        with self._surveys_lock:
+            survey = self._surveys.get(server)
+            if survey is None or not survey.join(username):
+                survey = KeySurvey()
+                survey.join(username)
+                self._surveys[server] = survey
+                threading.Thread(target=self._run_survey, args=(server, survey, client),
+                                 name='key-survey', daemon=True).start()
+        return survey.result(username)
+
+    def _run_survey(self, server: str, survey: KeySurvey, client: OutlineVPN):
+        try:
+            survey.read(client.iter_keys())
+        finally:
+            with self._surveys_lock:
+                if self._surveys.get(server) is survey:
+                    del self._surveys[server]
+        if survey.complete:
+            # the key pool sizes itself from this count instead of reading the list again
+            self.store.set('server_users', server, str(survey.users))
+
+    def _scan(self, username: str) -> Tuple[Optional[OutlineVPN], Optional[OutlineKey], int]:
+        """
+        Look for a user's key on every server at once
+        :param username:
+        :return: (client, key, number of users on that server) for the server holding
+        the user's key, otherwise (client picked for a new user, None, number of users on it)
+
+        Servers that do not answer within `server_timeout` seconds are skipped,
+        and so are servers whose circuit is open, without waiting for them.
+        The server for a new user is picked by the placement engine from the
+        answers of this scan; when all servers are full the one with the most
+        room is returned so the caller can refuse the user.
+        """
+        if len(self.configurator.servers) == 0:
+            self.logger.error('No VPN servers found')
+            raise Exception('No VPN servers found')
+
+        servers = [server for server in self.configurator.servers if self.health.allow(server)]
+        if len(servers) == 0:
+            self.logger.error(f'Every VPN server is unavailable, cannot serve {username}')
+            return None, None, 0
+
+        futures = {self.executor.submit(self.health.call, server,
+                                        functools.partial(self._survey, server, username)): index
+                   for index, server in enumerate(servers)}
+
+        # (position in the servers file, load) for every server that answered
+        loads: List[Tuple[int, ServerLoad]] = []
+        failed = 0
+        try:
+            for future in as_completed(futures, timeout=self.server_timeout):
+                index = futures[future]
+                try:
+                    key, users, used = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.logger.error(
+                        f'Could not connect to {servers[index]} with error: {e}')
+                    continue
+
+                if key is not None:
+                    self.index.put(IndexEntry(username, servers[index],
+                                              str(key.key_id), key.access_url))
+                    return self._client(servers[index]), key, users
+
+                server = servers[index]
+                loads.append((index, ServerLoad(
+                    server, self.users(server, users), used, self.capacity(server), self.weight(server))))
+        except FutureTimeoutError:
+            self.logger.error(
+                f'{len(futures) - len(loads) - failed} servers did not answer within {self.server_timeout}s')
+        finally:
+            for future in futures:
+                future.cancel()
+
+        if len(loads) == 0:
+            self.logger.error(f'No VPN servers available for {username}')
+            return None, None, 0
+
+        answered = [load for _, load in sorted(loads, key=lambda item: item[0])]
+        for load in answered:
+            self.metrics.set('vpn_server_users', load.users, server=server_label(load.server))
+        load = self.placement.choose(answered)
+        if load is None:
+            load = max(answered, key=lambda load: load.headroom)
+        return self._client(load.server), None, load.users
+
 
 class VPNBot:
 
-    def __init__(self, chat_id: str, dev_chat_id: str, vpn_urls: str, limit: int = 8, max_users: int = 100):
+    def __init__(self, chat_id: str, dev_chat_id: str, vpn_urls: str, limit: int = 8, max_users: int = 100,
+                 server_timeout: float = 5.0, index_path: str = 'vpn_users.sqlite',
+                 connect_timeout: float = 5.0, read_timeout: float = 10.0,
+                 keys_ttl: float = 60, metrics_ttl: float = 30, stats_interval: float = 300,
+                 member_ttl: float = 600, non_member_ttl: float = 60, pool_size: int = 0,
+                 placement: str = 'least-keys', health_interval: float = 30,
+                 failure_threshold: int = 3, reset_timeout: float = 60,
+                 metrics: Optional[Metrics] = None, profiler: Optional[SlowestTraces] = None,
+                 create_window: float = 0.0, idle_days: float = 30, sweep_interval: float = 0,
+                 sweep_batch: int = 20, sweep_pause: float = 1.0, sweep_dry_run: bool = False,
+                 limiter: Optional[RateLimiter] = None, digest_interval: float = 300,
+                 quota_thresholds: Tuple[int, ...] = (80, 100), shared_state: bool = False,
+                 stream_threshold: int = 5000):
         self.logger = logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.profiler = profiler
         self.chat_id = chat_id
         self.dev_chat_id = dev_chat_id
         self.limit = limit
-        self.provider = VPNProvider(vpn_urls, max_users=max_users, bytes_limit=MB_to_bytes(GB_to_MB(limit)))
+        self.provider = VPNProvider(vpn_urls, max_users=max_users, bytes_limit=MB_to_bytes(GB_to_MB(limit)),
+                                    server_timeout=server_timeout, index_path=index_path,
+                                    connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                    keys_ttl=keys_ttl, metrics_ttl=metrics_ttl, pool_size=pool_size,
+                                    placement=placement, health_interval=health_interval,
+                                    failure_threshold=failure_threshold, reset_timeout=reset_timeout,
+                                    metrics=self.metrics, create_window=create_window,
+                                    store=SQLiteStore(index_path) if shared_state else None,
+                                    stream_threshold=stream_threshold)
+        self.outbox = Outbox(dev_chat_id, limiter=limiter, digest_interval=digest_interval)
+        self.usage = UsageStats(self.provider, interval=stats_interval)
+        self.quota = QuotaNotifier(self.provider, self.usage, self.outbox, limit, thresholds=quota_thresholds)
+        self.usage.on_collect = self.quota.check
+        self.user_queue = KeyedQueue()
+        self.members = MembershipCache(ttl=member_ttl, negative_ttl=non_member_ttl, store=self.provider.store)
+        self.chat_title = None
+        self.idle_days = idle_days
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.sweep_pause = sweep_pause
+        self.sweep_dry_run = sweep_dry_run
+        self.sweeper: Optional[KeySweeper] = None
+
+        self.metrics.describe('bot_handler_seconds', 'histogram', 'Time to handle an update, by handler')
+        self.metrics.describe('bot_handlers_in_flight', 'gauge', 'Updates being handled right now')
+        self.metrics.describe('bot_handler_errors_total', 'counter', 'Handlers that raised')
+        self.metrics.describe('bot_membership_cache_hits_total', 'counter', 'Membership checks answered from the cache')
+        self.metrics.describe('bot_membership_cache_misses_total', 'counter', 'Membership checks sent to Telegram')
+        self.metrics.describe('bot_messages_sent_total', 'counter', 'Messages sent to Telegram')
+        self.metrics.describe('bot_messages_queued', 'gauge', 'Notifications and alerts waiting to be sent')
+        self.metrics.describe('bot_messages_dropped_total', 'counter', 'Notifications dropped because the queue was full')
+        self.metrics.describe('bot_alerts_suppressed_total', 'counter', 'Repeated dev chat alerts folded into digests')
+        self.metrics.collector(lambda: [
+            ('bot_membership_cache_hits_total', {}, self.members.hits),
+            ('bot_membership_cache_misses_total', {}, self.members.misses),
+            ('bot_messages_sent_total', {}, self.outbox.sent),
+            ('bot_messages_queued', {}, len(self.outbox)),
+            ('bot_messages_dropped_total', {}, self.outbox.dropped),
+            ('bot_alerts_suppressed_total', {}, self.outbox.suppressed),
+        ])
+
+    def start_background(self):
+        """
+        Start the background work of the provider and the traffic collection;
+        called once the bot receives updates, so a restart answers them sooner
+        """
+        self.provider.start()
+        self.usage.start()
+
+    def start_outbox(self, bot: Bot):
+        """
+        Start sending quota notifications and dev chat alerts
+        :param bot: the bot sending them
+        """
+        self.outbox.start(bot)
 
+    def start_sweeper(self, bot: Bot) -> Optional[KeySweeper]:
+        """
+        Start deleting idle keys and keys of users who left the chat, unless `sweep_interval` is 0
+        :param bot: asked about the members of the chat and sending the summaries to the dev chat
+        :return: the running sweeper
+        """
+        if self.sweep_interval <= 0:
+            return None
+
+        self.sweeper = KeySweeper(
+            self.provider, is_member=lambda user_id: self._is_chat_member(bot, user_id),
+            notify=lambda text: self.outbox.post(self.dev_chat_id, text),
+            idle_days=self.idle_days, interval=self.sweep_interval, batch_size=self.sweep_batch,
+            pause=self.sweep_pause, dry_run=self.sweep_dry_run)
+        self.sweeper.start()
+        return self.sweeper
+
+    @per_user
+    @instrumented
     def start(self, update: Update, context: CallbackContext):
         user = update.effective_user
         try:
-            chat = context.bot.get_chat(chat_id=self.chat_id)
-            member = context.bot.getChatMember(
-                chat_id=self.chat_id, user_id=user.id)
+            if self.chat_title is None:
+                self.chat_title = context.bot.get_chat(chat_id=self.chat_id).title
+            is_member = self._check_member(context, user.id)
         except Exception as e:
             self.logger.error(f'Error getting chat info: {e}')
-            context.bot.sendMessage(
-                chat_id=user.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
+            self.outbox.send(
+                context.bot, chat_id=user.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
             return
 
-        if not self._is_member(member):
+        if not is_member:
             self.logger.info('User does not belong to the group')
-            context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                    text='You do not belong to the group. Ask You Know Who to join.')
+            self.outbox.send(context.bot, chat_id=update.effective_chat.id,
+                             text='You do not belong to the group. Ask You Know Who to join.')
             return
 
-        self.logger.info(f'User belongs to the {chat.title}')
+        self.logger.info(f'User belongs to the {self.chat_title}')
 
         vpn_name = self._create_name(user=user)
         try:
             url = self.provider.generate_url(vpn_name)
         except UserLimitReached:
             self.logger.error(f'User limit reached for {vpn_name}')
-            context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                    text='Превышен лимит пользователей в прокси; попробуйте позже.')
-            context.bot.sendMessage(chat_id=self.dev_chat_id,
-                                    text='No more available VPN resources')
+            self.outbox.send(context.bot, chat_id=update.effective_chat.id,
+                             text='Превышен лимит пользователей в прокси; попробуйте позже.')
+            self.outbox.alert('user-limit', 'No more available VPN resources')
             return
 
         if url is not None:
             self.logger.info(url)
-            context.bot.sendMessage(
-                chat_id=user.id, text=f'''
+            self.outbox.send(
+                context.bot, chat_id=user.id, text=f'''
                 {url} 
                 Перейдите по ссылке для дальнейших инструкций. Если вы хотите оставить отзыв, используйте команду /feedback''', protect_content=True)
         else:
-            context.bot.sendMessage(
-                chat_id=user.id, text=f'Невозможно создать VPN, попробуйте позднее. Если вы хотите оставить отзыв, используйте команду /feedback', protect_content=True)
+            self.outbox.send(
+                context.bot, chat_id=user.id, text=f'Невозможно создать VPN, попробуйте позднее. Если вы хотите оставить отзыв, используйте команду /feedback', protect_content=True)
 
+    @instrumented
     def start_feedback(self, update: Update, context: CallbackContext):
         try:
-            member = context.bot.getChatMember(
-                chat_id=self.chat_id, user_id=update.effective_user.id)
+            is_member = self._check_member(context, update.effective_user.id)
         except Exception as e:
             self.logger.error(f'Error getting chat info: {e}')
-            context.bot.sendMessage(
-                chat_id=update.effective_user.id.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
+            self.outbox.send(
+                context.bot, chat_id=update.effective_user.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
             return
 
-        if not self._is_member(member):
+        if not is_member:
             self.logger.info('User does not belong to the group')
-            context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                    text='You do not belong to the group. Ask You Know Who to join.')
+            self.outbox.send(context.bot, chat_id=update.effective_chat.id,
+                             text='You do not belong to the group. Ask You Know Who to join.')
             return
 
-        update.message.reply_text(
-            'Пожалуйста оставьте ваш отзыв или используйте /cancel для отмены',
-        )
+        self.outbox.send(context.bot, update.effective_chat.id,
+                         'Пожалуйста оставьте ваш отзыв или используйте /cancel для отмены')
         return 0
 
+    @instrumented
     def feedback(self, update: Update, context: CallbackContext):
         user = self._create_name(update.effective_user)
-        context.bot.sendMessage(
-            chat_id=self.dev_chat_id, text=f'User {user} left feedback {update.message.text}')
+        self.outbox.send(
+            context.bot, chat_id=self.dev_chat_id, text=f'User {user} left feedback {update.message.text}')
 
         if self._clean_text(update.message.text):
-            update.message.reply_text('Спасибо за ваш отзыв!')
+            self.outbox.send(context.bot, update.effective_chat.id, 'Спасибо за ваш отзыв!')
         else:
-            update.message.reply_text('Usage: /feedback')
+            self.outbox.send(context.bot, update.effective_chat.id, 'Usage: /feedback')
 
         return ConversationHandler.END
 
+    @instrumented
     def cancel(self, update: Update, context: CallbackContext) -> int:
         """Cancels and ends the conversation."""
         user = update.message.from_user
         name = self._create_name(user=user)
         self.logger.debug(f"User {name} canceled the conversation.")
-        update.message.reply_text(
-            'Thank you for the feedback', reply_markup=ReplyKeyboardRemove()
-        )
+        self.outbox.send(context.bot, update.effective_chat.id,
+                         'Thank you for the feedback', reply_markup=ReplyKeyboardRemove())
 
         return ConversationHandler.END
 
+    @per_user
+    @instrumented
     def stats(self, update: Update, context: CallbackContext):
         try:
-            member = context.bot.getChatMember(
-                chat_id=self.chat_id, user_id=update.effective_user.id)
+            is_member = self._check_member(context, update.effective_user.id)
         except Exception as e:
             self.logger.error(f'Error getting chat info: {e}')
-            context.bot.sendMessage(
-                chat_id=user.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
+            self.outbox.send(
+                context.bot, chat_id=update.effective_user.id, text='Не удалось получить доступ к каналу; попробуйте через несколько секунд')
             return
 
-        if not self._is_member(member):
+        if not is_member:
             self.logger.info('User does not belong to the group')
-            context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                    text='You do not belong to the group. Ask You Know Who to join.')
+            self.outbox.send(context.bot, chat_id=update.effective_chat.id,
+                             text='You do not belong to the group. Ask You Know Who to join.')
             return
 
         user = update.effective_user
         vpn_name = self._create_name(user=user)
         self.logger.info(f'User {vpn_name} requested statistics')
-        vpn = self.provider.get_client(vpn_name)
-        if vpn is None:
-            self.logger.error(
-                f'VPN {vpn_name} not found, server url {vpn}')
-            update.message.reply_text(
-                text='У вас нет активных VPN; Для создания нового используйте /start')
-            return
 
-        all_keys = vpn.get_keys()
-        user_vpns = [vpn for vpn in all_keys if vpn.name == vpn_name]
-        if len(user_vpns) == 1:
-            user_vpn: OutlineVPN = user_vpns[0]
-            if user_vpn.used_bytes:
-                used = bytes_to_MB(user_vpn.used_bytes)
-                used_percent = round(used / GB_to_MB(self.limit) * 100, 2)
-            else:
-                used_percent = 0.0
+        used_bytes, daily = None, None
+        entry = self.provider.lookup(vpn_name)
+        if entry is not None and self.usage.ready:
+            used_bytes = self.usage.usage(entry.server, entry.key_id)
+            daily = self.usage.daily_delta(entry.server, entry.key_id)
+            aggregate = self.usage.fleet
+
+        if used_bytes is None:
+            # the collector has not seen this server yet, ask the server itself
+            vpn = self.provider.get_client(vpn_name)
+            user_vpn = vpn.find_key_by_name(vpn_name) if vpn is not None else None
+            if user_vpn is None:
+                self.logger.error(
+                    f'VPN {vpn_name} not found, server url {vpn}')
+                self.outbox.send(context.bot, update.effective_chat.id,
+                                 text='У вас нет активных VPN; Для создания нового используйте /start')
+                return
 
-            used = [vpn.used_bytes for vpn in all_keys if vpn.used_bytes]
-            update.message.reply_text(
-                f'Вы использовали {used_percent}% трафика от {self.limit} GB.' +
+            used_bytes = user_vpn.used_bytes or 0
+            aggregate = UsageAggregate.from_used(
+                vpn.get_transferred_data()['bytesTransferredByUserId'].values())
+
+        used_percent = round(bytes_to_MB(used_bytes) / GB_to_MB(self.limit) * 100, 2)
+        text = (f'Вы использовали {used_percent}% трафика от {self.limit} GB.' +
                 f' Медианна/Среднестатистическое использование всех пользователей ' +
-                f'{bytes_to_MB(np.median(used))}/{bytes_to_MB(np.mean(used))} MB.')
-        else:
-            update.message.reply_text(
-                text='У вас нет активных VPN; Для создания нового используйте /start')
+                f'{bytes_to_MB(aggregate.median)}/{bytes_to_MB(aggregate.mean)} MB.' +
+                f' Вы используете больше трафика, чем {aggregate.rank(used_bytes)}% пользователей.')
+        if daily is not None:
+            text += f' За последние сутки: {bytes_to_MB(daily)} MB.'
+        self.outbox.send(context.bot, update.effective_chat.id, text)
+
+    @instrumented
+    def on_chat_member(self, update: Update, context: CallbackContext):
+        """Keep the membership cache in sync with joins, leaves and bans in the main chat"""
+        change = update.chat_member
+        if change is None or change.chat.id != self.chat_id:
+            return
+
+        member = change.new_chat_member
+        self.logger.debug(
+            f'User {member.user.id} changed status to {member.status}')
+        self.members.set(member.user.id, self._is_member(member))
 
     def error_handler(self, update: object, context: CallbackContext) -> None:
         """Log the error and send a telegram message to notify the developer."""
@@ -299,8 +948,8 @@ class VPNBot:
 
         # Finally, send the message
         self.logger.error(message)
-        context.bot.send_message(
-            chat_id=update.message.from_user.id, text="Произошла ошибка; попробуйте еще раз")
+        self.outbox.send(
+            context.bot, chat_id=update.message.from_user.id, text="Произошла ошибка; попробуйте еще раз")
 
     def _clean_text(self, text):
         return text.replace('\n', ' ').replace('\r', '').replace('\t', ' ').strip()
@@ -308,5 +957,17 @@ class VPNBot:
     def _create_name(self, user: User):
         return f'{user.first_name}_{user.last_name}_{user.id}'
 
+    def _check_member(self, context: CallbackContext, user_id: int) -> bool:
+        return self._is_chat_member(context.bot, user_id)
+
+    def _is_chat_member(self, bot: Bot, user_id: int) -> bool:
+        is_member = self.members.get(user_id)
+        if is_member is None:
+            member = bot.getChatMember(
+                chat_id=self.chat_id, user_id=user_id)
+            is_member = self._is_member(member)
+            self.members.set(user_id, is_member)
+        return is_member
+
     def _is_member(self, user: ChatMember) -> bool:
-        return user.status != 'left' and user.status != 'banned'
+        return user.status not in (ChatMember.LEFT, ChatMember.KICKED)
@@ -2,13 +2,40 @@
 API wrapper for Outline VPN
 """
 
+import asyncio
+import codecs
+import functools
+import json
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
 from dataclasses import dataclass
-from datetime import timedelta
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
 
 import requests
-import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ACCESS_KEYS = "/access-keys/"
+METRICS = "/metrics/transfer"
+
+DEFAULT_TTLS = {ACCESS_KEYS: 60.0, METRICS: 30.0}
+
+# method reported to the request hook for the reads of each endpoint
+READERS = {ACCESS_KEYS: "get_keys", METRICS: "get_transferred_data"}
+
+# bytes read at a time from a streamed response
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# called after every request with the client method, the API URL, the seconds
+# it took and the status code, None when no answer came
+RequestHook = Callable[[str, str, float, Optional[int]], None]
 
-requests_cache.install_cache('outline_vpn_cache', backend='sqlite', expire_after=timedelta(seconds=60))
 
 @dataclass
 class OutlineKey:
@@ -16,6 +43,16 @@ class OutlineKey:
     Describes a key in the Outline server
     """
 
+    __slots__ = (
+        "key_id",
+        "name",
+        "password",
+        "port",
+        "method",
+        "access_url",
+        "used_bytes",
+    )
+
     key_id: int
     name: str
     password: str
@@ -24,67 +61,430 @@ class OutlineKey:
     access_url: str
     used_bytes: int
 
+    @classmethod
+    def from_json(cls, key: dict, used_bytes: Optional[int]) -> "OutlineKey":
+        """Build a key from its description in the API"""
+        return cls(
+            key_id=key.get("id"),
+            name=key.get("name"),
+            password=key.get("password"),
+            port=key.get("port"),
+            method=key.get("method"),
+            access_url=key.get("accessUrl"),
+            used_bytes=used_bytes,
+        )
+
+
+class KeySnapshot:
+    """
+    The keys of a server joined with their traffic.
+
+    Each response body is parsed once. OutlineKey objects and the NumPy
+    columns are only built when first read.
+    """
+
+    __slots__ = ("records", "used_by_id", "_keys", "_ids", "_used_bytes")
+
+    def __init__(self, records: List[dict], used_by_id: Dict[str, int]):
+        """
+        :param records: the accessKeys list of /access-keys/
+        :param used_by_id: the bytesTransferredByUserId map of /metrics/transfer
+        """
+        self.records = records
+        self.used_by_id = used_by_id
+        self._keys = None
+        self._ids = None
+        self._used_bytes = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def keys(self) -> List[OutlineKey]:
+        """Every key as an OutlineKey"""
+        if self._keys is None:
+            used_by_id = self.used_by_id
+            self._keys = [
+                OutlineKey.from_json(record, used_by_id.get(record.get("id")))
+                for record in self.records
+            ]
+        return self._keys
+
+    @property
+    def ids(self):
+        """Key ids as a NumPy array, aligned with `used_bytes`"""
+        if self._ids is None:
+            import numpy as np  # pylint: disable=C0415
+
+            ids = [record.get("id") for record in self.records]
+            try:
+                self._ids = np.array(ids, dtype=np.int64)
+            except (TypeError, ValueError):
+                self._ids = np.array(ids, dtype=object)
+        return self._ids
+
+    @property
+    def used_bytes(self):
+        """Bytes transferred by every key as a NumPy array, 0 when unknown"""
+        if self._used_bytes is None:
+            import numpy as np  # pylint: disable=C0415
+
+            used_by_id = self.used_by_id
+            self._used_bytes = np.fromiter(
+                (used_by_id.get(record.get("id")) or 0 for record in self.records),
+                dtype=np.int64,
+                count=len(self.records),
+            )
+        return self._used_bytes
+
+    def find(self, name: str) -> Optional[OutlineKey]:
+        """The first key with the given name, without building the others"""
+        for record in self.records:
+            if record.get("name") == name:
+                return OutlineKey.from_json(
+                    record, self.used_by_id.get(record.get("id"))
+                )
+        return None
+
+
+def iter_array(chunks: Iterable[bytes], field: str) -> Iterator[Any]:
+    """
+    Yield the items of an array in a JSON object as the body arrives,
+    holding one item and one chunk in memory at a time
+    :param chunks: the body in UTF-8
+    :param field: name of the array among the object's top-level fields
+    :raise ValueError: if the body is not JSON or has no such array
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, pos, done = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, done
+        if done:
+            return False
+        chunk = next(chunks, None)
+        done = chunk is None
+        buffer = buffer[pos:] + utf8.decode(chunk or b"", final=done)
+        pos = 0
+        return True
+
+    def peek() -> str:
+        # the next character that is not whitespace, without consuming it
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                raise ValueError("Body ended too early")
+
+    def expect(*chars: str) -> str:
+        nonlocal pos
+        char = peek()
+        if char not in chars:
+            raise ValueError(f"Expected {' or '.join(chars)} instead of {char!r}")
+        pos += 1
+        return char
+
+    def value() -> Any:
+        # a value is only complete once something follows it, a number could go on in the next chunk
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                if end < len(buffer) or done:
+                    pos = end
+                    return item
+            except json.JSONDecodeError:
+                if done:
+                    raise
+            fill()
+
+    expect("{")
+    if peek() == "}":
+        raise ValueError(f"No {field} in the body")
+    while True:
+        name = value()
+        expect(":")
+        if name == field:
+            break
+        value()
+        if expect(",", "}") == "}":
+            raise ValueError(f"No {field} in the body")
+
+    expect("[")
+    if peek() == "]":
+        return
+    while True:
+        yield value()
+        if expect(",", "]") == "]":
+            return
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share one call and its result
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, call: Callable[[], Any]) -> Any:
+        """Run the call, or wait for the same call already running"""
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class ResponseCache:
+    """
+    LRU cache of parsed responses with a separate expiry per endpoint.
+
+    Values are shared between callers and must be treated as read-only.
+    Every invalidation bumps the generation of a key, so a read that was
+    in flight during a write cannot put the old value back.
+    Concurrent misses of the same key and generation share one request.
+    """
+
+    def __init__(self, maxsize: int = 256, ttls: Optional[Dict[str, float]] = None):
+        """
+        :param maxsize: responses kept before the least recently used one is evicted
+        :param ttls: seconds a response stays fresh, per endpoint;
+        endpoints that are not listed are not cached
+        """
+        self.maxsize = maxsize
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.hits = {endpoint: 0 for endpoint in self.ttls}
+        self.misses = {endpoint: 0 for endpoint in self.ttls}
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._generations: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self.flights = SingleFlight()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, endpoint: str, key: Hashable) -> Optional[Any]:
+        """Return a fresh cached value or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+            return None
+
+    def generation(self, key: Hashable) -> int:
+        """Number of times the key was invalidated, read before fetching a value"""
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set(
+        self, endpoint: str, key: Hashable, value: Any, generation: Optional[int] = None
+    ):
+        """
+        Store a value for the endpoint's time to live
+        :param generation: generation of the key when the value was fetched;
+        the value is dropped if the key was invalidated since
+        """
+        ttl = self.ttls.get(endpoint, 0)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                return
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        """Drop cached values"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit and miss counters per endpoint"""
+        with self._lock:
+            return {
+                endpoint: {
+                    "hits": self.hits.get(endpoint, 0),
+                    "misses": self.misses.get(endpoint, 0),
+                }
+                for endpoint in set(self.hits) | set(self.misses)
+            }
+
 
 class OutlineVPN:
     """
     An Outline VPN connection
     """
 
-    def __init__(self, api_url: str):
+    def __init__(
+        self,
+        api_url: str,
+        timeout: Union[float, Tuple[float, float]] = (5, 10),
+        retries: int = 2,
+        backoff_factor: float = 0.3,
+        pool_size: int = 10,
+        cache: Optional[ResponseCache] = None,
+        on_request: Optional[RequestHook] = None,
+        create_window: float = 0.0,
+    ):
+        """
+        :param api_url: management API URL of the server
+        :param timeout: seconds to wait for a connection and for a response,
+        either as one number or as a (connect, read) pair
+        :param retries: how many times a failed connection or a 5xx answer is retried;
+        key creation is never retried so a lost answer cannot create two keys
+        :param backoff_factor: base of the exponential delay between retries
+        :param pool_size: keep-alive connections kept open to the server
+        :param cache: cache for the key list and metrics, may be shared between servers;
+        a private one is created when omitted
+        :param on_request: called after every request, to collect latencies and errors
+        :param create_window: seconds keys requested together are collected for, to be
+        created one after another by a single thread; 0 creates every key right away
+        """
         self.api_url = api_url
+        self.timeout = timeout
+        self.on_request = on_request
+        self.create_window = create_window
+        self._creations: "queue.Queue[Optional[Future]]" = queue.Queue()
+        self._creator: Optional[threading.Thread] = None
+        self._creator_lock = threading.Lock()
+        self._closed = False
+        self.cache = cache if cache is not None else ResponseCache()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "PUT", "DELETE"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the pooled connections and stop creating keys"""
+        with self._creator_lock:
+            self._closed = True
+            if self._creator is not None:
+                self._creations.put(None)
+        self.session.close()
 
     def get_keys(self):
         """Get all keys in the outline server"""
-        response = requests.get(f"{self.api_url}/access-keys/", verify=False)
-        if response.status_code == 200 and "accessKeys" in response.json():
-            response_metrics = requests.get(
-                f"{self.api_url}/metrics/transfer", verify=False
-            )
-            if (
-                response_metrics.status_code >= 400
-                or "bytesTransferredByUserId" not in response_metrics.json()
-            ):
-                raise Exception("Unable to get metrics")
-
-            response_json = response.json()
-            result = []
-            for key in response_json.get("accessKeys"):
-                result.append(
-                    OutlineKey(
-                        key_id=key.get("id"),
-                        name=key.get("name"),
-                        password=key.get("password"),
-                        port=key.get("port"),
-                        method=key.get("method"),
-                        access_url=key.get("accessUrl"),
-                        used_bytes=response_metrics.json()
-                        .get("bytesTransferredByUserId")
-                        .get(key.get("id")),
-                    )
-                )
-            return result
-        raise Exception("Unable to retrieve keys")
+        return self.snapshot().keys
+
+    def snapshot(self) -> KeySnapshot:
+        """Get all keys in the outline server together with their traffic"""
+        keys = self._get_json(ACCESS_KEYS)
+        if keys is None or "accessKeys" not in keys:
+            raise Exception("Unable to retrieve keys")
+
+        metrics = self._get_json(METRICS)
+        if metrics is None or "bytesTransferredByUserId" not in metrics:
+            raise Exception("Unable to get metrics")
+
+        return KeySnapshot(
+            keys.get("accessKeys"), metrics.get("bytesTransferredByUserId")
+        )
+
+    def iter_keys(self) -> Iterator[OutlineKey]:
+        """
+        Yield the keys of the server one at a time, with their traffic.
+
+        A fresh cached key list is read from memory. Otherwise the response
+        is parsed as it arrives and only the key being yielded is kept,
+        so the list is not cached either.
+        """
+        used_by_id = self.get_transferred_data()["bytesTransferredByUserId"]
+        for record in self._iter_records():
+            yield OutlineKey.from_json(record, used_by_id.get(record.get("id")))
+
+    def find_key_by_name(self, name: str) -> Optional[OutlineKey]:
+        """The first key with the given name, reading the key list only up to it"""
+        for record in self._iter_records():
+            if record.get("name") == name:
+                used_by_id = self.get_transferred_data()["bytesTransferredByUserId"]
+                return OutlineKey.from_json(record, used_by_id.get(record.get("id")))
+        return None
+
+    def count_keys(self, where: Optional[Callable[[dict], bool]] = None) -> int:
+        """
+        Number of keys on the server, without building them
+        :param where: counts only the keys whose description in the API it accepts
+        """
+        return sum(1 for record in self._iter_records() if where is None or where(record))
 
     def create_key(self) -> OutlineKey:
         """Create a new key"""
-        response = requests.post(f"{self.api_url}/access-keys/", verify=False)
-        if response.status_code == 201:
-            key = response.json()
-            return OutlineKey(
-                key_id=key.get("id"),
-                name=key.get("name"),
-                password=key.get("password"),
-                port=key.get("port"),
-                method=key.get("method"),
-                access_url=key.get("accessUrl"),
-                used_bytes=0,
-            )
+        if self.create_window <= 0:
+            try:
+                return self._post_key()
+            finally:
+                self._invalidate(ACCESS_KEYS)
 
-        raise Exception("Unable to create key")
+        future: Future = Future()
+        with self._creator_lock:
+            if self._closed:
+                raise Exception("Unable to create key, the client is closed")
+            if self._creator is None:
+                self._creator = threading.Thread(
+                    target=self._create_loop, name="outline-create", daemon=True
+                )
+                self._creator.start()
+            self._creations.put(future)
+        return future.result()
 
     def delete_key(self, key_id: int) -> bool:
         """Delete a key"""
-        response = requests.delete(f"{self.api_url}/access-keys/{key_id}", verify=False)
+        response = self._request(
+            "delete_key", self.session.delete, f"{self.api_url}/access-keys/{key_id}"
+        )
+        self._invalidate(ACCESS_KEYS, METRICS)
         return response.status_code == 204
 
     def rename_key(self, key_id: int, name: str):
@@ -93,33 +493,231 @@ class OutlineVPN:
             "name": (None, name),
         }
 
-        response = requests.put(
-            f"{self.api_url}/access-keys/{key_id}/name", files=files, verify=False
+        response = self._request(
+            "rename_key",
+            self.session.put,
+            f"{self.api_url}/access-keys/{key_id}/name",
+            files=files,
         )
+        self._invalidate(ACCESS_KEYS)
         return response.status_code == 204
 
     def add_data_limit(self, key_id: int, limit_bytes: int) -> bool:
         """Set data limit for a key (in bytes)"""
         data = {"limit": {"bytes": limit_bytes}}
 
-        response = requests.put(
-            f"{self.api_url}/access-keys/{key_id}/data-limit", json=data, verify=False
+        response = self._request(
+            "add_data_limit",
+            self.session.put,
+            f"{self.api_url}/access-keys/{key_id}/data-limit",
+            json=data,
         )
+        self._invalidate(ACCESS_KEYS)
         return response.status_code == 204
 
     def delete_data_limit(self, key_id: int) -> bool:
         """Removes data limit for a key"""
-        response = requests.delete(
-            f"{self.api_url}/access-keys/{key_id}/data-limit", verify=False
+        response = self._request(
+            "delete_data_limit",
+            self.session.delete,
+            f"{self.api_url}/access-keys/{key_id}/data-limit",
         )
+        self._invalidate(ACCESS_KEYS)
         return response.status_code == 204
 
+    def get_server_info(self) -> dict:
+        """Get the name and settings of the server, a cheap call to check it is up"""
+        response = self._request("get_server_info", self.session.get, f"{self.api_url}/server")
+        if response.status_code >= 400:
+            raise Exception("Unable to get server information")
+        return response.json()
+
     def get_transferred_data(self):
         """Gets how much data all keys have used"""
-        response = requests.get(f"{self.api_url}/metrics/transfer", verify=False)
-        if (
-            response.status_code >= 400
-            or "bytesTransferredByUserId" not in response.json()
-        ):
+        metrics = self._get_json(METRICS)
+        if metrics is None or "bytesTransferredByUserId" not in metrics:
             raise Exception("Unable to get metrics")
-        return response.json()
+        return metrics
+
+    def _post_key(self) -> OutlineKey:
+        response = self._request(
+            "create_key", self.session.post, f"{self.api_url}/access-keys/"
+        )
+        if response.status_code == 201:
+            return OutlineKey.from_json(response.json(), 0)
+
+        raise Exception("Unable to create key")
+
+    def _create_loop(self):
+        """Create the keys requested within each window, one after another"""
+        stopping = False
+        while not stopping:
+            first = self._creations.get()
+            if first is None:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.create_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    future = self._creations.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if future is None:
+                    stopping = True
+                    break
+                batch.append(future)
+
+            results = []
+            for future in batch:
+                try:
+                    results.append((future, self._post_key(), None))
+                except Exception as e:  # pylint: disable=W0703
+                    results.append((future, None, e))
+            # one invalidation for the whole batch, before anybody sees the new keys
+            self._invalidate(ACCESS_KEYS)
+            for future, key, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(key)
+
+    def _iter_records(self) -> Iterator[dict]:
+        """The descriptions of the keys, from the cache or streamed from the server"""
+        url = f"{self.api_url}{ACCESS_KEYS}"
+        body = self.cache.get(ACCESS_KEYS, url)
+        if body is not None:
+            yield from body["accessKeys"]
+            return
+
+        response = self._request(READERS[ACCESS_KEYS], self.session.get, url, stream=True)
+        try:
+            if response.status_code >= 400:
+                raise Exception("Unable to retrieve keys")
+            try:
+                yield from iter_array(response.iter_content(CHUNK_SIZE), "accessKeys")
+            except ValueError as e:
+                raise Exception(f"Unable to retrieve keys: {e}") from e
+        finally:
+            response.close()
+
+    def _get_json(self, endpoint: str) -> Optional[dict]:
+        """
+        Read an endpoint through the cache, None if the server refused;
+        concurrent misses share one request
+        """
+        url = f"{self.api_url}{endpoint}"
+        body = self.cache.get(endpoint, url)
+        if body is not None:
+            return body
+
+        generation = self.cache.generation(url)
+        return self.cache.flights.do(
+            (url, generation), lambda: self._fetch_json(endpoint, url, generation)
+        )
+
+    def _fetch_json(self, endpoint: str, url: str, generation: int) -> Optional[dict]:
+        response = self._request(READERS.get(endpoint, endpoint), self.session.get, url)
+        if response.status_code >= 400:
+            return None
+
+        body = response.json()
+        self.cache.set(endpoint, url, body, generation)
+        return body
+
+    def _request(self, method: str, send: Callable, url: str, **kwargs):
+        """Send a request with the client's timeout and report it to the hook"""
+        if self.on_request is None:
+            return send(url, timeout=self.timeout, **kwargs)
+
+        started = time.monotonic()
+        status = None
+        try:
+            response = send(url, timeout=self.timeout, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.on_request(method, self.api_url, time.monotonic() - started, status)
+
+    def _invalidate(self, *endpoints: str):
+        self.cache.invalidate(*(f"{self.api_url}{endpoint}" for endpoint in endpoints))
+
+
+class AsyncOutlineVPN:
+    """
+    An Outline VPN connection for asyncio code.
+
+    Calls go through a pooled OutlineVPN client on an executor,
+    so the keep-alive connections, the response cache and the shared
+    requests are the same as for synchronous callers.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        executor: Optional[Executor] = None,
+        client: Optional[OutlineVPN] = None,
+        **kwargs,
+    ):
+        self.client = client or OutlineVPN(api_url, **kwargs)
+        self.api_url = self.client.api_url
+        self.executor = executor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the pooled connections"""
+        self.client.close()
+
+    async def _run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(method, *args)
+        )
+
+    async def get_keys(self):
+        """Get all keys in the outline server"""
+        return await self._run(self.client.get_keys)
+
+    async def snapshot(self) -> KeySnapshot:
+        """Get all keys in the outline server together with their traffic"""
+        return await self._run(self.client.snapshot)
+
+    async def find_key_by_name(self, name: str) -> Optional[OutlineKey]:
+        """The first key with the given name"""
+        return await self._run(self.client.find_key_by_name, name)
+
+    async def create_key(self) -> OutlineKey:
+        """Create a new key"""
+        return await self._run(self.client.create_key)
+
+    async def delete_key(self, key_id: int) -> bool:
+        """Delete a key"""
+        return await self._run(self.client.delete_key, key_id)
+
+    async def rename_key(self, key_id: int, name: str):
+        """Rename a key"""
+        return await self._run(self.client.rename_key, key_id, name)
+
+    async def add_data_limit(self, key_id: int, limit_bytes: int) -> bool:
+        """Set data limit for a key (in bytes)"""
+        return await self._run(self.client.add_data_limit, key_id, limit_bytes)
+
+    async def delete_data_limit(self, key_id: int) -> bool:
+        """Removes data limit for a key"""
+        return await self._run(self.client.delete_data_limit, key_id)
+
+    async def get_server_info(self) -> dict:
+        """Get the name and settings of the server"""
+        return await self._run(self.client.get_server_info)
+
+    async def get_transferred_data(self):
+        """Gets how much data all keys have used"""
+        return await self._run(self.client.get_transferred_data)
@@ -0,0 +1,275 @@
+"""
+Unit tests for the API wrapper that do not need a live server
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from outline.outline_vpn import (
+    ACCESS_KEYS,
+    METRICS,
+    AsyncOutlineVPN,
+    KeySnapshot,
+    OutlineKey,
+    OutlineVPN,
+    ResponseCache,
+    iter_array,
+)
+
+
+class FakeResponse:
+    """A canned HTTP response"""
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        """Returns the canned body"""
+        return self.body
+
+    def iter_content(self, chunk_size):  # pylint: disable=W0613
+        """Sends the body a few bytes at a time"""
+        raw = json.dumps(self.body).encode()
+        for start in range(0, len(raw), 5):
+            yield raw[start:start + 5]
+
+    def close(self):
+        """Nothing to release"""
+
+
+class FakeSession:
+    """Answers like an Outline server with one key and counts the requests"""
+
+    def __init__(self):
+        self.requests = []
+        self.name = "first"
+
+    def get(self, url, **kwargs):
+        """Serves the key list and the metrics"""
+        self.requests.append(("STREAM" if kwargs.get("stream") else "GET", url))
+        if url.endswith(ACCESS_KEYS):
+            return FakeResponse(200, {"accessKeys": [{"id": "0", "name": self.name}]})
+        return FakeResponse(200, {"bytesTransferredByUserId": {"0": 42}})
+
+    def put(self, url, **kwargs):
+        """Renames the key"""
+        self.requests.append(("PUT", url))
+        self.name = kwargs["files"]["name"][1]
+        return FakeResponse(204)
+
+
+class RecordingClient:
+    """Remembers the calls it receives"""
+
+    api_url = "https://127.0.0.1:1234/secret"
+
+    def __init__(self):
+        self.calls = []
+
+    def rename_key(self, key_id, name):
+        """Pretends to rename a key"""
+        self.calls.append(("rename_key", key_id, name))
+        return True
+
+    def close(self):
+        """Pretends to close the connections"""
+        self.calls.append(("close",))
+
+
+def test_async_client_delegates():
+    """The async client runs the pooled client's methods"""
+    recording = RecordingClient()
+
+    async def rename():
+        async with AsyncOutlineVPN(recording.api_url, client=recording) as client:
+            return await client.rename_key(1, "name")
+
+    assert asyncio.run(rename())
+    assert recording.calls == [("rename_key", 1, "name"), ("close",)]
+
+
+def test_session_is_pooled():
+    """Every call of a client goes through one session with retries"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret", retries=4)
+    adapter = client.session.get_adapter(client.api_url)
+    assert client.session.verify is False
+    assert adapter.max_retries.total == 4
+    assert "POST" not in adapter.max_retries.allowed_methods
+    client.close()
+
+
+def test_cache_expiry_and_eviction():
+    """Entries expire per endpoint and the least recently used is evicted"""
+    cache = ResponseCache(maxsize=2, ttls={METRICS: 0})
+    cache.set(METRICS, "metrics", {})
+    assert cache.get(METRICS, "metrics") is None
+
+    cache.set(ACCESS_KEYS, "a", 1)
+    cache.set(ACCESS_KEYS, "b", 2)
+    assert cache.get(ACCESS_KEYS, "a") == 1
+    cache.set(ACCESS_KEYS, "c", 3)
+    assert cache.get(ACCESS_KEYS, "b") is None
+    assert cache.stats()[ACCESS_KEYS] == {"hits": 1, "misses": 1}
+
+
+def test_writes_invalidate_cache():
+    """Reads are served from the cache until a write changes the keys"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret")
+    client.session = FakeSession()
+
+    assert client.get_keys()[0].used_bytes == 42
+    assert client.get_keys()[0].name == "first"
+    assert len(client.session.requests) == 2
+
+    assert client.rename_key("0", "second")
+    assert client.get_keys()[0].name == "second"
+    assert [method for method, _ in client.session.requests] == [
+        "GET",
+        "GET",
+        "PUT",
+        "GET",
+    ]
+
+
+def test_snapshot_columns():
+    """A snapshot joins traffic by id and builds keys only on demand"""
+    snapshot = KeySnapshot(
+        [{"id": "0", "name": "a"}, {"id": "1", "name": "b"}, {"id": "5", "name": "c"}],
+        {"1": 10, "5": 20},
+    )
+    assert snapshot.ids.tolist() == [0, 1, 5]
+    assert snapshot.used_bytes.tolist() == [0, 10, 20]
+    assert snapshot.find("b").used_bytes == 10
+    assert snapshot.find("z") is None
+    assert snapshot._keys is None  # pylint: disable=W0212
+    assert [key.used_bytes for key in snapshot.keys] == [None, 10, 20]
+    assert not hasattr(OutlineKey.from_json({}, 0), "__dict__")
+
+
+def test_read_racing_a_write_is_not_cached():
+    """A key list fetched while a key is renamed does not outlive the rename"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret")
+    client.session = FakeSession()
+    get = client.session.get
+
+    def get_then_rename(url, **kwargs):
+        response = get(url, **kwargs)
+        if url.endswith(ACCESS_KEYS) and client.session.name == "first":
+            client.rename_key("0", "second")
+        return response
+
+    client.session.get = get_then_rename
+    assert client.get_keys()[0].name == "first"
+    assert client.get_keys()[0].name == "second"
+
+
+def test_request_hook():
+    """Every request that reaches the server is reported with its method and status"""
+    reported = []
+    client = OutlineVPN(
+        api_url="https://127.0.0.1:1234/secret",
+        on_request=lambda method, url, seconds, status: reported.append((method, status)),
+    )
+    client.session = FakeSession()
+
+    client.get_keys()
+    client.get_keys()
+    client.rename_key("0", "second")
+    assert reported == [
+        ("get_keys", 200),
+        ("get_transferred_data", 200),
+        ("rename_key", 204),
+    ]
+
+
+def test_concurrent_reads_share_one_request():
+    """Identical reads in flight at the same time send one request per endpoint"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret")
+    client.session = FakeSession()
+    get = client.session.get
+    release = threading.Event()
+
+    def slow_get(url, **kwargs):
+        release.wait(1)
+        return get(url, **kwargs)
+
+    client.session.get = slow_get
+    threads = [threading.Thread(target=client.get_keys) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while client.cache.flights.coalesced < 7:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert client.session.requests == [
+        ("GET", f"{client.api_url}{ACCESS_KEYS}"),
+        ("GET", f"{client.api_url}{METRICS}"),
+    ]
+
+
+def test_key_creation_is_batched():
+    """Keys requested together are created one after another by one thread"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret", create_window=0.05)
+    running = []
+    created = []
+
+    def post(url, **kwargs):
+        running.append(threading.current_thread().name)
+        created.append(str(len(created)))
+        return FakeResponse(201, {"id": created[-1], "accessUrl": "ss://"})
+
+    client.session.post = post
+    keys = []
+    threads = [
+        threading.Thread(target=lambda: keys.append(client.create_key().key_id))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+
+    assert sorted(keys) == ["0", "1", "2", "3", "4"]
+    assert set(running) == {"outline-create"}
+
+
+def test_array_is_parsed_across_chunks():
+    """Items are found whatever the chunk boundaries, other fields are skipped"""
+    body = json.dumps({
+        "before": [1, {"accessKeys": []}, 12345],
+        "accessKeys": [{"id": str(i), "name": f"ключ {i}", "n": i * 1.5} for i in range(50)],
+        "after": True,
+    }).encode()
+    for size in (1, 2, 7, 64, len(body)):
+        chunks = [body[start:start + size] for start in range(0, len(body), size)]
+        assert list(iter_array(chunks, "accessKeys")) == json.loads(body)["accessKeys"]
+
+    assert not list(iter_array([b'{"accessKeys": [ ]}'], "accessKeys"))
+    for bad in (b'{"other": []}', b'{"accessKeys": [{"id": "0"}', b"[]"):
+        with pytest.raises(ValueError):
+            list(iter_array([bad], "accessKeys"))
+
+
+def test_keys_are_streamed_unless_cached():
+    """Streaming reads do not fill the cache and use it when it is fresh"""
+    client = OutlineVPN(api_url="https://127.0.0.1:1234/secret")
+    client.session = FakeSession()
+
+    assert client.find_key_by_name("first").used_bytes == 42
+    assert client.find_key_by_name("other") is None
+    assert client.count_keys() == 1
+    assert client.count_keys(lambda record: record["name"] != "first") == 0
+    assert [method for method, _ in client.session.requests].count("STREAM") == 4
+
+    client.get_keys()
+    requests = len(client.session.requests)
+    assert [key.name for key in client.iter_keys()] == ["first"]
+    assert len(client.session.requests) == requests
@@ -0,0 +1,35 @@
+import functools
+import threading
+
+from telegram.ext import Dispatcher
+from telegram.ext.utils.promise import Promise
+
+
+class BoundedDispatcher(Dispatcher):
+    """
+    Dispatcher that runs at most `max_in_flight` asynchronous handlers at once.
+
+    Handing over another run_async handler blocks until one of the running ones
+    finishes, so updates wait upstream instead of piling up in the worker queue.
+    """
+
+    def __init__(self, *args, max_in_flight: int = 16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def run_async(self, func, *args, update=None, **kwargs) -> Promise:
+        self._in_flight.acquire()
+
+        # released by the job itself: Promise skips its done callbacks when the job raises
+        @functools.wraps(func)
+        def bounded(*job_args, **job_kwargs):
+            try:
+                return func(*job_args, **job_kwargs)
+            finally:
+                self._in_flight.release()
+
+        try:
+            return super().run_async(bounded, *args, update=update, **kwargs)
+        except Exception:
+            self._in_flight.release()
+            raise
@@ -2,9 +2,21 @@ import logging
 import requests
 import argparse
 import os
+import sys
 
-from bot.vpn_bot import VPNBot
-from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, Filters
+from bot.limits import LimitApplier
+from bot.metrics import Metrics, SlowestTraces
+from bot.outbox import RateLimiter
+from bot.placement import STRATEGIES
+from bot.vpn_bot import GB_to_MB, MB_to_bytes, VPNBot, VPNProvider
+from queue import Queue
+
+from vpn_bot.dispatcher import BoundedDispatcher
+from vpn_bot.metrics_server import MetricsServer
+from vpn_bot.webhook import WebhookServer
+from telegram import Bot, Update
+from telegram.utils.request import Request
+from telegram.ext import Updater, ChatMemberHandler, CommandHandler, MessageHandler, ConversationHandler, Filters
 
 
 requests.packages.urllib3.disable_warnings()
@@ -13,7 +25,48 @@ TOKEN = os.getenv('TELEGRAM_TOKEN')
 VPN_LIMIT_GB = 10
 
 
+def apply_limits(argv=None) -> int:
+    """
+    Set the data limit of every existing key to --limit and exit
+    :return: exit status, 1 when some keys or servers could not be updated
+    """
+    parser = argparse.ArgumentParser(prog='apply-limits',
+                                     description='Set the data limit of every existing key to --limit')
+    parser.add_argument('--servers', type=str,
+                        help='absolute path to JSON File with the servers list', required=True)
+    parser.add_argument('--limit', type=int,
+                        help='Limit for VPN', default=VPN_LIMIT_GB, required=False)
+    parser.add_argument('--index', type=str, default='vpn_users.sqlite',
+                        help='Path of the SQLite user index', required=False)
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Data limit requests in flight per server', required=False)
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Attempts after the first for every key', required=False)
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only count the keys that would change')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    provider = VPNProvider(args.servers, bytes_limit=MB_to_bytes(GB_to_MB(args.limit)),
+                           index_path=args.index, health_interval=0)
+    try:
+        def progress(done, total):
+            if done * 100 // total != (done - 1) * 100 // total:
+                print(f'\r{done}/{total} keys', end='' if done < total else '\n', file=sys.stderr, flush=True)
+
+        applier = LimitApplier(provider, concurrency=args.concurrency, retries=args.retries, progress=progress)
+        report = applier.apply(provider.bytes_limit, dry_run=args.dry_run)
+    finally:
+        provider.close()
+
+    print(report.summary())
+    return 1 if report.failed or report.skipped else 0
+
+
 def launch():
+    if len(sys.argv) > 1 and sys.argv[1] == 'apply-limits':
+        sys.exit(apply_limits(sys.argv[2:]))
+
     argparse.ArgumentParser(description='Outline VPN Telegram Bot')
     parser = argparse.ArgumentParser()
     parser.add_argument('--chat_id', type=int, help='Chat ID', required=True)
@@ -25,6 +78,91 @@ def launch():
                         help='absolute path to JSON File with the servers list', required=True)
     parser.add_argument('--max_users', type=int, default=100,
                         help='Max users per VPN server', required=False)
+    parser.add_argument('--server_timeout', type=float, default=5.0,
+                        help='Seconds to wait for every VPN server to answer', required=False)
+    parser.add_argument('--connect_timeout', type=float, default=5.0,
+                        help='Seconds to wait for a connection to a VPN server', required=False)
+    parser.add_argument('--read_timeout', type=float, default=10.0,
+                        help='Seconds to wait for a VPN server to respond', required=False)
+    parser.add_argument('--keys_ttl', type=float, default=60,
+                        help='Seconds a server key list is cached for', required=False)
+    parser.add_argument('--metrics_ttl', type=float, default=30,
+                        help='Seconds a server traffic report is cached for', required=False)
+    parser.add_argument('--stats_interval', type=float, default=300,
+                        help='Seconds between collections of the traffic statistics', required=False)
+    parser.add_argument('--member_ttl', type=float, default=600,
+                        help='Seconds a confirmed chat member is trusted without asking Telegram', required=False)
+    parser.add_argument('--non_member_ttl', type=float, default=60,
+                        help='Seconds a user outside the chat is remembered as such', required=False)
+    parser.add_argument('--pool_size', type=int, default=3,
+                        help='Unassigned keys kept ready on every server for new users', required=False)
+    parser.add_argument('--placement', type=str, choices=sorted(STRATEGIES), default='least-keys',
+                        help='How the server of a new user is picked', required=False)
+    parser.add_argument('--health_interval', type=float, default=30,
+                        help='Seconds between health probes of every server, 0 to turn them off', required=False)
+    parser.add_argument('--failure_threshold', type=int, default=3,
+                        help='Failures in a row after which a server is skipped', required=False)
+    parser.add_argument('--reset_timeout', type=float, default=60,
+                        help='Seconds a failing server is skipped before it is tried again', required=False)
+    parser.add_argument('--metrics_port', type=int, default=0,
+                        help='Port of the Prometheus metrics endpoint, 0 to turn it off', required=False)
+    parser.add_argument('--metrics_listen', type=str, default='127.0.0.1',
+                        help='Address the metrics endpoint binds to', required=False)
+    parser.add_argument('--profile_slowest', type=int, default=0,
+                        help='Keep stack samples of this many slowest updates, 0 to turn profiling off',
+                        required=False)
+    parser.add_argument('--create_window', type=float, default=0.02,
+                        help='Seconds key creations are collected for before being sent to a server one by one',
+                        required=False)
+    parser.add_argument('--sweep_interval', type=float, default=0,
+                        help='Seconds between sweeps deleting idle keys and keys of users who left the chat, '
+                             '0 to keep every key', required=False)
+    parser.add_argument('--idle_days', type=float, default=30,
+                        help='Days without traffic after which the sweeper deletes a key, 0 to keep idle keys',
+                        required=False)
+    parser.add_argument('--sweep_batch', type=int, default=20,
+                        help='Keys the sweeper deletes on a server before pausing', required=False)
+    parser.add_argument('--sweep_pause', type=float, default=1.0,
+                        help='Seconds between batches of deleted keys', required=False)
+    parser.add_argument('--sweep_dry_run', action='store_true',
+                        help='Only report the keys the sweeper would delete to the dev chat')
+    parser.add_argument('--message_rate', type=float, default=30,
+                        help='Messages a second the bot sends to all chats together', required=False)
+    parser.add_argument('--digest_interval', type=float, default=300,
+                        help='Seconds repeated dev chat alerts are collected into one message', required=False)
+    parser.add_argument('--quota_thresholds', type=str, default='80,100',
+                        help='Comma separated shares of the limit in percent users are told about, '
+                             'empty to tell nobody', required=False)
+    parser.add_argument('--stream_threshold', type=int, default=5000,
+                        help='Keys on a server from which a new user is looked up by reading its key list '
+                             'as a stream instead of caching it, 0 to always stream')
+    parser.add_argument('--shared_state', action='store_true',
+                        help='Share users, memberships, server counters and locks with other bot processes '
+                             'using the same --index file')
+    parser.add_argument('--apply_limits', action='store_true',
+                        help='Set the data limit of existing keys to --limit in the background on start')
+    parser.add_argument('--index', type=str, default='vpn_users.sqlite',
+                        help='path to the SQLite file mapping users to their VPN keys', required=False)
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of updates handled at once', required=False)
+    parser.add_argument('--mode', type=str, choices=('polling', 'webhook'), default='polling',
+                        help='How updates are received from Telegram', required=False)
+    parser.add_argument('--webhook_listen', type=str, default='127.0.0.1',
+                        help='Address the webhook listener binds to', required=False)
+    parser.add_argument('--webhook_port', type=int, default=8443,
+                        help='Port the webhook listener binds to', required=False)
+    parser.add_argument('--webhook_path', type=str, default='/telegram',
+                        help='Path Telegram posts updates to', required=False)
+    parser.add_argument('--webhook_url', type=str, default=None,
+                        help='Public URL of the webhook; registered with Telegram when given', required=False)
+    parser.add_argument('--webhook_secret', type=str, default=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+                        help='Secret token Telegram has to send with every update', required=False)
+    parser.add_argument('--webhook_queue_size', type=int, default=1000,
+                        help='Updates waiting for a worker before Telegram is asked to retry', required=False)
+    parser.add_argument('--tg_read_timeout', type=float, default=7,
+                        help='Seconds to wait for Telegram to respond', required=False)
+    parser.add_argument('--tg_connect_timeout', type=float, default=9,
+                        help='Seconds to wait for a connection to Telegram', required=False)
     parser.add_argument('--log_file', type=str, default='/var/log/tg_bot.log',
                         help='absolute path to JSON File with the servers list', required=False)
     parser.add_argument('--log_level', type=int, default=logging.INFO,
@@ -37,27 +175,84 @@ def launch():
                         datefmt='%H:%M:%S',
                         level=args.log_level)
 
+    metrics = Metrics()
+    profiler = None
+    if args.profile_slowest > 0:
+        profiler = SlowestTraces(keep=args.profile_slowest)
+        profiler.start()
+
     bot = VPNBot(chat_id=args.chat_id, dev_chat_id=args.dev_chat_id,
-                 vpn_urls=args.servers, limit=args.limit, max_users=args.max_users)
+                 vpn_urls=args.servers, limit=args.limit, max_users=args.max_users,
+                 server_timeout=args.server_timeout, index_path=args.index,
+                 connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                 keys_ttl=args.keys_ttl, metrics_ttl=args.metrics_ttl,
+                 stats_interval=args.stats_interval,
+                 member_ttl=args.member_ttl, non_member_ttl=args.non_member_ttl,
+                 pool_size=args.pool_size, placement=args.placement,
+                 health_interval=args.health_interval, failure_threshold=args.failure_threshold,
+                 reset_timeout=args.reset_timeout, metrics=metrics, profiler=profiler,
+                 create_window=args.create_window, idle_days=args.idle_days,
+                 sweep_interval=args.sweep_interval, sweep_batch=args.sweep_batch,
+                 sweep_pause=args.sweep_pause, sweep_dry_run=args.sweep_dry_run,
+                 limiter=RateLimiter(rate=args.message_rate, burst=int(args.message_rate)),
+                 digest_interval=args.digest_interval, shared_state=args.shared_state,
+                 stream_threshold=args.stream_threshold,
+                 quota_thresholds=tuple(int(threshold) for threshold in args.quota_thresholds.split(',')
+                                        if threshold.strip()))
 
-    updater = Updater(token=TOKEN, use_context=True, request_kwargs={
-        'read_timeout': 7, 'connect_timeout': 9})
-    dispatcher = updater.dispatcher
+    if args.apply_limits:
+        LimitApplier(bot.provider).start(bot.provider.bytes_limit)
+
+    if args.metrics_port > 0:
+        MetricsServer(metrics, profiler, listen=args.metrics_listen, port=args.metrics_port).start()
+
+    # handlers run on the worker pool, at most one per worker at a time;
+    # updates of one user are serialized by the bot
+    request = Request(con_pool_size=args.workers + 4, read_timeout=args.tg_read_timeout,
+                      connect_timeout=args.tg_connect_timeout)
+    dispatcher = BoundedDispatcher(Bot(TOKEN, request=request), Queue(), workers=args.workers,
+                                   use_context=True, max_in_flight=args.workers)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    bot.start_outbox(updater.bot)
+    bot.start_sweeper(updater.bot)
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('feedback', bot.start_feedback)],
+        entry_points=[CommandHandler('feedback', bot.start_feedback, run_async=True)],
         states={
-            0: [MessageHandler(Filters.text & ~Filters.command, bot.feedback)],
+            0: [MessageHandler(Filters.text & ~Filters.command, bot.feedback, run_async=True)],
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        fallbacks=[CommandHandler('cancel', bot.cancel, run_async=True)],
     )
 
-    dispatcher.add_handler(CommandHandler('start', bot.start))
-    dispatcher.add_handler(CommandHandler('stats', bot.stats))
+    dispatcher.add_handler(CommandHandler('start', bot.start, run_async=True))
+    dispatcher.add_handler(CommandHandler('stats', bot.stats, run_async=True))
     dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(ChatMemberHandler(bot.on_chat_member, ChatMemberHandler.CHAT_MEMBER))
     dispatcher.add_error_handler(bot.error_handler)
 
-    updater.start_polling()
+    if args.mode == 'webhook':
+        webhook = WebhookServer(dispatcher, updater.bot, listen=args.webhook_listen, port=args.webhook_port,
+                                path=args.webhook_path, secret_token=args.webhook_secret,
+                                queue_size=args.webhook_queue_size)
+        webhook.start()
+        # the background work starts once updates are taken, so a restart answers them first
+        bot.start_background()
+        if args.webhook_url:
+            api_kwargs = {'secret_token': args.webhook_secret} if args.webhook_secret else None
+            updater.bot.set_webhook(url=args.webhook_url, allowed_updates=Update.ALL_TYPES,
+                                    api_kwargs=api_kwargs)
+        try:
+            webhook.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            webhook.stop()
+            updater.stop()
+        return
+
+    # chat_member updates are only delivered when asked for explicitly
+    updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    bot.start_background()
     updater.idle()
 
 
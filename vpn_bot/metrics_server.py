@@ -0,0 +1,65 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from bot.metrics import Metrics, SlowestTraces
+
+
+class MetricsServer:
+    """
+    Serves the metrics in the Prometheus text format at /metrics
+    and, with a profiler, the slowest update traces at /debug/slowest
+    """
+
+    def __init__(self, metrics: Metrics, profiler: Optional[SlowestTraces] = None,
+                 listen: str = '127.0.0.1', port: int = 9090):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = metrics
+        self.profiler = profiler
+        self.server = ThreadingHTTPServer((listen, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='metrics-server', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        self.logger.info(f'Serving metrics on port {self.port}')
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = exporter.metrics.render()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/debug/slowest' and exporter.profiler is not None:
+                    body = exporter.profiler.dump()
+                    content_type = 'text/plain; charset=utf-8'
+                else:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                payload = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                exporter.logger.debug(format % args)
+
+        return Handler
@@ -0,0 +1,43 @@
+"""
+Unit tests for the bounded dispatcher
+"""
+
+import threading
+from queue import Queue
+
+from telegram import Bot, Update, User
+from telegram.ext import CommandHandler
+
+from vpn_bot.dispatcher import BoundedDispatcher
+from vpn_bot.test_webhook import command_update
+
+
+def test_failing_handlers_free_their_slot():
+    """Handlers that raise give their slot back, so later updates still run"""
+    bot = Bot("123:abc")
+    # skip the getMe request made to learn the bot's own name
+    bot._bot = User(1, "VPN", True, username="vpn_bot")  # pylint: disable=W0212
+    dispatcher = BoundedDispatcher(bot, Queue(), workers=2, use_context=True, max_in_flight=2)
+    calls = threading.Semaphore(0)
+
+    def start(_update, _context):
+        calls.release()
+        raise Exception("No VPN servers found")
+
+    dispatcher.add_handler(CommandHandler("start", start, run_async=True))
+    dispatcher.add_error_handler(lambda _update, _context: None)
+    # the workers running async handlers are started with the dispatcher
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    for _ in range(500):
+        if dispatcher.running:
+            break
+        threading.Event().wait(0.01)
+
+    def deliver():
+        for update_id in range(1, 6):
+            dispatcher.process_update(Update.de_json(command_update(update_id), bot))
+
+    threading.Thread(target=deliver, daemon=True).start()
+    for _ in range(5):
+        assert calls.acquire(timeout=5)
+    dispatcher.stop()
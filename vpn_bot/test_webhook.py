@@ -0,0 +1,130 @@
+"""
+Unit tests for the webhook listener
+"""
+
+import http.client
+import json
+import threading
+from queue import Queue
+
+import pytest
+from telegram import Bot, User
+from telegram.ext import CommandHandler
+
+from vpn_bot.dispatcher import BoundedDispatcher
+from vpn_bot.webhook import SECRET_HEADER, WebhookServer
+
+
+def command_update(update_id: int, command: str = "/start") -> dict:
+    """A private message with a bot command, as Telegram sends it"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "Test"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+@pytest.fixture
+def handled():
+    """Update ids seen by the handler, and a gate that keeps the handler busy"""
+    return {"ids": [], "done": threading.Semaphore(0), "gate": threading.Event()}
+
+
+@pytest.fixture
+def webhook(handled):  # pylint: disable=W0621
+    """A listener on a free local port feeding a real dispatcher"""
+    bot = Bot("123:abc")
+    # skip the getMe request made to learn the bot's own name
+    bot._bot = User(1, "VPN", True, username="vpn_bot")  # pylint: disable=W0212
+    dispatcher = BoundedDispatcher(
+        bot, Queue(), workers=2, use_context=True, max_in_flight=1
+    )
+
+    def start(update, _context):
+        handled["gate"].wait(5)
+        handled["ids"].append(update.update_id)
+        handled["done"].release()
+
+    dispatcher.add_handler(CommandHandler("start", start, run_async=True))
+    server = WebhookServer(dispatcher, bot, port=0, secret_token="s3cret", queue_size=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    handled["gate"].set()
+    server.stop()
+
+
+def post(
+    webhook: WebhookServer,  # pylint: disable=W0621
+    body,
+    secret: str = "s3cret",
+    path: str = "/telegram",
+    length: str = None,
+) -> int:
+    """Delivers a request the way Telegram does"""
+    data = body if isinstance(body, bytes) else json.dumps(body).encode()
+    connection = http.client.HTTPConnection("127.0.0.1", webhook.port, timeout=5)
+    connection.putrequest("POST", path)
+    connection.putheader(SECRET_HEADER, secret)
+    connection.putheader("Content-Type", "application/json")
+    connection.putheader("Content-Length", length or str(len(data)))
+    connection.endheaders(data)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def wait_consumed(webhook: WebhookServer):  # pylint: disable=W0621
+    """Waits until the consumer took the queued update"""
+    for _ in range(500):
+        if webhook.updates.empty():
+            break
+        threading.Event().wait(0.01)
+
+
+def test_runs_async_handlers(webhook, handled):  # pylint: disable=W0621
+    """Updates reach handlers registered with run_async"""
+    handled["gate"].set()
+    webhook.start()
+
+    assert post(webhook, command_update(1)) == 200
+    assert handled["done"].acquire(timeout=5)
+    assert handled["ids"] == [1]
+
+
+def test_rejects_wrong_secret_and_path(webhook):  # pylint: disable=W0621
+    """Only Telegram, on the configured path, may deliver updates"""
+    assert post(webhook, command_update(1), secret="wrong") == 403
+    assert post(webhook, command_update(1), path="/other") == 404
+
+
+def test_rejects_malformed_requests(webhook):  # pylint: disable=W0621
+    """A bad length or a body that is not an update is refused"""
+    assert post(webhook, command_update(1), length="many") == 400
+    assert post(webhook, [1, 2]) == 400
+    assert post(webhook, {"message": {}}) == 400
+    assert post(webhook, b"{not json") == 400
+
+
+def test_backpressure(webhook, handled):  # pylint: disable=W0621
+    """While every handler slot is busy, deliveries back up and are refused"""
+    webhook.start()
+
+    # the first update takes the only slot, the second waits for it in the
+    # consumer and the third fills the queue
+    assert post(webhook, command_update(1)) == 200
+    wait_consumed(webhook)
+    assert post(webhook, command_update(2)) == 200
+    wait_consumed(webhook)
+    assert post(webhook, command_update(3)) == 200
+    assert post(webhook, command_update(4)) == 503
+
+    handled["gate"].set()
+    for _ in range(3):
+        assert handled["done"].acquire(timeout=5)
+    assert sorted(handled["ids"]) == [1, 2, 3]
@@ -0,0 +1,129 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class WebhookServer:
+    """
+    Receives updates pushed by Telegram and hands them to the dispatcher.
+
+    Updates wait in a bounded queue between the HTTP listener and the dispatcher
+    and are dispatched in order by a single consumer. With a BoundedDispatcher the
+    consumer waits while every handler slot is busy, the queue fills up and the
+    listener answers 503, so Telegram retries the delivery later instead of the bot
+    piling up work it cannot finish.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, listen: str = '127.0.0.1', port: int = 8443,
+                 path: str = '/telegram', secret_token: Optional[str] = None, queue_size: int = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.updates: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.server = ThreadingHTTPServer((listen, port), self._handler())
+        self.server.daemon_threads = True
+        self._stopped = threading.Event()
+        self._consumer = threading.Thread(target=self._consume, name='webhook-consumer', daemon=True)
+        self._dispatcher_ready = threading.Event()
+        # the dispatcher's own loop stays idle; starting it spawns the run_async workers
+        self._dispatcher_thread = threading.Thread(
+            target=dispatcher.start, kwargs={'ready': self._dispatcher_ready}, name='dispatcher', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        """
+        Start the dispatcher's workers and hand queued updates to the dispatcher
+        """
+        self._dispatcher_thread.start()
+        self._dispatcher_ready.wait()
+        self._consumer.start()
+        self.logger.info(f'Listening for updates on port {self.port} at {self.path}')
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._stopped.set()
+        if self.dispatcher.running:
+            self.dispatcher.stop()
+
+    def accept(self, body: bytes, secret_token: Optional[str]) -> int:
+        """
+        Queue one delivery from Telegram
+        :return: HTTP status to answer with
+        """
+        if self.secret_token is not None and (
+                secret_token is None or not hmac.compare_digest(secret_token, self.secret_token)):
+            return 403
+
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            self.logger.error(f'Could not parse an update: {e}')
+            return 400
+        if not isinstance(data, dict) or 'update_id' not in data:
+            self.logger.error('Received something that is not an update')
+            return 400
+
+        try:
+            self.updates.put_nowait(Update.de_json(data, self.bot))
+        except queue.Full:
+            self.logger.warning(
+                f'Update queue is full ({self.updates.maxsize}); asking Telegram to retry')
+            return 503
+        return 200
+
+    def _consume(self):
+        while not self._stopped.is_set():
+            try:
+                update = self.updates.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.dispatcher.process_update(update)
+            except Exception as e:
+                self.logger.error(f'Could not process an update: {e}')
+
+    def _handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = 0
+
+                if self.path != webhook.path:
+                    status = 404
+                elif length <= 0 or length > MAX_BODY_BYTES:
+                    status = 413 if length > 0 else 400
+                else:
+                    status = webhook.accept(self.rfile.read(length), self.headers.get(SECRET_HEADER))
+
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                webhook.logger.debug(format % args)
+
+        return Handler